@@ -0,0 +1,652 @@
+import base64
+import click
+import fcntl
+import json
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+import tty
+
+from shakenfist_agent.commandline import daemon
+from shakenfist_agent import protocol
+from shakenfist_agent import version
+
+
+@click.group(help='Benchmark commands')
+def benchmark():
+    pass
+
+
+class ReplayAgent(protocol.Agent):
+    """An agent which reads from a canned list of reads instead of a fd."""
+
+    def __init__(self, reads):
+        super(ReplayAgent, self).__init__()
+        self.reads = reads
+        self.read_index = 0
+
+    def _read(self):
+        if self.read_index >= len(self.reads):
+            return None
+        d = self.reads[self.read_index]
+        self.read_index += 1
+        return d
+
+
+class LegacyReplayAgent(ReplayAgent):
+    """The packet parser as it was before it became incremental. This is only
+    here so we can measure the new parser against it."""
+
+    def __init__(self, reads):
+        super(LegacyReplayAgent, self).__init__(reads)
+        self.legacy_buffer = b''
+
+    def find_packet(self):
+        d = self._read()
+        if d:
+            self.legacy_buffer += d
+
+        buffer_as_string = self.legacy_buffer.decode('utf-8')
+        offset = buffer_as_string.find(self.PREAMBLE)
+        if offset == -1:
+            return None
+
+        blen = len(self.legacy_buffer)
+        len_end = offset + 17
+        if blen < len_end:
+            return None
+
+        plen = int(buffer_as_string[offset + 9: len_end])
+        if blen < len_end + 1 + plen:
+            return None
+
+        packet = self.legacy_buffer[len_end + 1: len_end + 1 + plen]
+        self.legacy_buffer = self.legacy_buffer[len_end + 1 + plen:]
+        return json.loads(packet.decode('utf-8'))
+
+
+def _make_reads(packet_size, count, read_size):
+    stream = bytearray()
+    packet = {'command': 'put-file', 'chunk': 'x' * packet_size}
+    for _ in range(count):
+        j = json.dumps(packet)
+        stream += ('%s[%08d]%s' % (protocol.Agent.PREAMBLE, len(j), j)).encode('utf-8')
+    return [bytes(stream[i:i + read_size])
+            for i in range(0, len(stream), read_size)]
+
+
+def _time_parser(agent_class, reads):
+    a = agent_class(reads)
+    found = 0
+    start = time.monotonic()
+    while a.read_index < len(reads):
+        for _ in a.find_packets():
+            found += 1
+    elapsed = time.monotonic() - start
+    return found, elapsed
+
+
+@benchmark.command(name='parser', help='Measure packet parser throughput')
+@click.option('--packet-size', default=1400, type=int,
+              help='Size of each packet body in bytes')
+@click.option('--count', default=10000, type=int,
+              help='Number of packets to parse')
+@click.option('--read-size', default=protocol.MAX_WRITE * 2, type=int,
+              help='Size of each simulated read')
+@click.option('--legacy/--no-legacy', default=True,
+              help='Also measure the previous parser implementation')
+def benchmark_parser(packet_size, count, read_size, legacy):
+    reads = _make_reads(packet_size, count, read_size)
+    total_bytes = sum(len(r) for r in reads)
+
+    implementations = [('incremental', ReplayAgent)]
+    if legacy:
+        implementations.append(('legacy', LegacyReplayAgent))
+
+    results = {}
+    for name, agent_class in implementations:
+        found, elapsed = _time_parser(agent_class, reads)
+        results[name] = {
+            'packets': found,
+            'seconds': elapsed,
+            'packets_per_second': found / elapsed,
+            'mb_per_second': total_bytes / elapsed / 1024 / 1024
+        }
+    click.echo(json.dumps(results, indent=4, sort_keys=True))
+
+
+benchmark.add_command(benchmark_parser)
+
+
+# Packets used to measure the JSON codecs. A small control packet, and a
+# get-file-response carrying a base64 encoded chunk.
+CODEC_PACKETS = {
+    'control': {
+        'command': 'execute-response',
+        'stdout': 'Linux guest 6.1.0-13-amd64 #1 SMP x86_64 GNU/Linux\n',
+        'stderr': '',
+        'return-code': 0,
+        'unique': '1697536800.123456'
+    },
+    'chunk': {
+        'command': 'get-file-response',
+        'result': True,
+        'path': '/var/log/syslog',
+        'offset': 1048576,
+        'encoding': 'base64',
+        'chunk': base64.b64encode(os.urandom(48 * 1024)).decode('utf-8'),
+        'unique': '1697536800.123456'
+    }
+}
+
+
+def _time_codec_encode(codec, packet, count):
+    frames = []
+    a = protocol.Agent()
+    a.use_json_codec(codec)
+    a._write = lambda *parts, **kwargs: frames.append(parts)
+
+    start = time.monotonic()
+    for _ in range(count):
+        a.send_packet(packet)
+    elapsed = time.monotonic() - start
+    return b''.join(frames[0]), elapsed
+
+
+def _time_codec_decode(codec, frame, count, read_size):
+    stream = frame * count
+    reads = [stream[i:i + read_size] for i in range(0, len(stream), read_size)]
+    a = ReplayAgent(reads)
+    a.use_json_codec(codec)
+
+    found = 0
+    start = time.monotonic()
+    while a.read_index < len(reads):
+        for _ in a.find_packets():
+            found += 1
+    return found, time.monotonic() - start
+
+
+@benchmark.command(name='codec', help='Measure JSON codec throughput')
+@click.option('--count', default=10000, type=int,
+              help='Number of packets to encode and decode')
+@click.option('--read-size', default=protocol.MAX_WRITE * 2, type=int,
+              help='Size of each simulated read when decoding')
+def benchmark_codec(count, read_size):
+    results = {}
+    for codec in protocol.json_codecs():
+        for name, packet in CODEC_PACKETS.items():
+            frame, encode_elapsed = _time_codec_encode(codec, packet, count)
+            found, decode_elapsed = _time_codec_decode(
+                codec, frame, count, read_size)
+            total_bytes = len(frame) * count
+
+            results.setdefault(codec, {})[name] = {
+                'frame_bytes': len(frame),
+                'encode': {
+                    'seconds': encode_elapsed,
+                    'frames_per_second': count / encode_elapsed,
+                    'mb_per_second': total_bytes / encode_elapsed / 1024 / 1024
+                },
+                'decode': {
+                    'frames': found,
+                    'seconds': decode_elapsed,
+                    'frames_per_second': found / decode_elapsed,
+                    'mb_per_second': total_bytes / decode_elapsed / 1024 / 1024
+                }
+            }
+    click.echo(json.dumps(results, indent=4, sort_keys=True))
+
+
+benchmark.add_command(benchmark_codec)
+
+
+def _set_fd_blocking(fd):
+    oflags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, oflags & ~os.O_NONBLOCK)
+
+
+class BenchmarkChannel(object):
+    """A raw pty or socketpair standing in for the virtio-serial port, with a
+    real SFFileAgent on the guest end running in a thread, and a plain Agent
+    on the host end driven by the caller."""
+
+    def __init__(self, kind='pty'):
+        self.kind = kind
+        if kind == 'socketpair':
+            self.host_socket, self.guest_socket = socket.socketpair()
+            host_fd = self.host_socket.fileno()
+        else:
+            self.master_fd, self.slave_fd = os.openpty()
+            tty.setraw(self.slave_fd)
+            host_fd = self.master_fd
+
+        self.host = protocol.Agent()
+        self.host.input_fileno = host_fd
+        self.host.output_fileno = host_fd
+        self.host.add_command('agent-start', self.host.noop)
+
+        if kind == 'socketpair':
+            # A socket can't be opened by path, so start the guest on
+            # /dev/null and then swap in our end of the socketpair.
+            self.guest = daemon.SFFileAgent(os.devnull)
+            os.close(self.guest.input_fileno)
+            self.guest.input_fileno = self.guest_socket.fileno()
+            self.guest.output_fileno = self.guest.input_fileno
+        else:
+            self.guest = daemon.SFFileAgent(os.ttyname(self.slave_fd))
+
+        # Both ends only read once the selector says there is data, so we can
+        # use blocking writes. This stops the host end queueing an entire
+        # put-file in memory before the reactor gets a chance to flush it.
+        _set_fd_blocking(host_fd)
+        _set_fd_blocking(self.guest.input_fileno)
+        self.host.start_reactor(keepalive=False)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run_guest, daemon=True)
+        self.thread.start()
+
+        # The guest runs in the same process as the host, so we need its
+        # thread's CPU clock to tell how much of the work was the guest's.
+        self.guest_clock = time.pthread_getcpuclockid(self.thread.ident)
+
+    def _run_guest(self):
+        self.guest.start_reactor(keepalive=False)
+        while self.running:
+            self.guest.run_once(timeout=0.1)
+
+    def guest_cpu_time(self):
+        return time.clock_gettime(self.guest_clock)
+
+    def run_until(self, condition, timeout=600):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError('benchmark operation timed out')
+            self.host.run_once(timeout=0.1)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        if self.kind == 'socketpair':
+            self.guest_socket.close()
+            self.host_socket.close()
+        else:
+            os.close(self.guest.input_fileno)
+            os.close(self.slave_fd)
+            os.close(self.master_fd)
+
+
+def _timed(channel, func):
+    # Returns wall clock seconds, CPU seconds for the whole process, and CPU
+    # seconds for the guest thread alone.
+    start = time.monotonic()
+    start_cpu = time.process_time()
+    start_guest_cpu = channel.guest_cpu_time()
+    func()
+    return (time.monotonic() - start, time.process_time() - start_cpu,
+            channel.guest_cpu_time() - start_guest_cpu)
+
+
+def _transfer_result(transferred, elapsed, cpu, guest_cpu):
+    mb = transferred / 1024 / 1024
+    result = {
+        'bytes': transferred,
+        'seconds': elapsed,
+        'bytes_per_second': transferred / elapsed,
+        'mb_per_second': mb / elapsed,
+        'cpu_seconds': cpu,
+        'guest_cpu_seconds': guest_cpu
+    }
+    if mb:
+        result['cpu_seconds_per_mb'] = cpu / mb
+        result['guest_cpu_seconds_per_mb'] = guest_cpu / mb
+    return result
+
+
+def _benchmark_get_file(channel, path, encoding):
+    state = {'bytes': 0, 'done': False}
+
+    def response(packet):
+        if 'stat_result' in packet:
+            if packet.get('encoding') == 'binary':
+                channel.host.register_binary_stream(
+                    packet['stream'],
+                    lambda p: state.update(bytes=state['bytes'] + len(p['chunk'])))
+        elif packet['chunk'] is None:
+            state['done'] = True
+        else:
+            state['bytes'] += len(base64.b64decode(packet['chunk']))
+
+    def get():
+        channel.host.send_packet({
+            'command': 'get-file',
+            'path': path,
+            'encoding': encoding,
+            'unique': 'benchmark'
+        })
+        channel.run_until(lambda: state['done'])
+
+    channel.host.add_command('get-file-response', response)
+    timings = _timed(channel, get)
+    return _transfer_result(state['bytes'], *timings)
+
+
+def _benchmark_put_file(channel, source, destination, encoding):
+    state = {'done': False}
+    channel.host.add_command(
+        'put-file-response', lambda p: state.update(done=True))
+
+    def put():
+        stream_id = channel.host.allocate_stream_id()
+        channel.host.send_packet({
+            'command': 'put-file',
+            'path': destination,
+            'stat_result': {'size': os.stat(source).st_size},
+            'encoding': encoding,
+            'stream': stream_id,
+            'unique': 'benchmark'
+        })
+
+        offset = 0
+        chunk_size = protocol.BINARY_CHUNK_SIZE if encoding == 'binary' else 1024
+        with open(source, 'rb') as f:
+            d = f.read(chunk_size)
+            while d:
+                if encoding == 'binary':
+                    channel.host.send_binary(stream_id, offset, d)
+                else:
+                    channel.host.send_packet({
+                        'command': 'put-file',
+                        'path': destination,
+                        'offset': offset,
+                        'encoding': 'base64',
+                        'chunk': base64.b64encode(d).decode('utf-8'),
+                        'unique': 'benchmark'
+                    })
+                offset += len(d)
+                d = f.read(chunk_size)
+
+        channel.host.send_packet({
+            'command': 'put-file',
+            'path': destination,
+            'offset': offset,
+            'encoding': encoding,
+            'stream': stream_id,
+            'chunk': None,
+            'unique': 'benchmark'
+        })
+        channel.run_until(lambda: state['done'])
+
+    timings = _timed(channel, put)
+    return _transfer_result(os.stat(destination).st_size, *timings)
+
+
+def _write_test_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def _measure_requests(channel, kind, count, depth):
+    # Send count requests of one kind, keeping depth of them outstanding,
+    # and time each round trip.
+    response_command, make_packet = REQUEST_KINDS[kind]
+    sent = {}
+    latencies = []
+    state = {'next': 0}
+
+    def send_next():
+        unique = state['next']
+        state['next'] += 1
+        sent[unique] = time.monotonic()
+        channel.host.send_packet(make_packet(unique))
+
+    def response(packet):
+        latencies.append(time.monotonic() - sent.pop(packet['unique']))
+        if state['next'] < count:
+            send_next()
+
+    def run():
+        for _ in range(min(depth, count)):
+            send_next()
+        channel.run_until(lambda: len(latencies) >= count)
+
+    channel.host.add_command(response_command, response)
+    elapsed, cpu, guest_cpu = _timed(channel, run)
+
+    latencies.sort()
+    return {
+        'requests': count,
+        'depth': depth,
+        'seconds': elapsed,
+        'requests_per_second': count / elapsed,
+        'packets_per_second': 2 * count / elapsed,
+        'latency_ms': {
+            'mean': 1000 * sum(latencies) / count,
+            'p50': 1000 * _percentile(latencies, 50),
+            'p99': 1000 * _percentile(latencies, 99),
+            'max': 1000 * latencies[-1]
+        },
+        'cpu_seconds': cpu,
+        'guest_cpu_seconds': guest_cpu
+    }
+
+
+def _percentile(ordered, percent):
+    # Nearest rank percentile of an already sorted list
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+# The kinds of request we can measure latency for. ping is handled inline on
+# the guest's loop thread, and a single stat batch is dispatched to the worker
+# pool, so the pair shows what that dispatch costs. Each kind is the command
+# the guest replies with, and a function which builds a request packet.
+REQUEST_KINDS = {
+    'ping': ('pong', lambda unique: {
+        'command': 'ping',
+        'unique': unique
+    }),
+    'stat': ('batch-response', lambda unique: {
+        'command': 'batch',
+        'operations': [{'op': 'stat', 'path': '/'}],
+        'unique': unique
+    })
+}
+
+
+def _run_requests(channel, kinds, count, depths):
+    results = {}
+    for kind in kinds:
+        for depth in depths:
+            results.setdefault(kind, {})['depth-%d' % depth] = \
+                _measure_requests(channel, kind, count, depth)
+    return results
+
+
+def _run_transfer(channel, td, sizes, encodings):
+    results = {}
+    for size in sizes:
+        source = os.path.join(td, 'source')
+        _write_test_file(source, size * 1024 * 1024)
+        size_results = results.setdefault('%dMiB' % size, {})
+
+        for enc in encodings:
+            destination = os.path.join(td, 'destination-%s' % enc)
+            size_results.setdefault(enc, {})['get-file'] = \
+                _benchmark_get_file(channel, source, enc)
+            size_results[enc]['put-file'] = \
+                _benchmark_put_file(channel, source, destination, enc)
+            os.unlink(destination)
+    return results
+
+
+def _emit(results, output):
+    results['version'] = version.version_string()
+    results['time'] = time.time()
+    j = json.dumps(results, indent=4, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(j + '\n')
+    click.echo(j)
+
+
+channel_option = click.option(
+    '--channel', 'channel_kind', default='pty',
+    type=click.Choice(['pty', 'socketpair']),
+    help='What to use in place of the virtio-serial port')
+output_option = click.option(
+    '--output', default=None, type=click.Path(dir_okay=False),
+    help='Also write the JSON results to this file')
+encoding_option = click.option(
+    '--encoding', default=['base64', 'binary'], multiple=True,
+    type=click.Choice(['base64', 'binary']),
+    help='Encodings to measure, may be repeated')
+kind_option = click.option(
+    '--kind', default=list(REQUEST_KINDS), multiple=True,
+    type=click.Choice(list(REQUEST_KINDS)),
+    help='Kinds of request to measure, may be repeated')
+depth_option = click.option(
+    '--depth', default=[1, 16], multiple=True, type=int,
+    help='Number of requests to keep outstanding, may be repeated')
+
+
+@benchmark.command(name='requests',
+                   help='Measure ping-pong packet rate and request latency')
+@click.option('--count', default=10000, type=int,
+              help='Number of requests to send for each measurement')
+@kind_option
+@depth_option
+@channel_option
+@output_option
+def benchmark_requests(count, kind, depth, channel_kind, output):
+    channel = BenchmarkChannel(channel_kind)
+    try:
+        results = {'channel': channel_kind,
+                   'requests': _run_requests(channel, kind, count, depth)}
+    finally:
+        channel.close()
+    _emit(results, output)
+
+
+benchmark.add_command(benchmark_requests)
+
+
+@benchmark.command(name='transfer',
+                   help='Measure get-file and put-file throughput')
+@click.option('--size', default=[1, 16, 256], multiple=True, type=int,
+              help='Size of the file to transfer in MiB, may be repeated')
+@encoding_option
+@channel_option
+@output_option
+def benchmark_transfer(size, encoding, channel_kind, output):
+    with tempfile.TemporaryDirectory() as td:
+        channel = BenchmarkChannel(channel_kind)
+        try:
+            results = {
+                'channel': channel_kind,
+                'transfer': _run_transfer(channel, td, size, encoding),
+                'guest_output_counters': channel.guest.output_counters,
+                'guest_link': channel.guest.link.snapshot()
+            }
+        finally:
+            channel.close()
+    _emit(results, output)
+
+
+benchmark.add_command(benchmark_transfer)
+
+
+@benchmark.command(name='suite',
+                   help='Run the request and transfer benchmarks together')
+@click.option('--count', default=10000, type=int,
+              help='Number of requests to send for each measurement')
+@click.option('--size', default=[1, 16, 256], multiple=True, type=int,
+              help='Size of the file to transfer in MiB, may be repeated')
+@kind_option
+@depth_option
+@encoding_option
+@channel_option
+@output_option
+def benchmark_suite(count, size, kind, depth, encoding, channel_kind, output):
+    with tempfile.TemporaryDirectory() as td:
+        channel = BenchmarkChannel(channel_kind)
+        try:
+            results = {
+                'channel': channel_kind,
+                'requests': _run_requests(channel, kind, count, depth),
+                'transfer': _run_transfer(channel, td, size, encoding),
+                'guest_output_counters': channel.guest.output_counters,
+                'guest_link': channel.guest.link.snapshot()
+            }
+        finally:
+            channel.close()
+    _emit(results, output)
+
+
+benchmark.add_command(benchmark_suite)
+
+
+def _set_guest_compression(channel, codec):
+    state = {'done': False}
+    channel.host.add_command(
+        'set-compression-response', lambda p: state.update(done=True))
+    channel.host.send_packet({'command': 'set-compression', 'codec': codec})
+    channel.run_until(lambda: state['done'])
+
+
+def _write_compressible_file(path, size):
+    line = ('Oct 17 10:00:00 guest systemd[1]: Started Session 42 of user '
+            'ubuntu.\n').encode('utf-8')
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(line[:size])
+            size -= len(line)
+
+
+@benchmark.command(name='compression',
+                   help='Measure get-file time with each compression codec')
+@click.option('--size', default=64, type=int,
+              help='Size of the file to transfer in MiB')
+@click.option('--encoding', default=['base64', 'binary'], multiple=True,
+              type=click.Choice(['base64', 'binary']),
+              help='Encodings to measure, may be repeated')
+def benchmark_compression(size, encoding):
+    results = {}
+    with tempfile.TemporaryDirectory() as td:
+        sources = {
+            'compressible': os.path.join(td, 'compressible'),
+            'incompressible': os.path.join(td, 'incompressible')
+        }
+        _write_compressible_file(sources['compressible'], size * 1024 * 1024)
+        _write_test_file(sources['incompressible'], size * 1024 * 1024)
+
+        channel = BenchmarkChannel()
+        try:
+            for codec in [None] + protocol.compression_codecs():
+                _set_guest_compression(channel, codec)
+                codec_name = codec or 'none'
+
+                for data_type, source in sources.items():
+                    for enc in encoding:
+                        before = channel.guest.output_counters['bytes']
+                        result = _benchmark_get_file(channel, source, enc)
+                        result['bytes_on_wire'] = \
+                            channel.guest.output_counters['bytes'] - before
+
+                        results.setdefault(codec_name, {}).setdefault(
+                            data_type, {})[enc] = result
+        finally:
+            channel.close()
+
+    click.echo(json.dumps(results, indent=4, sort_keys=True))
+
+
+benchmark.add_command(benchmark_compression)
@@ -1,24 +1,105 @@
 import base64
 import click
-import distro
-from linux_utils.fstab import find_mounted_filesystems
-import multiprocessing
+import codecs
+import fnmatch
+import hashlib
 import os
-from oslo_concurrency import processutils
-from pbr.version import VersionInfo
 import psutil
-import select
 import shutil
 import signal
+import subprocess
 import symbolicmode
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 
+from shakenfist_agent import delta
+from shakenfist_agent import facts
+from shakenfist_agent import inotify
+from shakenfist_agent import metrics
+from shakenfist_agent import process
 from shakenfist_agent import protocol
+from shakenfist_agent import trace
+from shakenfist_agent import version
+
+# Some modules are slow to import and not needed to start, so that we can
+# send agent-start as soon as possible after boot. oslo_concurrency and
+# shakenfist_agent.profiling are imported by the commands which use them.
 
 
 SIDE_CHANNEL_PATH = '/dev/virtio-ports/sf-agent'
 
+# Data appended to watched files is read in pieces of at most this size.
+WATCH_READ_SIZE = 65536
+
+# Output from streaming executes is read from the command's pipes in pieces
+# of at most this size, each of which becomes one execute-output packet.
+EXECUTE_READ_SIZE = 65536
+
+# verify-file reports digests of blocks of this size unless asked otherwise.
+VERIFY_BLOCK_SIZE = 1024 * 1024
+
+# sync-file sends at most this many block signatures in each packet.
+SIGNATURES_PER_PACKET = 4096
+
+# Files created by sync-file get this mode unless the host specifies one.
+DEFAULT_SYNC_MODE = 0o644
+
+# Holes sent by the host which overlap existing data are zeroed in writes of
+# at most this size.
+HOLE_WRITE_SIZE = 1024 * 1024
+
+# get-tree reads the archive it is building in pieces of at most this size,
+# each of which becomes one chunk.
+TREE_READ_SIZE = 65536
+
+# subscribe-metrics samples this often, in seconds, unless asked otherwise.
+METRICS_INTERVAL = 10
+
+# profile runs for this many seconds unless asked otherwise, and never for
+# longer than the maximum. It reports this many functions unless asked
+# otherwise.
+PROFILE_DURATION = 10
+MAX_PROFILE_DURATION = 300
+PROFILE_LIMIT = 50
+
+# Optional protocol features this agent supports, advertised in agent-start.
+# A host which understands binary-chunks may ask for file data in binary
+# frames by setting 'encoding' to 'binary' in get-file and put-file packets.
+# A host which understands flow-control may set 'window' in a get-file
+# packet, and then acknowledge received data with window-ack packets. The
+# codecs listed in the compression field of agent-start may be enabled with a
+# set-compression packet. Similarly the codecs listed in the json-codecs
+# field may be chosen with a set-json-codec packet, which a host must do
+# before the agent will send non-ASCII characters unescaped. A host which
+# understands streaming-execute may set 'stream-output' in an execute packet
+# to receive output as it is produced.
+# A host which understands resumable-transfers may ask for digests and start
+# offsets in get-file and put-file, and query partial files with verify-file.
+# A host which understands delta-sync may update files with sync-file.
+# Signatures arrive over one or more sync-file-response packets, and the
+# host should wait for the one marked complete.
+# A host which understands sparse-files may ask get-file to send holes as
+# hole packets, and may send them to put-file. A host which understands
+# tree-transfer may move whole directories as tar archives with get-tree and
+# put-tree. A host which understands batch may send a list of operations in
+# a single batch packet. A host which understands fact-subscriptions may ask
+# gather-facts for some groups of facts, and subscribe to changes in them.
+# A host which understands metrics may subscribe to resource usage samples
+# with subscribe-metrics. A host which understands agent-stats may ask how
+# the agent itself is performing with get-agent-stats, and profile it for a
+# while with profile. A host which understands packet-trace may ask the
+# agent to remember the last few frames it sent and received with
+# set-packet-trace, and fetch them with get-packet-trace. A host which
+# understands ping-timestamps may put a timestamp in its pings, which the
+# agent returns in the pong so the host can measure the round trip time.
+CAPABILITIES = ['binary-chunks', 'flow-control', 'streaming-execute',
+                'resumable-transfers', 'delta-sync', 'sparse-files',
+                'tree-transfer', 'batch', 'fact-subscriptions', 'metrics',
+                'agent-stats', 'profile', 'packet-trace', 'ping-timestamps']
+
 
 @click.group(help='Daemon commands')
 def daemon():
@@ -29,22 +110,60 @@ class SFFileAgent(protocol.FileAgent):
     def __init__(self, path, logger=None):
         super(SFFileAgent, self).__init__(path, logger=logger)
 
+        # The reactor is started once we are set up, so output sent before
+        # then (agent-start and the first ping) waits for it rather than
+        # blocking startup when there is no host on the channel.
+        self.write_timeout = None
+
         self.watched_files = {}
-        self.executing_commands = []
+        self.inotify = None
+        self._watch_descriptors = {}
+        self._directory_watches = {}
+        self.supervisor = process.ProcessSupervisor(self, logger=logger)
+        self.facts = facts.FactsCache()
+        self.facts.watch(self, self._facts_changed)
+        self._facts_subscriptions = {}
+        self._facts_timers = set()
+        self._batch_operations = {
+            'write': self._batch_write,
+            'chmod': self._batch_chmod,
+            'chown': self._batch_chown,
+            'mkdir': self._batch_mkdir,
+            'symlink': self._batch_symlink,
+            'unlink': self._batch_unlink,
+            'rename': self._batch_rename,
+            'stat': self._batch_stat,
+            'execute': self._batch_execute
+        }
 
-        self.add_command('is-system-running', self.is_system_running)
-        self.add_command('gather-facts', self.gather_facts)
+        self.add_command('is-system-running', self.is_system_running,
+                         blocking=True)
+        self.add_command('gather-facts', self.gather_facts, blocking=True)
+        self.add_command('subscribe-metrics', self.subscribe_metrics)
+        self.add_command('profile', self.profile)
         self.add_command('put-file', self.put_file)
         self.add_command('chmod', self.chmod)
         self.add_command('chown', self.chown)
         self.add_command('get-file', self.get_file)
+        self.add_command('verify-file', self.verify_file, blocking=True)
+        self.add_command('sync-file', self.sync_file, blocking=True)
+        self.add_command('sync-file-delta', self.sync_file_delta)
+        self.add_command('get-tree', self.get_tree)
+        self.add_command('put-tree', self.put_tree)
         self.add_command('watch-file', self.watch_file)
-        self.add_command('execute', self.execute)
+        self.add_command('unwatch-file', self.unwatch_file)
+        self.add_command('batch', self.batch)
+        self.add_command('execute', self.execute,
+                         blocking=lambda p: (p.get('block-for-result', True) and
+                                             not p.get('stream-output', False)))
 
         self.send_packet({
             'command': 'agent-start',
-            'message': 'version %s' % VersionInfo('shakenfist_agent').version_string(),
+            'message': 'version %s' % version.version_string(),
             'system_boot_time': psutil.boot_time(),
+            'capabilities': CAPABILITIES,
+            'compression': protocol.compression_codecs(),
+            'json-codecs': protocol.json_codecs(),
             'unique': str(time.time())
         })
 
@@ -52,6 +171,8 @@ class SFFileAgent(protocol.FileAgent):
             self.log.debug('Setup complete')
 
         self.incomplete_file_puts = {}
+        self.incomplete_file_syncs = {}
+        self.incomplete_tree_puts = {}
 
     def close(self):
         self.send_packet({
@@ -59,9 +180,14 @@ class SFFileAgent(protocol.FileAgent):
             'system_boot_time': psutil.boot_time(),
             'unique': str(time.time())
         })
+        if self.inotify:
+            self.inotify.close()
+        self.facts.close(self)
         super(SFFileAgent, self).close()
 
     def is_system_running(self, packet):
+        from oslo_concurrency import processutils
+
         out, _ = processutils.execute(
             'systemctl is-system-running', shell=True, check_exit_code=False)
         out = out.rstrip()
@@ -74,57 +200,828 @@ class SFFileAgent(protocol.FileAgent):
         })
 
     def gather_facts(self, packet):
-        facts = {
-            'distribution': distro.info(),
-            'mounts': [],
-            'ssh-host-keys': {}
+        # Facts come from a cache, see facts.FactsCache. The host may ask for
+        # only some groups of facts, and may subscribe to be sent the groups
+        # which later change, until it cancels the subscription.
+        unique = packet.get('unique', str(time.time()))
+        groups = packet.get('groups') or self.facts.groups()
+        unknown = [g for g in groups if g not in self.facts.groups()]
+        if unknown:
+            self.send_packet({
+                'command': 'gather-facts-response',
+                'result': False,
+                'message': 'unknown fact groups: %s' % ', '.join(unknown),
+                'unique': unique
+            })
+            return
+
+        response = {
+            'command': 'gather-facts-response',
+            'result': self.facts.get(groups),
+            'unique': unique
+        }
+        if not packet.get('subscribe', False):
+            self.send_packet(response)
+            return
+
+        # We run on a worker thread, but streams and subscriptions are only
+        # changed on the loop thread
+        self.call_soon(lambda: self._subscribe_facts(response, groups))
+
+    def _subscribe_facts(self, response, groups):
+        stream = self.open_stream('gather-facts', response['unique'])
+        stream.on_cancel = lambda: self._facts_subscriptions.pop(
+            stream.id, None)
+        self._facts_subscriptions[stream.id] = {
+            'stream': stream,
+            'groups': groups
         }
+        response['stream'] = stream.id
+        self._schedule_fact_expiry(groups)
+        self.send_packet(response)
 
-        # We should allow this agent to at least run on MacOS
-        if facts['distribution']['id'] != 'darwin':
-            for entry in find_mounted_filesystems():
-                facts['mounts'].append({
-                    'device': entry.device,
-                    'mount_point': entry.mount_point,
-                    'vfs_type': entry.vfs_type
+    def _facts_subscribed(self, group):
+        for subscription in self._facts_subscriptions.values():
+            if group in subscription['groups']:
+                return True
+        return False
+
+    def _facts_changed(self, group):
+        self.facts.invalidate(group)
+        if self._facts_subscribed(group):
+            self.call_in_worker(lambda: self.facts.refresh([group]),
+                                self._send_fact_changes)
+
+    def _send_fact_changes(self, changed):
+        for subscription in list(self._facts_subscriptions.values()):
+            wanted = {group: value for group, value in changed.items()
+                      if group in subscription['groups']}
+            if wanted:
+                self.send_packet({
+                    'command': 'facts-changed',
+                    'changed': wanted,
+                    'stream': subscription['stream'].id,
+                    'unique': subscription['stream'].unique
                 })
 
-        for kind, path in [('rsa', '/etc/ssh/ssh_host_rsa_key.pub'),
-                           ('ecdsa',  '/etc/ssh/ssh_host_ecdsa_key.pub'),
-                           ('ed25519', '/etc/ssh/ssh_host_ed25519_key.pub')]:
-            if os.path.exists(path):
-                with open(path) as f:
-                    facts['ssh-host-keys'][kind] = f.read()
+    def _schedule_fact_expiry(self, groups):
+        # Groups we cannot watch are checked for subscribers when they expire
+        for group in groups:
+            ttl = self.facts.ttls[group]
+            if ttl is None or group in self._facts_timers:
+                continue
+            self._facts_timers.add(group)
+            self.add_timer(ttl, lambda group=group: self._fact_expired(group))
+
+    def _fact_expired(self, group):
+        self._facts_timers.discard(group)
+        if self._facts_subscribed(group):
+            self._facts_changed(group)
+            self._schedule_fact_expiry([group])
+
+    def subscribe_metrics(self, packet):
+        # Sample the requested metrics every interval seconds, sending them
+        # in batches of samples until the host cancels the stream. Each batch
+        # reports the CPU time we spent taking its samples.
+        unique = packet.get('unique', str(time.time()))
+        names = packet.get('metrics') or list(metrics.SAMPLERS)
+        interval = packet.get('interval', METRICS_INTERVAL)
+        unknown = [m for m in names if m not in metrics.SAMPLERS]
+
+        error = None
+        if unknown:
+            error = 'unknown metrics: %s' % ', '.join(unknown)
+        elif interval < metrics.MIN_INTERVAL:
+            error = ('interval must be at least %s seconds'
+                     % metrics.MIN_INTERVAL)
+        if error:
+            self.send_packet({
+                'command': 'subscribe-metrics-response',
+                'result': False,
+                'message': error,
+                'unique': unique
+            })
+            return
 
+        subscription = {
+            'sampler': metrics.MetricsSampler(names),
+            'interval': interval,
+            'batch': max(1, packet.get('batch', 1)),
+            'samples': [],
+            'cost': 0.0,
+            'stream': self.open_stream('subscribe-metrics', unique)
+        }
+        # The first sample only gives us counters to compute rates from
+        self._sample_metrics(subscription)
         self.send_packet({
-            'command': 'gather-facts-response',
-            'result': facts,
-            'unique': packet.get('unique', str(time.time()))
+            'command': 'subscribe-metrics-response',
+            'result': True,
+            'metrics': names,
+            'interval': interval,
+            'batch': subscription['batch'],
+            'stream': subscription['stream'].id,
+            'unique': unique
         })
+        self.add_timer(interval, lambda: self._metrics_due(subscription))
+
+    def _sample_metrics(self, subscription):
+        started = time.thread_time()
+        sample = subscription['sampler'].sample()
+        subscription['cost'] += time.thread_time() - started
+        return sample
+
+    def _metrics_due(self, subscription):
+        stream = subscription['stream']
+        if stream.cancelled:
+            return
+
+        subscription['samples'].append(self._sample_metrics(subscription))
+        if len(subscription['samples']) >= subscription['batch']:
+            self.send_packet({
+                'command': 'metrics',
+                'samples': subscription['samples'],
+                'sample-cost': round(subscription['cost'], 6),
+                'stream': stream.id,
+                'unique': stream.unique
+            })
+            subscription['samples'] = []
+            subscription['cost'] = 0.0
+        self.add_timer(subscription['interval'],
+                       lambda: self._metrics_due(subscription))
+
+    def profile(self, packet):
+        # Profile the agent for a while, and then reply with the functions
+        # it spent the most time in. Both profilers watch the loop thread,
+        # but the sampling profiler may also be asked to watch the worker
+        # threads with 'all-threads'. If a path is given the whole profile is
+        # also written there, for the host to get-file.
+        from shakenfist_agent import profiling
+
+        unique = packet.get('unique', str(time.time()))
+        name = packet.get('profiler', 'sampling')
+        duration = packet.get('duration', PROFILE_DURATION)
+        sort = packet.get('sort', 'cumulative')
+
+        error = None
+        if name not in profiling.PROFILERS:
+            error = 'unknown profiler %s' % name
+        elif sort not in profiling.SORT_KEYS:
+            error = 'unknown sort key %s' % sort
+        elif not 0 < duration <= MAX_PROFILE_DURATION:
+            error = ('duration must be more than zero and at most %d '
+                     'seconds' % MAX_PROFILE_DURATION)
+        if not error:
+            if name == 'sampling':
+                threads = None
+                if not packet.get('all-threads', False):
+                    threads = [threading.get_ident()]
+                profiler = profiling.SamplingProfiler(
+                    packet.get('interval', profiling.SAMPLE_INTERVAL),
+                    threads=threads)
+            else:
+                profiler = profiling.CProfiler()
+            try:
+                profiler.start()
+            except profiling.ProfilerBusy as e:
+                error = str(e)
+        if error:
+            self.send_packet({
+                'command': 'profile-response',
+                'result': False,
+                'message': error,
+                'unique': unique
+            })
+            return
+
+        profile = {
+            'profiler': profiler,
+            'name': name,
+            'sort': sort,
+            'limit': packet.get('limit', PROFILE_LIMIT),
+            'path': packet.get('path'),
+            'started': time.monotonic()
+        }
+        profile['stream'] = self.open_stream(
+            'profile', unique, on_cancel=profiler.stop)
+        self.add_timer(duration, lambda: self._profile_finished(profile))
+
+    def _profile_finished(self, profile):
+        stream = profile['stream']
+        if stream.cancelled:
+            return
+        self.close_stream(stream)
+
+        profiler = profile['profiler']
+        profiler.stop()
+        response = {
+            'command': 'profile-response',
+            'result': True,
+            'profiler': profile['name'],
+            'duration': time.monotonic() - profile['started'],
+            'functions': profiler.top(profile['limit'], profile['sort']),
+            'stream': stream.id,
+            'unique': stream.unique
+        }
+        if profile['path']:
+            try:
+                profiler.dump(profile['path'])
+                response['path'] = profile['path']
+            except OSError as e:
+                response['result'] = False
+                response['message'] = 'failed to write profile: %s' % e
+        self.send_packet(response)
 
     def put_file(self, packet):
+        # Partial puts are tracked per request, so that two puts to the same
+        # path do not share state.
         path = packet['path']
-        if path not in self.incomplete_file_puts:
-            self.incomplete_file_puts[path] = {}
-            self.incomplete_file_puts[path]['flo'] = open(path, 'wb')
+        key = (path, packet.get('unique'))
+        unique = packet.get('unique', str(time.time()))
+        put = self.incomplete_file_puts.get(key)
+
+        if 'stat_result' in packet or not put:
+            # A put starts from scratch unless the host is resuming it from
+            # an offset, in which case we keep what we already have.
+            offset = packet.get('offset', 0)
+            if packet.get('digest'):
+                protocol.new_digest(packet['digest'])
+            flags = os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC
+            if not offset:
+                flags |= os.O_TRUNC
+            if put:
+                self._abandon_put(put)
+            put = {
+                'path': path,
+                'key': key,
+                'fd': os.open(path, flags, 0o666),
+                'offset': offset,
+                'digest': packet.get('digest'),
+                'file-digest': None
+            }
+            put['stream'] = self.open_stream(
+                'put-file', unique, on_cancel=lambda: self._abandon_put(put))
+            self.incomplete_file_puts[key] = put
+
+            # The digest is kept up to date as chunks arrive. A resumed put
+            # would first need to hash what we already have, which may take
+            # a while, so it is left to be done on a worker at the end.
+            if put['digest'] and not offset:
+                put['file-digest'] = protocol.new_digest(put['digest'])
 
         if 'stat_result' in packet:
-            self.incomplete_file_puts[path].update(packet['stat_result'])
+            put.update(packet['stat_result'])
+            if packet.get('encoding') == 'binary':
+                put['binary-stream'] = packet['stream']
+                self.register_binary_stream(
+                    packet['stream'],
+                    lambda p: self._put_file_chunk(
+                        put, p['offset'], p['chunk'], None, unique))
+            return
+
+        if 'hole' in packet:
+            self._put_file_hole(put, packet['offset'], packet['hole'])
             return
 
         if packet['chunk'] is None:
-            self.incomplete_file_puts[path]['flo'].close()
-            del self.incomplete_file_puts[path]
-            self.log.with_fields(packet).info('File put complete')
-            self.send_packet({
+            self._abandon_put(put)
+            response = {
                 'command': 'put-file-response',
+                'result': True,
                 'path': packet['path'],
-                'unique': packet['unique']
+                'offset': put['offset'],
+                'unique': unique
+            }
+
+            expected = packet.get('file-digest')
+            if not put['digest']:
+                self._put_file_complete(response, None, None)
+            elif put['file-digest']:
+                self._put_file_complete(response, put['file-digest'], expected)
+            else:
+                # The put was resumed or chunks arrived out of order, so we
+                # hash the whole file, away from the loop thread.
+                def _digest_file():
+                    try:
+                        with open(path, 'rb') as f:
+                            return protocol.digest_file(f, put['digest']), None
+                    except OSError as e:
+                        return None, 'cannot digest file: %s' % e
+
+                self.call_in_worker(
+                    _digest_file,
+                    lambda result: self._put_file_complete(
+                        response, result[0], expected, error=result[1]))
+            return
+
+        self._put_file_chunk(
+            put, packet.get('offset'), base64.b64decode(packet['chunk']),
+            packet.get('chunk-digest'), unique)
+
+    def _put_file_complete(self, response, file_digest, expected, error=None):
+        if error:
+            response['result'] = False
+            response['message'] = error
+        elif file_digest:
+            response['file-digest'] = file_digest.hexdigest()
+            if expected and expected != response['file-digest']:
+                response['result'] = False
+                response['message'] = 'file digest does not match'
+
+        if self.log:
+            self.log.with_fields(response).info('File put complete')
+        self.send_packet(response)
+
+    def _put_file_chunk(self, put, offset, d, chunk_digest, unique):
+        if offset is None:
+            offset = put['offset']
+
+        if chunk_digest and put['digest']:
+            if hashlib.new(put['digest'], d).hexdigest() != chunk_digest:
+                # Tell the host where to resume from
+                self.send_packet({
+                    'command': 'put-file-response',
+                    'result': False,
+                    'path': put['path'],
+                    'message': 'chunk digest does not match',
+                    'offset': offset,
+                    'unique': unique
+                })
+                return
+
+        os.pwrite(put['fd'], d, offset)
+        if put['file-digest']:
+            if offset == put['offset']:
+                put['file-digest'].update(d)
+            else:
+                put['file-digest'] = None
+        put['offset'] = offset + len(d)
+
+    def _put_file_hole(self, put, offset, length):
+        # Extending the file leaves a hole. Only the part of the range which
+        # overlaps data already in the file, for example from an earlier
+        # attempt at this put, needs zeros written.
+        end = offset + length
+        size = os.fstat(put['fd']).st_size
+        if size < end:
+            os.ftruncate(put['fd'], end)
+        zero_offset = offset
+        while zero_offset < min(size, end):
+            count = min(min(size, end) - zero_offset, HOLE_WRITE_SIZE)
+            os.pwrite(put['fd'], bytes(count), zero_offset)
+            zero_offset += count
+
+        if put['file-digest']:
+            if offset == put['offset']:
+                protocol.digest_zeros(put['file-digest'], length)
+            else:
+                put['file-digest'] = None
+        put['offset'] = end
+
+    def _abandon_put(self, put):
+        if 'binary-stream' in put:
+            self.unregister_binary_stream(put['binary-stream'])
+        self.close_stream(put['stream'])
+        os.close(put['fd'])
+        self.incomplete_file_puts.pop(put['key'], None)
+
+    def verify_file(self, packet):
+        # Report how much of a (possibly partial) file is present. The host
+        # may send the digests of each block of its copy, in which case we
+        # report how far they match. Otherwise we send our own block digests.
+        unique = packet.get('unique', str(time.time()))
+        path = packet.get('path')
+        if self._path_is_a_file('verify-file', path, unique):
+            return
+
+        algorithm = packet.get('digest', protocol.DIGEST_ALGORITHMS[0])
+        block_size = packet.get('block-size', VERIFY_BLOCK_SIZE)
+        expected = packet.get('block-digests')
+
+        digests = []
+        verified = 0
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            for start in range(0, size, block_size):
+                end = min(start + block_size, size)
+                digest = protocol.digest_file(
+                    f, algorithm, start=start, end=end).hexdigest()
+                if expected is not None:
+                    if (len(expected) <= len(digests) or
+                            expected[len(digests)] != digest):
+                        break
+                    verified = end
+                digests.append(digest)
+
+        response = {
+            'command': 'verify-file-response',
+            'result': True,
+            'path': path,
+            'size': size,
+            'digest': algorithm,
+            'block-size': block_size,
+            'unique': unique
+        }
+        if expected is not None:
+            response['verified-offset'] = verified
+        else:
+            response['block-digests'] = digests
+        self.send_packet(response)
+
+    def sync_file(self, packet):
+        # The first half of a delta sync: send the host signatures of the
+        # blocks of our copy of the file, so that it can work out which parts
+        # it needs to send us. A missing file has no signatures. Signatures
+        # for a large file are sent over several packets, each saying which
+        # block its signatures start at, and the last marked complete.
+        unique = packet.get('unique', str(time.time()))
+        path = packet.get('path')
+        block_size = packet.get('block-size')
+
+        def _response(first_block, sigs, complete):
+            return {
+                'command': 'sync-file-response',
+                'result': True,
+                'path': path,
+                'size': size,
+                'block-size': block_size,
+                'first-block': first_block,
+                'signatures': sigs,
+                'complete': complete,
+                'unique': unique
+            }
+
+        size = 0
+        if not os.path.isfile(path):
+            block_size = block_size or delta.BLOCK_SIZE
+            self.send_packet(_response(0, [], True))
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            block_size = block_size or delta.block_size_for(size)
+            first_block = 0
+            sigs = []
+            for sig in delta.iter_signatures(f, block_size=block_size):
+                if len(sigs) == SIGNATURES_PER_PACKET:
+                    self.send_packet(_response(first_block, sigs, False))
+                    first_block += len(sigs)
+                    sigs = []
+                sigs.append(sig)
+        self.send_packet(_response(first_block, sigs, True))
+
+    def sync_file_delta(self, packet):
+        # The second half of a delta sync: a series of packets of operations
+        # from delta.compute_delta(). The new file is built in a temporary
+        # file alongside the old one and renamed into place when complete.
+        unique = packet.get('unique', str(time.time()))
+        path = packet['path']
+        sync = self.incomplete_file_syncs.get(unique)
+        try:
+            if not sync:
+                sync = self._start_file_sync(path, unique, packet)
+            sync['offset'] = delta.apply_delta(
+                sync['basis-fd'], sync['fd'], packet.get('ops', []),
+                sync['offset'], block_size=sync['block-size'])
+
+            if not packet.get('complete', False):
+                return
+            response = self._finish_file_sync(sync, packet)
+
+        except Exception as e:
+            if sync:
+                self._cancel_file_sync(sync)
+            response = {
+                'command': 'sync-file-delta-response',
+                'result': False,
+                'path': path,
+                'message': 'sync failed: %s' % e,
+                'unique': unique
+            }
+
+        self.send_packet(response)
+
+    def _start_file_sync(self, path, unique, packet):
+        directory, name = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory or '.',
+                                         prefix='.%s.' % name)
+        sync = {
+            'path': path,
+            'unique': unique,
+            'fd': fd,
+            'temp-path': temp_path,
+            'basis-fd': None,
+            'block-size': packet.get('block-size'),
+            'offset': 0
+        }
+        sync['stream'] = self.open_stream(
+            'sync-file-delta', unique,
+            on_cancel=lambda: self._cancel_file_sync(sync))
+        basis_size = 0
+        if os.path.isfile(path):
+            sync['basis-fd'] = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            basis_size = os.fstat(sync['basis-fd']).st_size
+        if not sync['block-size']:
+            # The same default sync-file used for the signatures
+            sync['block-size'] = delta.block_size_for(basis_size)
+        self.incomplete_file_syncs[unique] = sync
+        return sync
+
+    def _abandon_file_sync(self, sync):
+        # This may be called more than once for a sync, so each fd is only
+        # closed the first time. Closing it again could close an fd another
+        # thread has since been given.
+        self.close_stream(sync['stream'])
+        for key in ('fd', 'basis-fd'):
+            if sync[key] is not None:
+                os.close(sync[key])
+                sync[key] = None
+        self.incomplete_file_syncs.pop(sync['unique'], None)
+
+    def _cancel_file_sync(self, sync):
+        self._abandon_file_sync(sync)
+        try:
+            os.unlink(sync['temp-path'])
+        except FileNotFoundError:
+            pass
+
+    def _finish_file_sync(self, sync, packet):
+        os.ftruncate(sync['fd'], sync['offset'])
+
+        response = {
+            'command': 'sync-file-delta-response',
+            'result': True,
+            'path': sync['path'],
+            'size': sync['offset'],
+            'unique': sync['unique']
+        }
+        if packet.get('digest'):
+            with open(sync['temp-path'], 'rb') as f:
+                response['file-digest'] = protocol.digest_file(
+                    f, packet['digest']).hexdigest()
+            expected = packet.get('file-digest')
+            if expected and expected != response['file-digest']:
+                raise ValueError('file digest does not match')
+
+        # Keep the ownership and permissions of the file we are replacing.
+        # Ownership is set first, as changing it can clear setuid bits.
+        if sync['basis-fd'] is not None:
+            st = os.fstat(sync['basis-fd'])
+            ours = os.fstat(sync['fd'])
+            if (st.st_uid, st.st_gid) != (ours.st_uid, ours.st_gid):
+                os.fchown(sync['fd'], st.st_uid, st.st_gid)
+            os.fchmod(sync['fd'], st.st_mode & 0o7777)
+        elif 'mode' in packet:
+            os.fchmod(sync['fd'], packet['mode'] & 0o7777)
+        else:
+            os.fchmod(sync['fd'], DEFAULT_SYNC_MODE)
+
+        os.fsync(sync['fd'])
+        self._abandon_file_sync(sync)
+        os.rename(sync['temp-path'], sync['path'])
+        if self.log:
+            self.log.with_fields(response).info('File sync complete')
+        return response
+
+    def get_tree(self, packet):
+        # Send a directory as a tar archive. The archive is written by a
+        # thread into a pipe, which we read from like the output of a
+        # streaming execute, so that flow control pauses the thread.
+        unique = packet.get('unique', str(time.time()))
+        path = packet.get('path')
+        encoding = packet.get('encoding', 'base64')
+        response = {
+            'command': 'get-tree-response',
+            'result': True,
+            'path': path,
+            'encoding': encoding,
+            'unique': unique
+        }
+        if not path or not os.path.isdir(path):
+            response['result'] = False
+            response['message'] = 'path is not a directory'
+            self.send_packet(response)
+            return
+
+        transfer = {
+            'path': path,
+            'unique': unique,
+            'encoding': encoding,
+            'stream': self.open_stream('get-tree', unique),
+            'include': packet.get('include'),
+            'exclude': packet.get('exclude'),
+            'entries': 0,
+            'errors': [],
+            'failure': None
+        }
+        response['stream'] = transfer['stream'].id
+        self.send_packet(response)
+
+        r, w = os.pipe()
+        self.set_fd_nonblocking(r)
+        producer = protocol.Producer(None, unique=unique,
+                                     window=packet.get('window'))
+        self.register_throttled_reader(
+            r, lambda fd, mask: self._tree_archive_ready(
+                transfer, fd, producer),
+            producer=producer)
+        # Closing the pipe stops the thread writing the archive
+        transfer['stream'].on_cancel = lambda: self._close_tree_archive(r)
+        threading.Thread(target=self._write_tree_archive, args=(transfer, w),
+                         daemon=True).start()
+
+    def _write_tree_archive(self, transfer, fd):
+        f = os.fdopen(fd, 'wb')
+        try:
+            with tarfile.open(fileobj=f, mode='w|',
+                              format=tarfile.PAX_FORMAT) as tar:
+                for path, name in _tree_entries(
+                        transfer['path'], transfer['include'],
+                        transfer['exclude']):
+                    try:
+                        tar.add(path, arcname=name, recursive=False)
+                        transfer['entries'] += 1
+                    except OSError as e:
+                        # Files we cannot read are skipped, as they fail
+                        # before anything is written to the archive
+                        transfer['errors'].append(
+                            {'path': name, 'message': str(e)})
+        except Exception as e:
+            transfer['failure'] = str(e)
+        finally:
+            # The reader only sees the end of the archive once we are done
+            # updating transfer
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def _tree_archive_ready(self, transfer, fd, producer):
+        try:
+            d = os.read(fd, TREE_READ_SIZE)
+        except BlockingIOError:
+            return
+
+        if d:
+            if transfer['encoding'] == 'binary':
+                self.send_binary(transfer['stream'].id, producer.sent, d)
+            else:
+                self.send_packet({
+                    'command': 'get-tree-response',
+                    'result': True,
+                    'path': transfer['path'],
+                    'offset': producer.sent,
+                    'encoding': 'base64',
+                    'chunk': base64.b64encode(d).decode('utf-8'),
+                    'unique': transfer['unique']
+                })
+            producer.sent += len(d)
+            return
+
+        self._close_tree_archive(fd)
+        self.close_stream(transfer['stream'])
+        response = {
+            'command': 'get-tree-response',
+            'result': transfer['failure'] is None,
+            'path': transfer['path'],
+            'encoding': transfer['encoding'],
+            'chunk': None,
+            'offset': producer.sent,
+            'entries': transfer['entries'],
+            'errors': transfer['errors'],
+            'stream': transfer['stream'].id,
+            'unique': transfer['unique']
+        }
+        if transfer['failure']:
+            response['message'] = 'archive failed: %s' % transfer['failure']
+        if self.log:
+            self.log.with_fields(response).info('Tree get complete')
+        self.send_packet(response)
+
+    def _close_tree_archive(self, fd):
+        self.unregister_throttled_reader(fd)
+        os.close(fd)
+
+    def put_tree(self, packet):
+        # Receive a tar archive of a directory, sent like put-file without a
+        # stat_result. The archive is spooled to disk and, once complete,
+        # extracted alongside the destination and renamed into place. The
+        # extraction runs on a worker thread.
+        unique = packet.get('unique', str(time.time()))
+        transfer = self.incomplete_tree_puts.get(unique)
+
+        if 'chunk' not in packet:
+            if transfer:
+                self._cancel_tree_put(transfer)
+            path = packet['path']
+            transfer = {
+                'path': path,
+                'unique': unique,
+                'spool': tempfile.TemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(path))),
+                'binary-stream': packet.get('stream'),
+                'include': packet.get('include'),
+                'exclude': packet.get('exclude')
+            }
+            transfer['stream'] = self.open_stream(
+                'put-tree', unique,
+                on_cancel=lambda: self._cancel_tree_put(transfer))
+            self.incomplete_tree_puts[unique] = transfer
+            if packet.get('encoding') == 'binary':
+                self.register_binary_stream(
+                    packet['stream'],
+                    lambda p: os.pwrite(transfer['spool'].fileno(),
+                                        p['chunk'], p['offset']))
+            return
+
+        if not transfer:
+            self.send_packet({
+                'command': 'put-tree-response',
+                'result': False,
+                'path': packet.get('path'),
+                'message': 'no put-tree in progress',
+                'unique': unique
             })
             return
 
-        d = base64.b64decode(packet['chunk'])
-        self.incomplete_file_puts[path]['flo'].write(d)
+        if packet['chunk'] is not None:
+            os.pwrite(transfer['spool'].fileno(),
+                      base64.b64decode(packet['chunk']), packet['offset'])
+            return
+
+        self._abandon_tree_put(transfer)
+
+        def _extract():
+            try:
+                return self._extract_tree(transfer), None
+            except Exception as e:
+                return None, 'extracting tree failed: %s' % e
+            finally:
+                transfer['spool'].close()
+
+        self.call_in_worker(
+            _extract,
+            lambda result: self._put_tree_complete(transfer, *result))
+
+    def _put_tree_complete(self, transfer, entries, error):
+        response = {
+            'command': 'put-tree-response',
+            'result': error is None,
+            'path': transfer['path'],
+            'unique': transfer['unique']
+        }
+        if error:
+            response['message'] = error
+        else:
+            response['entries'] = entries
+
+        if self.log:
+            self.log.with_fields(response).info('Tree put complete')
+        self.send_packet(response)
+
+    def _abandon_tree_put(self, transfer):
+        if transfer['binary-stream']:
+            self.unregister_binary_stream(transfer['binary-stream'])
+        self.close_stream(transfer['stream'])
+        self.incomplete_tree_puts.pop(transfer['unique'], None)
+
+    def _cancel_tree_put(self, transfer):
+        self._abandon_tree_put(transfer)
+        transfer['spool'].close()
+
+    def _extract_tree(self, transfer):
+        path = os.path.abspath(transfer['path'])
+        if os.path.lexists(path) and not os.path.isdir(path):
+            raise ValueError('path exists and is not a directory')
+
+        directory, name = os.path.split(path)
+        temp_path = tempfile.mkdtemp(dir=directory, prefix='.%s.' % name)
+        try:
+            transfer['spool'].seek(0)
+            with tarfile.open(fileobj=transfer['spool'], mode='r:') as tar:
+                members = [
+                    m for m in tar.getmembers()
+                    if _tree_path_selected(m.name, m.isdir(),
+                                           transfer['include'],
+                                           transfer['exclude'])]
+                kwargs = {}
+                if hasattr(tarfile, 'tar_filter'):
+                    kwargs['filter'] = _tree_extract_filter
+                tar.extractall(temp_path, members=members, **kwargs)
+        except Exception:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+        # The new tree only appears once it is complete. An existing tree is
+        # first moved aside, as a directory cannot be renamed over another
+        # which has contents.
+        if os.path.isdir(path):
+            old_path = tempfile.mkdtemp(dir=directory, prefix='.%s.' % name)
+            os.rename(path, old_path)
+            os.rename(temp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.rename(temp_path, path)
+        return len(members)
 
     def chmod(self, packet):
         symbolicmode.chmod(packet['path'], packet['mode'])
@@ -148,50 +1045,370 @@ class SFFileAgent(protocol.FileAgent):
         error = self._path_is_a_file('get-file', path, unique)
         if error:
             return
-        self._send_file('get-file-response', path, path, unique)
+        self._send_file('get-file-response', path, path, unique,
+                        encoding=packet.get('encoding', 'base64'),
+                        window=packet.get('window'),
+                        offset=packet.get('offset', 0),
+                        digest=packet.get('digest'),
+                        sparse=packet.get('sparse', False))
 
     def watch_file(self, packet):
         unique = packet.get('unique', str(time.time()))
         path = packet.get('path')
-        if not self._path_is_a_file('watch-file', path, unique):
+        if self._path_is_a_file('watch-file', path, unique):
             return
 
-        flo = open(path, 'rb')
-        self.set_fd_nonblocking(flo.fileno())
+        error = None
+        if path in self.watched_files:
+            error = 'path is already watched'
+        else:
+            try:
+                self._get_inotify()
+            except OSError as e:
+                error = 'cannot watch files: %s' % e
+        if error:
+            self.send_packet({
+                'command': 'watch-file-response',
+                'result': False,
+                'path': path,
+                'message': error,
+                'unique': unique
+            })
+            return
 
-        self.watched_files[flo.fileno()] = {
+        watch = {
             'path': path,
-            'flo': flo
+            'unique': unique,
+            'encoding': packet.get('encoding', 'base64'),
+            'stream': self.open_stream('watch-file', unique),
+            'fd': None,
+            'wd': None,
+            'offset': 0,
+            'reading': False,
+            'rotated': False,
+            'stopped': False,
+            'producer': None
         }
+        watch['stream'].on_cancel = lambda: self._stop_watch(watch)
+        self._open_watched_file(watch)
+        if not packet.get('from-start', False):
+            watch['offset'] = os.fstat(watch['fd']).st_size
+        # Every read of the file uses this producer, so the window and what
+        # the host has acknowledged carry over from one read to the next.
+        watch['producer'] = protocol.Producer(
+            None, unique=unique, window=packet.get('window'),
+            offset=watch['offset'])
+        self.watched_files[path] = watch
 
-    def watch_files(self):
-        readable = []
-        for f in self.watched_files:
-            readable.append(f['flo'])
-        readable, _, exceptional = select.select(readable, [], readable, 0)
+        response = {
+            'command': 'watch-file-response',
+            'result': True,
+            'path': path,
+            'offset': watch['offset'],
+            'encoding': watch['encoding'],
+            'unique': unique
+        }
+        response['stream'] = watch['stream'].id
+        self.send_packet(response)
+        self._read_watched_file(watch)
 
-        for fd in exceptional:
-            if fd in self.watched_files:
-                self.send_packet({
-                    'command': 'watch-file-response',
-                    'result': True,
-                    'path': self.watched_files[fd]['path'],
-                    'chunk': None
-                })
-                del self.watched_files[fd]
+    def unwatch_file(self, packet):
+        unique = packet.get('unique', str(time.time()))
+        path = packet.get('path')
+        watch = self.watched_files.get(path)
+        if not watch:
+            self.send_packet({
+                'command': 'unwatch-file-response',
+                'result': False,
+                'path': path,
+                'message': 'path is not watched',
+                'unique': unique
+            })
+            return
+
+        self._stop_watch(watch)
+        self.send_packet({
+            'command': 'unwatch-file-response',
+            'result': True,
+            'path': path,
+            'unique': unique
+        })
+
+    def _get_inotify(self):
+        if not self.inotify:
+            self.inotify = inotify.Inotify()
+            self.register_fd(self.inotify.fileno(), self._inotify_ready)
+        return self.inotify
+
+    def _restart_watch_offset(self, watch):
+        # Offsets in a new or truncated file start again from zero, and so
+        # do the acknowledgements we expect from the host.
+        watch['offset'] = 0
+        if watch['producer']:
+            watch['producer'].sent = 0
+            watch['producer'].acknowledged = 0
+
+    def _open_watched_file(self, watch):
+        watch['fd'] = os.open(watch['path'], os.O_RDONLY | os.O_CLOEXEC)
+        self._restart_watch_offset(watch)
+        watch['rotated'] = False
+        watch['wd'] = self.inotify.add_watch(
+            watch['path'],
+            inotify.IN_MODIFY | inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF)
+        self._watch_descriptors[watch['wd']] = watch
+
+    def _forget_file_watch(self, watch):
+        if self._watch_descriptors.get(watch['wd']) is watch:
+            del self._watch_descriptors[watch['wd']]
+            self.inotify.rm_watch(watch['wd'])
+        watch['wd'] = None
+
+    def _wait_for_watched_file(self, watch):
+        # The file has been rotated away and not replaced yet, so watch its
+        # directory for it to reappear.
+        directory, name = os.path.split(watch['path'])
+        wd = self.inotify.add_watch(
+            directory or '.',
+            inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        self._directory_watches.setdefault(wd, {})[name] = watch
+        watch['directory-wd'] = wd
+
+    def _forget_directory_watch(self, watch):
+        wd = watch.pop('directory-wd', None)
+        if wd is None:
+            return
+        waiting = self._directory_watches.get(wd, {})
+        waiting.pop(os.path.basename(watch['path']), None)
+        if not waiting:
+            self._directory_watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def _stop_watch(self, watch):
+        watch['stopped'] = True
+        self.close_stream(watch['stream'])
+        self._forget_file_watch(watch)
+        self._forget_directory_watch(watch)
+        if watch['fd'] is not None:
+            os.close(watch['fd'])
+            watch['fd'] = None
+        self.watched_files.pop(watch['path'], None)
+        self.send_packet({
+            'command': 'watch-file-response',
+            'result': True,
+            'path': watch['path'],
+            'offset': watch['offset'],
+            'chunk': None,
+            'unique': watch['unique']
+        })
 
-        for fd in readable:
-            if fd in self.watched_files:
+    def _inotify_ready(self, fd, mask):
+        for wd, event_mask, _, name in self.inotify.read_events():
+            if event_mask & inotify.IN_Q_OVERFLOW:
+                # We lost events, so check everything
+                for watch in list(self.watched_files.values()):
+                    self._read_watched_file(watch)
+                continue
+
+            if wd in self._directory_watches:
+                watch = self._directory_watches[wd].get(name)
+                if watch and event_mask & (inotify.IN_CREATE |
+                                           inotify.IN_MOVED_TO):
+                    self._forget_directory_watch(watch)
+                    try:
+                        self._open_watched_file(watch)
+                    except FileNotFoundError:
+                        self._wait_for_watched_file(watch)
+                        continue
+                    self._send_watch_event(watch, 'reopened')
+                    self._read_watched_file(watch)
+                continue
+
+            watch = self._watch_descriptors.get(wd)
+            if not watch:
+                continue
+
+            if event_mask & (inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF |
+                             inotify.IN_IGNORED):
+                # Log rotation. Finish reading the old file, and then reopen
+                # the path.
+                self._forget_file_watch(watch)
+                watch['rotated'] = True
+            self._read_watched_file(watch)
+
+    def _send_watch_event(self, watch, event):
+        self.send_packet({
+            'command': 'watch-file-response',
+            'result': True,
+            'path': watch['path'],
+            'event': event,
+            'offset': watch['offset'],
+            'unique': watch['unique']
+        })
+
+    def _windowed_producers(self):
+        return super(SFFileAgent, self)._windowed_producers() + [
+            watch['producer'] for watch in self.watched_files.values()]
+
+    def _read_watched_file(self, watch):
+        if watch['reading'] or watch['stopped']:
+            return
+        watch['reading'] = True
+        watch['producer'].generator = self._watched_file_chunks(watch)
+        self.start_producer(watch['producer'])
+
+    def _watched_file_chunks(self, watch):
+        try:
+            while not watch['stopped']:
+                if os.fstat(watch['fd']).st_size < watch['offset']:
+                    self._restart_watch_offset(watch)
+                    self._send_watch_event(watch, 'truncated')
+
+                d = os.pread(watch['fd'], WATCH_READ_SIZE, watch['offset'])
+                if d:
+                    if watch['encoding'] == 'binary':
+                        self.send_binary(watch['stream'].id, watch['offset'],
+                                         d)
+                    else:
+                        self.send_packet({
+                            'command': 'watch-file-response',
+                            'result': True,
+                            'path': watch['path'],
+                            'offset': watch['offset'],
+                            'encoding': 'base64',
+                            'chunk': base64.b64encode(d).decode('utf-8'),
+                            'unique': watch['unique']
+                        })
+                    watch['offset'] += len(d)
+                    yield len(d)
+                    continue
+
+                if not watch['rotated']:
+                    return
+
+                os.close(watch['fd'])
+                watch['fd'] = None
                 try:
-                    self.send_packet({
-                        'command': 'watch-file-response',
-                        'result': True,
-                        'path': self.watched_files[fd]['path'],
-                        'chunk': base64.base64encode(
-                            self.watched_files[fd]['flo'].read(1024)).decode('utf-8')
-                    })
-                except BlockingIOError:
-                    pass
+                    self._open_watched_file(watch)
+                except FileNotFoundError:
+                    self._wait_for_watched_file(watch)
+                    return
+                self._send_watch_event(watch, 'reopened')
+        finally:
+            watch['reading'] = False
+
+    def batch(self, packet):
+        # Run a list of operations in order on a worker thread, replying once
+        # with the result of each. Unless stop-on-error is false, we stop at
+        # the first operation which fails. The stream is opened and closed
+        # here on the loop thread, only the operations run on the worker.
+        unique = packet.get('unique', str(time.time()))
+        stream = self.open_stream('batch', unique)
+        started = time.monotonic()
+        self.call_in_worker(
+            lambda: self._run_batch(packet, stream),
+            lambda result: self._batch_complete(
+                unique, stream, started, *result))
+
+    def _run_batch(self, packet, stream):
+        # Returns the results, and an error if the batch itself was bad
+        stop_on_error = packet.get('stop-on-error', True)
+        results = []
+        try:
+            operations = list(packet.get('operations', []))
+        except TypeError as e:
+            return results, 'bad operations: %s' % e
+
+        for op in operations:
+            if not isinstance(op, dict):
+                return results, 'operations must be objects'
+            if stream.cancelled:
+                break
+            result = {'op': op.get('op'), 'result': True}
+            op_started = time.monotonic()
+            try:
+                meth = self._batch_operations.get(op.get('op'))
+                if not meth:
+                    raise ValueError('unknown operation %s' % op.get('op'))
+                result.update(meth(op) or {})
+            except Exception as e:
+                result['result'] = False
+                result['message'] = str(e)
+            result['elapsed'] = time.monotonic() - op_started
+            results.append(result)
+            if not result['result'] and stop_on_error:
+                break
+        return results, None
+
+    def _batch_complete(self, unique, stream, started, results, error):
+        self.close_stream(stream)
+        response = {
+            'command': 'batch-response',
+            'result': all(r['result'] for r in results),
+            'results': results,
+            'completed': len(results),
+            'elapsed': time.monotonic() - started,
+            'unique': unique
+        }
+        if error:
+            response['result'] = False
+            response['message'] = error
+        elif stream.cancelled:
+            response['result'] = False
+            response['message'] = 'batch cancelled'
+        self.send_packet(response)
+
+    def _batch_write(self, op):
+        fd = os.open(op['path'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     os.O_CLOEXEC, 0o666)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(op.get('data', '')))
+            if 'mode' in op:
+                os.fchmod(fd, op['mode'] & 0o7777)
+
+    def _batch_chmod(self, op):
+        symbolicmode.chmod(op['path'], op['mode'])
+
+    def _batch_chown(self, op):
+        shutil.chown(op['path'], user=op.get('user'), group=op.get('group'))
+
+    def _batch_mkdir(self, op):
+        mode = op.get('mode', 0o777)
+        if op.get('parents', False):
+            os.makedirs(op['path'], mode=mode, exist_ok=True)
+        else:
+            os.mkdir(op['path'], mode=mode)
+
+    def _batch_symlink(self, op):
+        os.symlink(op['target'], op['path'])
+
+    def _batch_unlink(self, op):
+        path = op['path']
+        if not os.path.lexists(path) and op.get('missing-ok', False):
+            return
+        if (op.get('recursive', False) and os.path.isdir(path) and
+                not os.path.islink(path)):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    def _batch_rename(self, op):
+        os.rename(op['source'], op['destination'])
+
+    def _batch_stat(self, op):
+        st = os.stat(op['path'],
+                     follow_symlinks=op.get('follow-symlinks', True))
+        return {'stat_result': protocol.stat_result(st)}
+
+    def _batch_execute(self, op):
+        from oslo_concurrency import processutils
+
+        try:
+            out, err = processutils.execute(
+                op['command-line'], shell=True, check_exit_code=True)
+            return {'stdout': out, 'stderr': err, 'return-code': 0}
+        except processutils.ProcessExecutionError as e:
+            return {'result': False, 'stdout': e.stdout, 'stderr': e.stderr,
+                    'return-code': e.exit_code}
 
     def execute(self, packet):
         unique = packet.get('unique', str(time.time()))
@@ -204,7 +1421,14 @@ class SFFileAgent(protocol.FileAgent):
             })
             return
 
+        if packet.get('stream-output', False):
+            self._execute_streaming(packet['command-line'], unique,
+                                    window=packet.get('window'))
+            return
+
         if packet.get('block-for-result', True):
+            from oslo_concurrency import processutils
+
             try:
                 out, err = processutils.execute(
                     packet['command-line'], shell=True, check_exit_code=True)
@@ -231,31 +1455,163 @@ class SFFileAgent(protocol.FileAgent):
                 })
                 return
 
-        def _execute(cmd):
-            processutils.execute(cmd, shell=True, check_exit_code=False)
-
-        p = multiprocessing.Process(
-            target=_execute, args=(packet['command-line'],))
-        p.start()
-        self.executing_commands.append(p)
+        stream = self.open_stream('execute', unique)
+        p = self.supervisor.spawn(
+            packet['command-line'],
+            lambda result: self._execute_complete(
+                packet['command-line'], unique, result, stream))
+        stream.on_cancel = lambda: self.supervisor.kill(p.pid)
 
         self.send_packet({
             'command': 'execute-response',
             'command-line': packet['command-line'],
             'pid': p.pid,
+            'stream': stream.id,
             'unique': unique
         })
 
-    def reap_processes(self):
-        for p in self.executing_commands:
-            if not p.is_alive():
-                p.join(1)
-            self.executing_commands.remove(p)
+    def _execute_complete(self, command_line, unique, result, stream):
+        self.close_stream(stream)
+        result.update({
+            'command': 'execute-complete',
+            'command-line': command_line,
+            'result': result['return-code'] == 0,
+            'stream': stream.id,
+            'unique': unique
+        })
+        self.send_packet(result)
+
+    def _execute_streaming(self, command_line, unique, window=None):
+        execution = {
+            'command-line': command_line,
+            'unique': unique,
+            'open-pipes': 2,
+            'exit': None,
+            'stream': self.open_stream('execute', unique)
+        }
+        p = self.supervisor.spawn(
+            command_line,
+            lambda result: self._streaming_execute_exited(execution, result),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        execution['stream'].on_cancel = lambda: self.supervisor.kill(p.pid)
+        producer = protocol.Producer(None, unique=unique, window=window)
+
+        for name, flo in [('stdout', p.stdout), ('stderr', p.stderr)]:
+            self.set_fd_nonblocking(flo.fileno())
+            self.register_throttled_reader(
+                flo.fileno(),
+                self._make_output_reader(execution, name, flo, producer),
+                producer=producer)
+
+    def _make_output_reader(self, execution, name, flo, producer):
+        # Commands can emit multibyte characters split across reads
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # 'stream' is the stream id of the execution, as in every other
+        # packet, and 'fd' says which of the command's outputs this is
+        def _send_output(text):
+            self.send_packet({
+                'command': 'execute-output',
+                'stream': execution['stream'].id,
+                'fd': name,
+                'output': text,
+                'offset': producer.sent,
+                'unique': execution['unique']
+            })
+
+        def _output_ready(fd, mask):
+            try:
+                d = os.read(fd, EXECUTE_READ_SIZE)
+            except BlockingIOError:
+                return
+
+            if d:
+                _send_output(decoder.decode(d))
+                producer.sent += len(d)
+                return
+
+            self.unregister_throttled_reader(fd)
+            flo.close()
+            text = decoder.decode(b'', final=True)
+            if text:
+                _send_output(text)
+
+            execution['open-pipes'] -= 1
+            self._streaming_execute_complete(execution)
+
+        return _output_ready
+
+    def _streaming_execute_exited(self, execution, result):
+        execution['exit'] = result
+        self._streaming_execute_complete(execution)
+
+    def _streaming_execute_complete(self, execution):
+        # We are done once the command has both exited and closed its output
+        if execution['open-pipes'] or not execution['exit']:
+            return
+
+        self.close_stream(execution['stream'])
+        result = execution['exit']
+        result.update({
+            'command': 'execute-response',
+            'command-line': execution['command-line'],
+            'result': result['return-code'] == 0,
+            'stream': execution['stream'].id,
+            'unique': execution['unique']
+        })
+        self.send_packet(result)
 
 
 CHANNEL = None
 
 
+def _tree_path_selected(name, is_dir, include, exclude):
+    # Patterns are matched against paths relative to the root of the tree.
+    # Directories are kept unless excluded, so that included files have
+    # somewhere to live.
+    if name == '.':
+        return True
+    for pattern in exclude or []:
+        if fnmatch.fnmatchcase(name, pattern):
+            return False
+    if include and not is_dir:
+        for pattern in include:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+    return True
+
+
+def _tree_entries(root, include, exclude):
+    # Yields (path, name in archive) for the root of the tree and everything
+    # selected beneath it. Symlinks are not followed.
+    yield root, '.'
+    for directory, dirnames, filenames in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        for name in sorted(dirnames):
+            if relative != '.':
+                name = os.path.join(relative, name)
+            path = os.path.join(root, name)
+            is_dir = os.path.isdir(path) and not os.path.islink(path)
+            if _tree_path_selected(name, is_dir, include, exclude):
+                yield path, name
+            elif is_dir:
+                dirnames.remove(os.path.basename(name))
+
+        for name in sorted(filenames):
+            if relative != '.':
+                name = os.path.join(relative, name)
+            if _tree_path_selected(name, False, include, exclude):
+                yield os.path.join(root, name), name
+
+
+def _tree_extract_filter(member, path):
+    # Refuse members which would be extracted outside the tree, but keep
+    # their modes as sent.
+    checked = tarfile.tar_filter(member, path)
+    return checked.replace(mode=member.mode, deep=False)
+
+
 def exit_gracefully(sig, _frame):
     if sig == signal.SIGTERM:
         print('Caught SIGTERM, gracefully exiting')
@@ -264,27 +1620,71 @@ def exit_gracefully(sig, _frame):
         sys.exit()
 
 
+def dump_packet_trace(sig, _frame):
+    # Logging from a signal handler could deadlock, so leave it to the loop
+    if CHANNEL and CHANNEL.reactor_running:
+        CHANNEL.call_soon_threadsafe(CHANNEL.log_packet_trace)
+
+
 @daemon.command(name='run', help='Run the sf-agent daemon')
+@click.option('--channel', default=SIDE_CHANNEL_PATH,
+              help='The path of the virtio-serial port to the host')
+@click.option('--command-concurrency', multiple=True, metavar='COMMAND=LIMIT',
+              help=('The maximum number of packets for a blocking command '
+                    'handled at once, may be repeated'))
+@click.option('--stats-log-interval', default=None, type=int, metavar='SECONDS',
+              help='Log agent statistics this often')
+@click.option('--profile', default=None, type=click.Path(dir_okay=False),
+              help=('Profile the loop thread with cProfile, and write the '
+                    'profile to this path on exit'))
+@click.option('--packet-trace', default=0, type=int, metavar='FRAMES',
+              help=('Remember the start of this many recent frames, which '
+                    'are logged on SIGUSR1'))
+@click.option('--json-codec', default=None,
+              type=click.Choice(protocol.json_codecs()),
+              help=('The JSON codec to use, by default the fastest which '
+                    'escapes non-ASCII characters until the host asks for '
+                    'another'))
 @click.pass_context
-def daemon_run(ctx):
+def daemon_run(ctx, channel, command_concurrency, stats_log_interval, profile,
+               packet_trace, json_codec):
     global CHANNEL
 
     signal.signal(signal.SIGTERM, exit_gracefully)
+    signal.signal(signal.SIGUSR1, dump_packet_trace)
 
-    if not os.path.exists(SIDE_CHANNEL_PATH):
+    if not os.path.exists(channel):
         click.echo('Side channel missing, will periodically check.')
 
-        while not os.path.exists(SIDE_CHANNEL_PATH):
+        while not os.path.exists(channel):
             time.sleep(60)
 
-    CHANNEL = SFFileAgent(SIDE_CHANNEL_PATH, logger=ctx.obj['LOGGER'])
+    CHANNEL = SFFileAgent(channel, logger=ctx.obj['LOGGER'])
+    for limit in command_concurrency:
+        command, _, value = limit.partition('=')
+        CHANNEL.set_command_concurrency(command, int(value))
+    CHANNEL.stats_log_interval = stats_log_interval
+    if json_codec:
+        CHANNEL.use_json_codec(json_codec)
+    if packet_trace:
+        CHANNEL.trace = trace.PacketTrace(packet_trace)
     CHANNEL.send_ping()
 
-    while True:
-        for packet in CHANNEL.find_packets():
-            CHANNEL.dispatch_packet(packet)
-        CHANNEL.watch_files()
-        CHANNEL.reap_processes()
+    if not profile:
+        CHANNEL.run()
+        return
+
+    # SIGTERM exits with SystemExit, so the profile is written then too
+    from shakenfist_agent import profiling
+
+    profiler = profiling.CProfiler()
+    profiler.start()
+    try:
+        CHANNEL.run()
+    finally:
+        profiler.stop()
+        profiler.dump(profile)
+        click.echo('Wrote profile to %s' % profile)
 
 
 daemon.add_command(daemon_run)
@@ -0,0 +1,177 @@
+import base64
+import hashlib
+import os
+import zlib
+
+
+# The smallest block size for signatures. Small blocks find more matches but
+# make the signature list larger, so by default the block size grows with the
+# file, as rsync's does, to about the square root of its size up to
+# MAX_BLOCK_SIZE.
+BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Signatures are computed from reads of about this size.
+SIGNATURE_READ_SIZE = 1024 * 1024
+
+# The weak checksum is Adler-32, which zlib computes for whole blocks and we
+# roll forward a byte at a time.
+ADLER_MODULUS = 65521
+
+# The strong hash is truncated, as it only needs to disambiguate blocks which
+# share a weak checksum.
+STRONG_DIGEST_SIZE = 16
+
+# Consecutive literal bytes are sent in pieces of at most this size.
+MAX_LITERAL = 65536
+
+
+def block_size_for(size):
+    """The default signature block size for a file of the given size."""
+    block_size = BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(block):
+    """The Adler-32 checksum of a block, as a 32 bit integer."""
+    return zlib.adler32(block)
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=STRONG_DIGEST_SIZE).hexdigest()
+
+
+def iter_signatures(f, block_size=BLOCK_SIZE):
+    """Yields (weak, strong) checksums for each block of the open file f."""
+    read_size = max(block_size, SIGNATURE_READ_SIZE // block_size * block_size)
+    offset = 0
+    while True:
+        d = os.pread(f.fileno(), read_size, offset)
+        if not d:
+            return
+        view = memoryview(d)
+        for start in range(0, len(d), block_size):
+            block = view[start:start + block_size]
+            yield weak_checksum(block), strong_checksum(block)
+        offset += len(d)
+
+
+def signatures(f, block_size=BLOCK_SIZE):
+    """Returns a list of (weak, strong) checksums for each block of the open
+    file f."""
+    return list(iter_signatures(f, block_size=block_size))
+
+
+def compute_delta(sigs, data, block_size=BLOCK_SIZE):
+    """Returns the operations needed to turn a file with the given signatures
+    into data. Operations are dictionaries, either {'block': n, 'count': c}
+    to copy c blocks starting at block n of the existing file, or
+    {'data': ...} with base64 encoded literal data.
+
+    This runs on the host, but lives here so that both ends agree on the
+    checksums."""
+    by_weak = {}
+    for index, (weak, strong) in enumerate(sigs):
+        by_weak.setdefault(weak, {}).setdefault(strong, index)
+
+    ops = []
+    literal_start = 0
+
+    def _add_literal(end):
+        for start in range(literal_start, end, MAX_LITERAL):
+            chunk = data[start:min(end, start + MAX_LITERAL)]
+            ops.append({'data': base64.b64encode(chunk).decode('utf-8')})
+
+    def _add_copy(index):
+        if (ops and 'block' in ops[-1] and
+                ops[-1]['block'] + ops[-1]['count'] == index):
+            ops[-1]['count'] += 1
+        else:
+            ops.append({'block': index, 'count': 1})
+
+    offset = 0
+    a = b = None
+    while offset + block_size <= len(data):
+        if a is None:
+            weak = weak_checksum(data[offset:offset + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+
+        index = None
+        candidates = by_weak.get(a | (b << 16))
+        if candidates:
+            index = candidates.get(
+                strong_checksum(data[offset:offset + block_size]))
+
+        if index is not None:
+            _add_literal(offset)
+            _add_copy(index)
+            offset += block_size
+            literal_start = offset
+            a = None
+            continue
+
+        # Roll the checksum forward one byte
+        out_byte = data[offset]
+        if offset + block_size < len(data):
+            in_byte = data[offset + block_size]
+            a = (a - out_byte + in_byte) % ADLER_MODULUS
+            b = (b - block_size * out_byte + a - 1) % ADLER_MODULUS
+        offset += 1
+
+    # The final partial block can still match a short final block
+    if offset < len(data) and sigs:
+        tail = data[offset:]
+        if (weak_checksum(tail), strong_checksum(tail)) == tuple(sigs[-1]):
+            _add_literal(offset)
+            _add_copy(len(sigs) - 1)
+            literal_start = len(data)
+
+    _add_literal(len(data))
+    return ops
+
+
+def _copy_range(src_fd, dst_fd, count, src_offset, dst_offset):
+    while count > 0:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                copied = os.copy_file_range(
+                    src_fd, dst_fd, count, src_offset, dst_offset)
+            except OSError:
+                copied = None
+            if copied:
+                count -= copied
+                src_offset += copied
+                dst_offset += copied
+                continue
+            if copied == 0:
+                return dst_offset
+
+        d = os.pread(src_fd, min(count, MAX_LITERAL), src_offset)
+        if not d:
+            return dst_offset
+        os.pwrite(dst_fd, d, dst_offset)
+        count -= len(d)
+        src_offset += len(d)
+        dst_offset += len(d)
+    return dst_offset
+
+
+def apply_delta(basis_fd, out_fd, ops, offset, block_size=BLOCK_SIZE):
+    """Applies operations from compute_delta() to out_fd starting at offset,
+    copying blocks from basis_fd. Returns the offset after the last byte
+    written."""
+    for op in ops:
+        if 'block' in op:
+            if basis_fd is None:
+                raise ValueError('delta refers to blocks of a missing file')
+            offset = _copy_range(
+                basis_fd, out_fd, op['count'] * block_size,
+                op['block'] * block_size, offset)
+        else:
+            d = base64.b64decode(op['data'])
+            os.pwrite(out_fd, d, offset)
+            offset += len(d)
+    return offset
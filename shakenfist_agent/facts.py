@@ -0,0 +1,163 @@
+import copy
+import os
+import selectors
+import sys
+import threading
+import time
+
+from shakenfist_agent import inotify
+
+
+SSH_DIRECTORY = '/etc/ssh'
+SSH_HOST_KEYS = [
+    ('rsa', '/etc/ssh/ssh_host_rsa_key.pub'),
+    ('ecdsa', '/etc/ssh/ssh_host_ecdsa_key.pub'),
+    ('ed25519', '/etc/ssh/ssh_host_ed25519_key.pub')
+]
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# How long each group of facts is cached for, in seconds. Groups which we are
+# able to watch for changes are cached until they change instead.
+FACT_TTLS = {
+    'distribution': 300,
+    'mounts': 60,
+    'ssh-host-keys': 60
+}
+
+
+# The modules used to gather facts are slow to import, so they are imported
+# the first time the facts are gathered rather than when the agent starts.
+def _distribution():
+    import distro
+
+    return distro.info()
+
+
+def _mounts():
+    # We should allow this agent to at least run on MacOS
+    if sys.platform == 'darwin':
+        return []
+
+    from linux_utils.fstab import find_mounted_filesystems
+
+    mounts = []
+    for entry in find_mounted_filesystems():
+        mounts.append({
+            'device': entry.device,
+            'mount_point': entry.mount_point,
+            'vfs_type': entry.vfs_type
+        })
+    return mounts
+
+
+def _ssh_host_keys():
+    keys = {}
+    for kind, path in SSH_HOST_KEYS:
+        if os.path.exists(path):
+            with open(path) as f:
+                keys[kind] = f.read()
+    return keys
+
+
+GATHERERS = {
+    'distribution': _distribution,
+    'mounts': _mounts,
+    'ssh-host-keys': _ssh_host_keys
+}
+
+
+class FactsCache(object):
+    """Caches each group of facts until it expires or is invalidated. Facts
+    may be read from worker threads while the loop thread invalidates them,
+    so all access is under a lock."""
+
+    def __init__(self):
+        self.ttls = dict(FACT_TTLS)
+        self._values = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self.inotify = None
+        self.mountinfo_fd = None
+
+    def groups(self):
+        return list(GATHERERS)
+
+    def get(self, groups=None):
+        facts = {}
+        with self._lock:
+            for group in groups or GATHERERS:
+                if self._expires.get(group, 0) <= time.monotonic():
+                    self._gather(group)
+                facts[group] = copy.deepcopy(self._values[group])
+        return facts
+
+    def _gather(self, group):
+        self._values[group] = GATHERERS[group]()
+        ttl = self.ttls[group]
+        if ttl is None:
+            self._expires[group] = float('inf')
+        else:
+            self._expires[group] = time.monotonic() + ttl
+
+    def invalidate(self, group):
+        with self._lock:
+            self._expires[group] = 0
+
+    def refresh(self, groups):
+        # Gather groups again, returning those whose value changed
+        changed = {}
+        with self._lock:
+            for group in groups:
+                old = self._values.get(group)
+                self._gather(group)
+                if self._values[group] != old:
+                    changed[group] = copy.deepcopy(self._values[group])
+        return changed
+
+    def watch(self, reactor, callback):
+        # Ask the kernel to tell us when SSH host keys or mounts change, and
+        # cache those groups until then. callback is called on the loop
+        # thread with the name of the group which changed.
+        try:
+            self.inotify = inotify.Inotify()
+            self.inotify.add_watch(
+                SSH_DIRECTORY,
+                inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MODIFY |
+                inotify.IN_ATTRIB | inotify.IN_MOVED_FROM |
+                inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        except OSError:
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+        else:
+            self.ttls['ssh-host-keys'] = None
+            reactor.register_fd(
+                self.inotify.fileno(),
+                lambda fd, mask: self._ssh_changed(callback))
+
+        # mountinfo reports a priority event, which selectors reports as
+        # writable, whenever the mount table changes. See proc(5).
+        try:
+            self.mountinfo_fd = os.open(MOUNTINFO_PATH,
+                                        os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            pass
+        else:
+            self.ttls['mounts'] = None
+            reactor.register_fd(
+                self.mountinfo_fd, lambda fd, mask: callback('mounts'),
+                selectors.EVENT_WRITE)
+
+    def _ssh_changed(self, callback):
+        self.inotify.read_events()
+        callback('ssh-host-keys')
+
+    def close(self, reactor):
+        if self.inotify:
+            reactor.unregister_fd(self.inotify.fileno())
+            self.inotify.close()
+            self.inotify = None
+        if self.mountinfo_fd is not None:
+            reactor.unregister_fd(self.mountinfo_fd)
+            os.close(self.mountinfo_fd)
+            self.mountinfo_fd = None
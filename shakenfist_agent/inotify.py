@@ -0,0 +1,99 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+
+# Event masks, from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# Flags for inotify_init1()
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event is followed by len bytes of NUL padded name
+EVENT_HEADER = struct.Struct('iIII')
+
+# Big enough for many events at once, see inotify(7)
+READ_SIZE = 64 * (EVENT_HEADER.size + 256)
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if not _libc:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+        for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(_libc, name):
+                raise OSError('inotify is not supported on this platform')
+        _libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+class Inotify(object):
+    """A thin wrapper around an inotify instance. The fd is non-blocking and
+    may be registered with a selector."""
+
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        return _check(self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        try:
+            _check(self.libc.inotify_rm_watch(self.fd, wd))
+        except OSError:
+            # The watch is already gone, for example because the file was
+            # deleted
+            pass
+
+    def read_events(self):
+        """Returns a list of (wd, mask, cookie, name) tuples for all queued
+        events."""
+        events = []
+        while True:
+            try:
+                d = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            if not d:
+                return events
+
+            offset = 0
+            while offset < len(d):
+                wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(d, offset)
+                offset += EVENT_HEADER.size
+                name = d[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,149 @@
+import time
+
+
+# Round trip times are smoothed the way TCP smooths them (RFC 6298), with
+# jitter being the smoothed mean deviation.
+RTT_GAIN = 0.125
+JITTER_GAIN = 0.25
+
+# Throughput samples are smoothed with this gain.
+THROUGHPUT_GAIN = 0.25
+
+# A throughput sample is only taken once we have been sending for at least
+# this long, shorter periods say more about scheduling than the channel.
+MIN_THROUGHPUT_SAMPLE = 0.05
+
+# An idle connection is first pinged after this many seconds. Each answered
+# ping doubles the interval up to the maximum, and a missed ping or an error
+# on the channel drops it to the minimum. Further missed pings double it
+# again, so a channel with nothing on the other end is not pinged constantly.
+KEEPALIVE_INTERVAL = 5
+MIN_KEEPALIVE_INTERVAL = 1
+MAX_KEEPALIVE_INTERVAL = 30
+
+# Binary file transfers are sent in chunks which take about this long to
+# write at the measured throughput, rounded to a power of two within these
+# bounds.
+CHUNK_TARGET_SECONDS = 0.01
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+
+class LinkEstimator(object):
+    """What we have learnt about the channel: the round trip time from
+    timestamped pings, the throughput from how quickly output is written
+    while we have more to send, and so how often an idle channel should be
+    pinged. The agent owns one, and reports it in get-agent-stats."""
+
+    def __init__(self):
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.rtt = None
+        self.jitter = None
+        self.min_rtt = None
+        self.rtt_samples = 0
+        self.throughput = None
+        self.throughput_samples = 0
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.pings_missed = 0
+        self.errors = 0
+
+        self._consecutive_misses = 0
+        self._busy_since = None
+        self._busy_written = 0
+
+    def observe_rtt(self, seconds):
+        if seconds < 0:
+            return
+        if self.rtt is None:
+            self.rtt = seconds
+            self.jitter = seconds / 2
+        else:
+            self.jitter += JITTER_GAIN * (abs(self.rtt - seconds) - self.jitter)
+            self.rtt += RTT_GAIN * (seconds - self.rtt)
+        if self.min_rtt is None or seconds < self.min_rtt:
+            self.min_rtt = seconds
+        self.rtt_samples += 1
+
+    def observe_throughput(self, length, seconds):
+        if seconds <= 0:
+            return
+        rate = length / seconds
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput += THROUGHPUT_GAIN * (rate - self.throughput)
+        self.throughput_samples += 1
+
+    def output_sample(self, written, busy):
+        # Called each time around the loop with the total number of bytes
+        # written to the channel, and whether we still had output to send.
+        # While we do, the rate it is written at is what the channel is
+        # carrying. Long busy periods are sampled as they go, so that a
+        # transfer which keeps the channel busy still produces estimates.
+        if self._busy_since is None:
+            if busy:
+                self._busy_since = time.monotonic()
+                self._busy_written = written
+            return
+
+        now = time.monotonic()
+        elapsed = now - self._busy_since
+        if elapsed >= MIN_THROUGHPUT_SAMPLE:
+            # Nothing written says nothing about how fast the channel is,
+            # there may just be nobody on the other end.
+            if written > self._busy_written:
+                self.observe_throughput(written - self._busy_written, elapsed)
+            self._busy_since = now
+            self._busy_written = written
+        if not busy:
+            self._busy_since = None
+
+    def ping_sent(self):
+        self.pings_sent += 1
+
+    def pong_received(self):
+        self.pongs_received += 1
+        self._consecutive_misses = 0
+        self.keepalive_interval = min(
+            self.keepalive_interval * 2, MAX_KEEPALIVE_INTERVAL)
+
+    def ping_missed(self):
+        self.pings_missed += 1
+        self._consecutive_misses += 1
+        if self._consecutive_misses == 1:
+            self.error()
+        else:
+            self.errors += 1
+            self.keepalive_interval = min(
+                self.keepalive_interval * 2, MAX_KEEPALIVE_INTERVAL)
+
+    def error(self):
+        self.errors += 1
+        self.keepalive_interval = MIN_KEEPALIVE_INTERVAL
+
+    def chunk_size(self, default):
+        # A chunk size for binary transfers, or default if we have not yet
+        # measured the throughput.
+        if not self.throughput:
+            return default
+        target = int(self.throughput * CHUNK_TARGET_SECONDS)
+        size = MIN_CHUNK_SIZE
+        while size < target and size < MAX_CHUNK_SIZE:
+            size *= 2
+        return size
+
+    def snapshot(self):
+        return {
+            'keepalive-interval': self.keepalive_interval,
+            'rtt-seconds': self.rtt,
+            'jitter-seconds': self.jitter,
+            'min-rtt-seconds': self.min_rtt,
+            'rtt-samples': self.rtt_samples,
+            'throughput-bytes-per-second': self.throughput,
+            'throughput-samples': self.throughput_samples,
+            'pings-sent': self.pings_sent,
+            'pongs-received': self.pongs_received,
+            'pings-missed': self.pings_missed,
+            'errors': self.errors
+        }
@@ -1,17 +1,33 @@
 # Copyright 2022 Michael Still
 
 import click
+import importlib
 from shakenfist_utilities import logs
 import logging
 
 
-from shakenfist_agent.commandline import daemon
+LOG = logs.setup_console(__name__)
 
+# Subcommand groups as name: module. Each module is only imported when its
+# group is used, so that the daemon does not pay for importing the others
+# before it can start.
+COMMAND_GROUPS = {
+    'benchmark': 'shakenfist_agent.commandline.benchmark',
+    'daemon': 'shakenfist_agent.commandline.daemon'
+}
 
-LOG = logs.setup_console(__name__)
 
+class LazyGroup(click.Group):
+    def list_commands(self, ctx):
+        return sorted(COMMAND_GROUPS)
+
+    def get_command(self, ctx, name):
+        if name not in COMMAND_GROUPS:
+            return None
+        return getattr(importlib.import_module(COMMAND_GROUPS[name]), name)
 
-@click.group()
+
+@click.group(cls=LazyGroup)
 @click.option('--verbose/--no-verbose', default=False)
 @click.pass_context
 def cli(ctx, verbose):
@@ -26,6 +42,3 @@ def cli(ctx, verbose):
     else:
         ctx.obj['VERBOSE'] = False
         LOG.setLevel(logging.INFO)
-
-
-cli.add_command(daemon.daemon)
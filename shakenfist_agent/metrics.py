@@ -0,0 +1,107 @@
+import os
+import psutil
+import time
+
+
+# The shortest sampling interval a subscriber may ask for, in seconds.
+MIN_INTERVAL = 0.01
+
+# Rates and percentages are rounded to this many decimal places to keep
+# samples small.
+PRECISION = 3
+
+
+def _rates(previous, current, elapsed):
+    # Per second rates of change for counters which only increase
+    if previous is None or elapsed <= 0:
+        return None
+    return {name: round((value - previous[name]) / elapsed, PRECISION)
+            for name, value in current.items()}
+
+
+def _counters(named_tuple, fields):
+    if named_tuple is None:
+        return {}
+    return {field: getattr(named_tuple, field) for field in fields}
+
+
+def _cpu(previous, elapsed):
+    times = psutil.cpu_times()._asdict()
+    sample = None
+    if previous is not None:
+        total = sum(times.values()) - sum(previous.values())
+        if total > 0:
+            sample = {name: round(100.0 * (value - previous[name]) / total,
+                                  PRECISION)
+                      for name, value in times.items()}
+    return times, sample
+
+
+def _memory(previous, elapsed):
+    vm = psutil.virtual_memory()
+    swap = psutil.swap_memory()
+    return None, {
+        'total': vm.total,
+        'available': vm.available,
+        'used': vm.used,
+        'percent': vm.percent,
+        'swap-used': swap.used
+    }
+
+
+def _disk(previous, elapsed):
+    counters = _counters(
+        psutil.disk_io_counters(),
+        ('read_count', 'write_count', 'read_bytes', 'write_bytes'))
+    return counters, _rates(previous, counters, elapsed)
+
+
+def _network(previous, elapsed):
+    counters = _counters(
+        psutil.net_io_counters(),
+        ('bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv',
+         'errin', 'errout', 'dropin', 'dropout'))
+    return counters, _rates(previous, counters, elapsed)
+
+
+def _load(previous, elapsed):
+    return None, [round(load, PRECISION) for load in os.getloadavg()]
+
+
+# Each sampler is passed the raw counters it returned last time (or None)
+# and the seconds since then, and returns its new raw counters and the
+# values to report. Counters are reported as per second rates, and CPU
+# times as the percentage of time spent in each state.
+SAMPLERS = {
+    'cpu': _cpu,
+    'memory': _memory,
+    'disk': _disk,
+    'network': _network,
+    'load': _load
+}
+
+
+class MetricsSampler(object):
+    """Samples a set of metrics, remembering the raw counters from the last
+    sample so that rates can be computed. Metrics which need two samples
+    to compute are left out of the first."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._previous = {}
+        self._last_sampled = None
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = 0
+        if self._last_sampled is not None:
+            elapsed = now - self._last_sampled
+        self._last_sampled = now
+
+        sample = {'time': time.time()}
+        for metric in self.metrics:
+            raw, value = SAMPLERS[metric](self._previous.get(metric), elapsed)
+            self._previous[metric] = raw
+            if value is not None:
+                sample[metric] = value
+        return sample
@@ -0,0 +1,151 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+
+# If neither pidfds nor SIGCHLD are available to us (SIGCHLD handlers can only
+# be installed from the main thread), check on children this often.
+POLL_INTERVAL = 0.2
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ProcessSupervisor(object):
+    """Runs shell commands as direct children and reports their exit via the
+    reactor of an Agent. Exits are noticed with a pidfd where the kernel
+    supports them, otherwise with a SIGCHLD handler which wakes the reactor
+    via a pipe. Children are reaped with wait4() so that we can report their
+    resource usage.
+
+    Completion callbacks are called on the loop thread with a dictionary
+    describing how the child exited."""
+
+    def __init__(self, reactor, logger=None):
+        self.reactor = reactor
+        self.log = logger
+        self.children = {}
+        self._sigchld_fds = None
+        self._polling = False
+
+    def spawn(self, command_line, callback, stdout=subprocess.DEVNULL,
+              stderr=subprocess.DEVNULL):
+        use_pidfd = hasattr(os, 'pidfd_open')
+        if not use_pidfd:
+            self._install_sigchld_handler()
+
+        # Each child leads its own process group, so that kill() reaches
+        # everything the shell started
+        p = subprocess.Popen(
+            command_line, shell=True, stdin=subprocess.DEVNULL,
+            stdout=stdout, stderr=stderr, start_new_session=True)
+        child = {
+            'process': p,
+            'callback': callback,
+            'started': time.monotonic(),
+            'pidfd': None
+        }
+        self.children[p.pid] = child
+
+        if use_pidfd:
+            try:
+                child['pidfd'] = os.pidfd_open(p.pid)
+                self.reactor.register_fd(
+                    child['pidfd'], lambda fd, mask: self._reap(p.pid))
+                return p
+            except OSError:
+                # The kernel is older than 5.3
+                self._install_sigchld_handler()
+
+        # The child might have exited before we were ready to notice
+        self._reap(p.pid)
+        return p
+
+    def kill(self, pid):
+        if pid not in self.children:
+            return
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _install_sigchld_handler(self):
+        if self._sigchld_fds or self._polling:
+            return
+
+        if threading.current_thread() is not threading.main_thread():
+            self._polling = True
+            self.reactor.add_timer(POLL_INTERVAL, self._poll_children)
+            return
+
+        self._sigchld_fds = os.pipe()
+        for fd in self._sigchld_fds:
+            self.reactor.set_fd_nonblocking(fd)
+        self.reactor.register_fd(self._sigchld_fds[0], self._sigchld_ready)
+        signal.signal(signal.SIGCHLD, self._sigchld_handler)
+
+    def _sigchld_handler(self, signum, frame):
+        try:
+            os.write(self._sigchld_fds[1], b'x')
+        except BlockingIOError:
+            pass
+
+    def _sigchld_ready(self, fd, mask):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self._reap_all()
+
+    def _poll_children(self):
+        self._reap_all()
+        self.reactor.add_timer(POLL_INTERVAL, self._poll_children)
+
+    def _reap_all(self):
+        for pid in list(self.children):
+            if self.children[pid]['pidfd'] is None:
+                self._reap(pid)
+
+    def _reap(self, pid):
+        child = self.children.get(pid)
+        if not child:
+            return
+
+        try:
+            wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Someone else reaped our child, so we don't know how it exited
+            wpid, status, rusage = pid, None, None
+        if wpid == 0:
+            return
+
+        del self.children[pid]
+        if child['pidfd'] is not None:
+            self.reactor.unregister_fd(child['pidfd'])
+            os.close(child['pidfd'])
+
+        result = {
+            'pid': pid,
+            'return-code': None,
+            'wall-time': time.monotonic() - child['started']
+        }
+        if status is not None:
+            result['return-code'] = _exit_code(status)
+            # Stop the Popen object from trying to reap the child itself
+            child['process'].returncode = result['return-code']
+        if rusage is not None:
+            result.update({
+                'user-time': rusage.ru_utime,
+                'system-time': rusage.ru_stime,
+                'max-rss': rusage.ru_maxrss
+            })
+
+        if self.log:
+            self.log.with_fields(result).debug('Child process exited')
+        child['callback'](result)
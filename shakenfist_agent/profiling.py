@@ -0,0 +1,144 @@
+import collections
+import cProfile
+import pstats
+import sys
+import threading
+
+
+# How often the sampling profiler looks at each thread's stack, in seconds.
+SAMPLE_INTERVAL = 0.005
+
+# Stacks deeper than this are truncated to their innermost frames.
+MAX_STACK_DEPTH = 128
+
+# Functions are sorted by one of these before the top of the list is
+# reported.
+SORT_KEYS = ('cumulative', 'total')
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _function_name(filename, line, name):
+    # The same format pstats uses
+    return '%s:%d(%s)' % (filename, line, name)
+
+
+class CProfiler(object):
+    """Deterministic profiling with cProfile. This only sees the thread
+    which started it, which for the agent is the loop thread. Only one may
+    run at a time, as a thread can only have one profile function."""
+
+    _running = threading.Lock()
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy('another cProfile profile is already running')
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            self._running.release()
+            raise ProfilerBusy(str(e))
+
+    def stop(self):
+        self.profile.disable()
+        self._running.release()
+
+    def top(self, limit, sort='cumulative'):
+        functions = []
+        for (filename, line, name), (cc, nc, tt, ct, _) in \
+                pstats.Stats(self.profile).stats.items():
+            functions.append({
+                'function': _function_name(filename, line, name),
+                'calls': nc,
+                'primitive-calls': cc,
+                'total-seconds': tt,
+                'cumulative-seconds': ct
+            })
+        functions.sort(key=lambda f: f['%s-seconds' % sort], reverse=True)
+        return functions[:limit]
+
+    def dump(self, path):
+        # In the pstats format, which may be loaded with pstats.Stats(path)
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler(object):
+    """Statistical profiling by looking at the stacks of other threads from
+    a background thread. This is cheap enough for a busy agent. threads is
+    a list of the thread idents to sample, or None to sample every thread
+    including idle ones."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, threads=None):
+        self.interval = interval
+        self.threads = threads
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if self.threads is None or ident in self.threads:
+                    self.stacks[self._stack(frame)] += 1
+
+    def _stack(self, frame):
+        # Outermost function first
+        stack = []
+        while frame and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(_function_name(
+                code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def top(self, limit, sort='cumulative'):
+        total = collections.Counter()
+        cumulative = collections.Counter()
+        for stack, count in self.stacks.items():
+            total[stack[-1]] += count
+            for function in set(stack):
+                cumulative[function] += count
+
+        functions = []
+        for function, count in cumulative.items():
+            functions.append({
+                'function': function,
+                'samples': total[function],
+                'cumulative-samples': count,
+                'total-seconds': total[function] * self.interval,
+                'cumulative-seconds': count * self.interval
+            })
+        functions.sort(key=lambda f: f['%s-seconds' % sort], reverse=True)
+        return functions[:limit]
+
+    def dump(self, path):
+        # As collapsed stacks, one per line with a count, which is what most
+        # flame graph tools read.
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (';'.join(stack), count))
+
+
+PROFILERS = {
+    'cprofile': CProfiler,
+    'sampling': SamplingProfiler
+}
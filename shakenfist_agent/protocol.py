@@ -1,24 +1,312 @@
 import base64
-import copy
+import collections
+from concurrent import futures
+import errno
 import fcntl
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import os
 import random
+import select
+import selectors
 import socket
+import stat
+import struct
 import sys
+import threading
 import time
+import zlib
+
+from shakenfist_agent import link
+from shakenfist_agent import stats
+from shakenfist_agent import trace
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 MAX_WRITE = 2048
 
+# Once this many bytes at the front of the receive buffer have been consumed
+# we compact the buffer, instead of re-slicing it for every packet.
+COMPACT_THRESHOLD = 65536
+
+# How long the connection may be idle before we first send a keepalive ping.
+# After that the interval adapts to how healthy the channel is, see link.py.
+KEEPALIVE_INTERVAL = link.KEEPALIVE_INTERVAL
+
+# If the other end of the channel goes away (for virtio-serial, the host is
+# not connected), how long to wait before watching the channel again. This
+# applies to writes as well as reads, as such a channel is always reported
+# as writable even though writes to it fail.
+RECONNECT_DELAY = 1
+
+# File data sent in binary frames is sent in chunks of this size, until we
+# have measured the throughput of the channel.
+BINARY_CHUNK_SIZE = 65536
+
+# Digest algorithms which may be requested for file transfers.
+DIGEST_ALGORITHMS = ('blake2b', 'sha256')
+
+# Files are read in pieces of this size when only computing digests.
+DIGEST_READ_SIZE = 1024 * 1024
+
+# Output waiting to be written to the channel is buffered in memory. Once more
+# than this many bytes are queued, producers of bulk data (such as file
+# transfers) are paused until the channel drains.
+MAX_QUEUED_OUTPUT = 1024 * 1024
+
+# When the reactor is not running, writes block until the channel accepts
+# them. If the channel does not accept any data for this long we assume there
+# is nothing on the other end and discard the output. The reactor does the
+# same once the other end has gone away for this long. An agent which is about
+# to start its reactor can set write_timeout to None, and output the channel
+# will not take yet is then left queued for the reactor to write.
+WRITE_TIMEOUT = 30
+
+# On close we only wait this long for queued output to be written.
+CLOSE_WRITE_TIMEOUT = 1
+
+# Output is queued at one of these priorities. Control traffic (replies to
+# small commands, pings and the like) is written before any queued bulk data,
+# switching between queues only at frame boundaries.
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+OUTPUT_PRIORITIES = (PRIORITY_CONTROL, PRIORITY_BULK)
+
+# When the reactor is running, small writes are queued and flushed together
+# with writev once per loop iteration, or as soon as this many bytes are
+# queued.
+COALESCE_THRESHOLD = 65536
+
+# Once compression is enabled, frames with payloads smaller than this are
+# never compressed.
+COMPRESSION_THRESHOLD = 1024
+
+# Flags in the binary frame header. The low bit says that the payload is a
+# JSON packet rather than file data, and the next three bits say which codec
+# the payload is compressed with (zero meaning none).
+FLAG_JSON = 0x01
+FLAG_COMPRESSION_MASK = 0x0e
+FLAG_COMPRESSION_SHIFT = 1
+
+# Compression codecs in order of preference, as name: (codec id, compress,
+# decompress). Codecs are only offered if their module is importable.
+# DECOMPRESSION_ERRORS are what each codec raises for corrupt data.
+COMPRESSION_CODECS = {}
+DECOMPRESSION_ERRORS = [zlib.error]
+if zstandard:
+    COMPRESSION_CODECS['zstd'] = (
+        2, zstandard.ZstdCompressor(level=1).compress,
+        zstandard.ZstdDecompressor().decompress)
+    DECOMPRESSION_ERRORS.append(zstandard.ZstdError)
+if lz4:
+    COMPRESSION_CODECS['lz4'] = (3, lz4.frame.compress, lz4.frame.decompress)
+    DECOMPRESSION_ERRORS.append(RuntimeError)
+COMPRESSION_CODECS['zlib'] = (
+    1, lambda d: zlib.compress(d, 1), zlib.decompress)
+DECOMPRESSION_ERRORS = tuple(DECOMPRESSION_ERRORS)
+COMPRESSION_CODECS_BY_ID = {
+    codec_id: (name, decompress)
+    for name, (codec_id, _, decompress) in COMPRESSION_CODECS.items()}
+
+
+def compression_codecs():
+    return list(COMPRESSION_CODECS.keys())
+
+
+def _json_dumps(p):
+    return json.dumps(p).encode('utf-8')
+
+
+# JSON codecs in order of preference, as name: (dumps, loads). dumps returns
+# UTF-8 encoded bytes, and loads accepts them. Codecs are only offered if
+# their module is importable. We decode with whichever codec we use for
+# sending, as they all read each other's output.
+#
+# Codecs in UTF8_JSON_CODECS write non-ASCII characters unescaped. Older
+# peers decode their whole receive buffer as UTF-8, and fail when a read
+# splits a multibyte character, so those codecs are only used if the peer
+# asks for them with set-json-codec. Until then we use the first codec
+# which escapes non-ASCII characters.
+JSON_CODECS = {}
+UTF8_JSON_CODECS = set()
+if orjson:
+    JSON_CODECS['orjson'] = (orjson.dumps, orjson.loads)
+    UTF8_JSON_CODECS.add('orjson')
+if ujson:
+    JSON_CODECS['ujson'] = (
+        lambda p: ujson.dumps(p, escape_forward_slashes=False).encode('utf-8'),
+        ujson.loads)
+JSON_CODECS['json'] = (_json_dumps, json.loads)
+
+
+def json_codecs():
+    return list(JSON_CODECS.keys())
+
+
+def default_json_codec():
+    for name in JSON_CODECS:
+        if name not in UTF8_JSON_CODECS:
+            return name
+
+
+# Commands registered as blocking run on a pool of this many worker threads
+# when the reactor is running, so that they do not hold up the loop. Each
+# command may have at most DEFAULT_COMMAND_CONCURRENCY packets being handled
+# at once unless it is registered with a different limit, further packets
+# wait for a running one to finish.
+WORKER_THREADS = 8
+DEFAULT_COMMAND_CONCURRENCY = 4
+
+# The most buffers we pass to a single writev call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (ValueError, OSError):
+    IOV_MAX = 1024
+
 
 class PacketTooLarge(Exception):
     ...
 
 
+class UnsupportedDigest(Exception):
+    ...
+
+
+def new_digest(algorithm):
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise UnsupportedDigest(
+            'Unsupported digest algorithm %s, the supported algorithms are %s'
+            % (algorithm, ', '.join(DIGEST_ALGORITHMS)))
+    return hashlib.new(algorithm)
+
+
+def digest_file(f, algorithm, start=0, end=None, h=None):
+    # Returns a digest object (or updates h) with the bytes of the open file f
+    # between start and end.
+    if not h:
+        h = new_digest(algorithm)
+    offset = start
+    while end is None or offset < end:
+        size = DIGEST_READ_SIZE
+        if end is not None:
+            size = min(size, end - offset)
+        d = os.pread(f.fileno(), size, offset)
+        if not d:
+            break
+        h.update(d)
+        offset += len(d)
+    return h
+
+
+def stat_result(st):
+    # The subset of an os.stat_result we send to the host.
+    return {
+        'mode': st.st_mode,
+        'size': st.st_size,
+        'uid': st.st_uid,
+        'gid': st.st_gid,
+        'atime': st.st_atime,
+        'mtime': st.st_mtime,
+        'ctime': st.st_ctime
+    }
+
+
+def digest_zeros(h, length):
+    # Updates the digest h as if it had read a hole of length bytes.
+    zeros = bytes(min(length, DIGEST_READ_SIZE))
+    while length > 0:
+        h.update(zeros[:length])
+        length -= len(zeros)
+
+
+def _data_extents(fd, start, end):
+    # Yields (start, end) for each region of the file between start and end
+    # which contains data. Filesystems which cannot report holes report the
+    # whole file as data.
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # There is only a hole between offset and the end of the file
+                return
+            yield offset, end
+            return
+        if data >= end:
+            return
+
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole
+        offset = hole
+
+
+class Producer(object):
+    """A generator which sends data a piece at a time, yielding how far it
+    advanced through the data for each piece. sent is then the offset
+    reached, which starts at offset and counts the same way as the offsets
+    in the data sent, so for a file it is the file offset and includes any
+    holes. If the peer asked for a window, at most that many bytes are sent
+    beyond the offset the peer has acknowledged with a window-ack packet.
+    Throttled readers use a Producer without a generator purely to track
+    their window."""
+
+    def __init__(self, generator, unique=None, window=None,
+                 priority=PRIORITY_BULK, offset=0):
+        self.generator = generator
+        self.unique = unique
+        self.window = window
+        self.priority = priority
+        self.sent = offset
+        self.acknowledged = offset
+
+    def blocked(self):
+        return (self.window is not None and
+                self.sent - self.acknowledged >= self.window)
+
+
+class Stream(object):
+    """An operation which outlives the packet which started it, such as a
+    file transfer or a running command. Each has an id unique within this
+    agent, and may be cancelled by the peer with a cancel packet naming
+    either that id or the unique of the request. on_cancel is called to stop
+    the operation and release anything it holds."""
+
+    def __init__(self, stream_id, command, unique, on_cancel=None):
+        self.id = stream_id
+        self.command = command
+        self.unique = unique
+        self.on_cancel = on_cancel
+        self.cancelled = False
+
+
 class Agent(object):
     def __init__(self, logger=None):
-        self.buffer = b''
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._search_offset = 0
         self.received_any_data = False
         self.last_data = time.time()
 
@@ -27,67 +315,700 @@ class Agent(object):
 
         self._command_map = {
             'ping': self.send_pong,
-            'pong': self.noop,
+            'pong': self.pong_received,
             'json-decode-failure': self.log_error_packet,
             'command-error': self.log_error_packet,
             'unknown-command': self.log_error_packet,
+            'binary-chunk': self.dispatch_binary_chunk,
+            'window-ack': self.window_ack,
+            'unknown-stream': self.log_error_packet,
+            'decompression-failure': self.log_error_packet,
+            'set-compression': self.set_compression,
+            'set-json-codec': self.set_json_codec,
+            'cancel': self.cancel,
+            'get-agent-stats': self.get_agent_stats,
+            'set-packet-trace': self.set_packet_trace,
+            'get-packet-trace': self.get_packet_trace,
         }
+        self._binary_streams = {}
+        self._stream_ids = itertools.count(1)
+        self.streams = {}
+
+        self.compression = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.use_json_codec(default_json_codec())
 
         self.log = logger
         self.poll_tasks = []
 
+        self.selector = None
+        self.reactor_running = False
+        self.write_timeout = WRITE_TIMEOUT
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._packets_framed = 0
+
+        # Each queue holds [data, end of frame, unique] entries. Bulk frames
+        # are counted by the unique they belong to, so that later packets
+        # for the same request are never sent ahead of them.
+        self._output_queues = [collections.deque() for _ in OUTPUT_PRIORITIES]
+        self._output_queued = 0
+        self._output_frame_open = None
+        self._output_context = None
+        self._bulk_frames_queued = collections.Counter()
+        self._waiting_for_writable = False
+        self._output_paused = False
+        self._output_stalled_since = None
+        self._input_hungup = False
+        self.output_counters = {
+            'frames': 0,
+            'bytes': 0,
+            'write_syscalls': 0
+        }
+        self._producers = []
+        self._throttled_readers = {}
+
+        self.max_workers = WORKER_THREADS
+        self._executor = None
+        self._blocking_commands = {}
+        self._command_concurrency = {}
+        self._commands_running = collections.Counter()
+        self._commands_waiting = collections.defaultdict(collections.deque)
+        self._loop_thread = None
+        self._wakeup_fds = None
+        self._pending_calls = collections.deque()
+
+        self.stats = stats.AgentStats()
+        self.stats_log_interval = None
+        self._last_frame_size = 0
+        self.trace = None
+
+        self.link = link.LinkEstimator()
+        self._bytes_written = 0
+        self._ping_outstanding = False
+        self._ping_unique = None
+
+    @property
+    def log(self):
+        return self._log
+
+    @log.setter
+    def log(self, logger):
+        # Whether to debug log is decided once here, so that hot paths only
+        # test a flag and never build messages which would be discarded.
+        self._log = logger
+        self.log_debug = bool(logger) and logger.isEnabledFor(logging.DEBUG)
+
     def _read(self):
         d = None
         try:
             d = os.read(self.input_fileno, MAX_WRITE * 2)
             self.received_any_data = True
         except BlockingIOError:
-            time.sleep(0.200)
+            # When the reactor is running we are only called once the fd is
+            # readable, so there is no need to avoid spinning here.
+            if not self.reactor_running:
+                time.sleep(0.200)
 
         if d:
             self.last_data = time.time()
-            if self.log:
-                self.log.debug('Read: %s' % d)
+            if self.log_debug:
+                self.log.debug('Read: %s', trace.summarize(d))
         return d
 
-    def _write(self, data):
+    def _write(self, *parts, unique=None, priority=None, command=None):
+        # All output goes through the loop thread, so that frames written by
+        # worker threads are never interleaved. A frame may be passed in
+        # several parts, which saves copying large payloads into the frame.
+        # command names the packet being written, for statistics.
+        if (self._loop_thread is not None and
+                threading.get_ident() != self._loop_thread):
+            self.call_soon_threadsafe(
+                lambda: self._write(*parts, unique=unique, priority=priority,
+                                    command=command))
+            return
+
+        # Output from producers and throttled readers is bulk data unless
+        # they say otherwise, everything else is control traffic.
+        context = self._output_context
+        if context:
+            if unique is None:
+                unique = context.unique
+            if priority is None:
+                priority = context.priority
+        if priority is None:
+            priority = PRIORITY_CONTROL
+        if unique is not None and self._bulk_frames_queued[unique]:
+            priority = PRIORITY_BULK
+
+        parts = [memoryview(data) for data in parts if data]
+        if not parts:
+            return
+        queue = self._output_queues[priority]
+        size = 0
+        for data in parts:
+            queue.append([data, False, unique])
+            size += len(data)
+        queue[-1][1] = True
+        if self.trace is not None:
+            head = parts[0]
+            if len(head) < trace.TRACE_HEAD_BYTES:
+                head = b''.join(
+                    bytes(data[:trace.TRACE_HEAD_BYTES]) for data in parts)
+            self.trace.record('out', head, size)
+        self._output_queued += size
+        self.output_counters['bytes'] += size
+        if command:
+            self.stats.sent(command, size)
+        self.stats.observe('output-queued', self._output_queued)
+        if priority != PRIORITY_CONTROL:
+            self._bulk_frames_queued[unique] += 1
+        self.output_counters['frames'] += 1
+
+        if self.reactor_running:
+            # The loop flushes at the end of each iteration, unless enough has
+            # queued up to be worth flushing now.
+            if self._output_queued >= COALESCE_THRESHOLD:
+                self._flush_output()
+            return
+
+        # Without the reactor nothing will flush the queue later, so wait
+        # for the channel to accept the data, unless we have been told the
+        # reactor is about to start.
+        self._flush()
+        if self.write_timeout is not None:
+            self._drain(self.write_timeout)
+
+    def _output_pending(self):
+        for queue in self._output_queues:
+            if queue:
+                return True
+        return False
+
+    def _drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._output_pending():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._discard_output()
+                return
+            select.select([], [self.output_fileno], [], remaining)
+            self._flush()
+
+    def _discard_output(self):
+        if self.log:
+            self.log.info(
+                'Discarded %d bytes of output as the channel is not '
+                'accepting writes, no connection?' % self._output_queued)
+        self.stats.increment('dropped-bytes', self._output_queued)
+        for queue in self._output_queues:
+            self.stats.increment(
+                'dropped-frames', sum(1 for e in queue if e[1]))
+            queue.clear()
+        self._output_queued = 0
+        self._output_frame_open = None
+        self._bulk_frames_queued.clear()
+        self.link.error()
+
+    def _next_output_queue(self):
+        # A partly written frame must be finished before anything else is
+        # sent, otherwise we take from the highest priority queue.
+        if self._output_frame_open is not None:
+            return self._output_frame_open
+        for queue in self._output_queues:
+            if queue:
+                return queue
+        return None
+
+    def _flush(self):
+        control = self._output_queues[PRIORITY_CONTROL]
+        queue = self._next_output_queue()
+        while queue:
+            iov = []
+            size = 0
+            for data, end, _ in queue:
+                if size >= MAX_WRITE or len(iov) >= IOV_MAX:
+                    break
+                piece = data[:MAX_WRITE - size]
+                iov.append(piece)
+                size += len(piece)
+                if end and queue is not control and control:
+                    # Let the waiting control traffic go next
+                    break
+
+            try:
+                written = os.writev(self.output_fileno, iov)
+            except BlockingIOError:
+                self.stats.increment('write-stalls')
+                return
+            self.output_counters['write_syscalls'] += 1
+            self._output_queued -= written
+            self._bytes_written += written
+            if written:
+                self._output_stalled_since = None
+
+            while written:
+                entry = queue[0]
+                data, end, unique = entry
+                if written >= len(data):
+                    queue.popleft()
+                    written -= len(data)
+                    self._output_frame_open = None if end else queue
+                    if end and queue is not control:
+                        self._bulk_frames_queued[unique] -= 1
+                        if not self._bulk_frames_queued[unique]:
+                            del self._bulk_frames_queued[unique]
+                else:
+                    entry[0] = data[written:]
+                    written = 0
+                    self._output_frame_open = queue
+
+            queue = self._next_output_queue()
+
+    def _flush_output(self):
+        if self._output_paused:
+            return
+        self._flush()
+        if self._output_pending() and not self._waiting_for_writable:
+            self.register_fd(self.output_fileno, self._output_ready,
+                             selectors.EVENT_WRITE)
+            self._waiting_for_writable = True
+
+    def _output_ready(self, fd, mask):
+        written = self._bytes_written
+        self._flush()
+        if not self._output_pending():
+            self.unregister_fd(self.output_fileno, selectors.EVENT_WRITE)
+            self._waiting_for_writable = False
+        elif self._input_hungup and self._bytes_written == written:
+            # The other end has gone away, and the hangup makes the channel
+            # look writable even though writes fail. Rather than spin, stop
+            # watching it and try again later, as we do for input.
+            self.unregister_fd(self.output_fileno, selectors.EVENT_WRITE)
+            self._waiting_for_writable = False
+            self._output_paused = True
+            if self._output_stalled_since is None:
+                self._output_stalled_since = time.monotonic()
+            self.add_timer(RECONNECT_DELAY, self._resume_output)
+
+    def _resume_output(self):
+        self._output_paused = False
+        if (self._output_stalled_since is not None and
+                time.monotonic() - self._output_stalled_since > WRITE_TIMEOUT):
+            # Nobody has been there for a while, so what we queued is stale
+            self._discard_output()
+            self._output_stalled_since = None
+        self._flush_output()
+
+    def _output_refers_to(self, obj):
+        # Whether any output waiting to be written is a view of obj
+        for queue in self._output_queues:
+            for data, _, _ in queue:
+                if data.obj is obj:
+                    return True
+        return False
+
+    def output_backlogged(self):
+        return self._output_queued >= MAX_QUEUED_OUTPUT
+
+    # Producers send bulk data without starving the rest of the agent. When the
+    # reactor is running they are advanced a piece at a time while the output
+    # queue has space and their window is open, otherwise they run to
+    # completion immediately.
+    def add_producer(self, generator, unique=None, window=None,
+                     priority=PRIORITY_BULK, offset=0):
+        return self.start_producer(
+            Producer(generator, unique=unique, window=window,
+                     priority=priority, offset=offset))
+
+    def start_producer(self, producer):
+        # A producer may be started again with a new generator, keeping its
+        # window.
+        if not self.reactor_running:
+            self._output_context = producer
+            try:
+                for sent in producer.generator:
+                    producer.sent += sent
+            finally:
+                self._output_context = None
+            return producer
+
+        self._producers.append(producer)
+        return producer
+
+    def remove_producer(self, producer):
+        if producer in self._producers:
+            self._producers.remove(producer)
+        producer.generator.close()
+
+    def _runnable_producers(self):
+        if self.output_backlogged():
+            return []
+        runnable = [p for p in self._producers if not p.blocked()]
+        return sorted(runnable, key=lambda p: p.priority)
+
+    def _run_producers(self):
+        for producer in self._runnable_producers():
+            if self.output_backlogged():
+                return
+            self._output_context = producer
+            try:
+                producer.sent += next(producer.generator)
+            except StopIteration:
+                self._producers.remove(producer)
+            except Exception as e:
+                self.remove_producer(producer)
+                self._request_failed(producer.unique, 'producer', e)
+            finally:
+                self._output_context = None
+
+    # Throttled readers are fds which produce output for the peer, such as the
+    # pipes of a running command. They are only watched while the output queue
+    # has space and their window (if any) is open, so that a fast source
+    # blocks instead of filling memory.
+    def register_throttled_reader(self, fd, callback, producer=None):
+        if not producer:
+            producer = Producer(None)
+        self._throttled_readers[fd] = {
+            'callback': callback,
+            'producer': producer,
+            'registered': False
+        }
+        self._update_throttled_readers()
+
+    def _throttled_reader_ready(self, fd, mask):
+        reader = self._throttled_readers.get(fd)
+        if not reader:
+            return
+        self._output_context = reader['producer']
         try:
-            while data:
-                os.write(self.output_fileno, data[:MAX_WRITE])
-                data = data[MAX_WRITE:]
-        except BlockingIOError:
-            if self.log:
-                self.log.info(
-                    'Discarded write due to non-blocking IO error, no connection?')
-            pass
+            reader['callback'](fd, mask)
+        except Exception as e:
+            self.unregister_throttled_reader(fd)
+            self._request_failed(reader['producer'].unique, 'reader', e)
+        finally:
+            self._output_context = None
+
+    def unregister_throttled_reader(self, fd):
+        reader = self._throttled_readers.pop(fd, None)
+        if reader and reader['registered']:
+            self.unregister_fd(fd, selectors.EVENT_READ)
+
+    def _update_throttled_readers(self):
+        backlogged = self.output_backlogged()
+        for fd, reader in self._throttled_readers.items():
+            paused = backlogged or reader['producer'].blocked()
+            if paused and reader['registered']:
+                self.unregister_fd(fd, selectors.EVENT_READ)
+                reader['registered'] = False
+            elif not paused and not reader['registered']:
+                self.register_fd(fd, self._throttled_reader_ready)
+                reader['registered'] = True
+
+    def _windowed_producers(self):
+        # The producers a window-ack might be for
+        return self._producers + [
+            r['producer'] for r in self._throttled_readers.values()]
+
+    def window_ack(self, packet):
+        for producer in self._windowed_producers():
+            if producer.unique == packet.get('unique'):
+                producer.acknowledged = max(producer.acknowledged,
+                                            packet.get('offset', 0))
+
+    @property
+    def buffer(self):
+        return bytes(self._buffer[self._buffer_start:])
+
+    @buffer.setter
+    def buffer(self, value):
+        self._buffer = bytearray(value)
+        self._buffer_start = 0
+        self._search_offset = 0
 
     def set_fd_nonblocking(self, fd):
         oflags = fcntl.fcntl(fd, fcntl.F_GETFL)
         fcntl.fcntl(fd, fcntl.F_SETFL, oflags | os.O_NONBLOCK)
 
-    def add_command(self, name, meth):
-        if self.log:
-            self.log.debug('Registered command %s' % name)
+    def add_command(self, name, meth, blocking=False, concurrency=None):
+        # blocking may also be a callable, which is passed the packet and
+        # decides if handling that packet might block.
+        if self.log_debug:
+            self.log.debug('Registered command %s', name)
         self._command_map[name] = meth
+        if blocking:
+            self._blocking_commands[name] = blocking
+        else:
+            self._blocking_commands.pop(name, None)
+        if concurrency:
+            self._command_concurrency[name] = concurrency
+
+    def set_command_concurrency(self, name, concurrency):
+        self._command_concurrency[name] = concurrency
 
     def poll(self):
-        if time.time() - self.last_data > 5:
+        if time.time() - self.last_data > self.link.keepalive_interval:
+            # A ping we have not managed to write yet has not been missed,
+            # and there is no point queueing another behind it.
+            ping_queued = self._ping_queued()
+            if self._ping_outstanding and not ping_queued:
+                self.link.ping_missed()
+                self._ping_outstanding = False
+
             pts = self.poll_tasks
             if not pts:
-                pts = [self.send_ping]
+                pts = [] if ping_queued else [self.send_ping]
 
             for pt in pts:
-                if self.log:
+                if self.log_debug:
                     self.log.debug(
-                        'Sending %s poll due to idle connection' % pt)
+                        'Sending %s poll due to idle connection', pt)
                 pt()
             self.last_data = time.time()
 
-    def close(self):
+    # The reactor waits on the channel, any other registered fds, and timers
+    # at once. Callbacks for fds are called with the fd and the event which
+    # occurred, timer callbacks are called with no arguments. A fd may have
+    # different callbacks for reading and writing.
+    def register_fd(self, fd, callback, events=selectors.EVENT_READ):
+        if not self.selector:
+            self.selector = selectors.DefaultSelector()
+
+        try:
+            key = self.selector.get_key(fd)
+        except KeyError:
+            key = None
+
+        callbacks = dict(key.data) if key else {}
+        for event in (selectors.EVENT_READ, selectors.EVENT_WRITE):
+            if events & event:
+                callbacks[event] = callback
+
+        if key:
+            self.selector.modify(fd, key.events | events, callbacks)
+        else:
+            self.selector.register(fd, events, callbacks)
+
+    def unregister_fd(self, fd,
+                      events=selectors.EVENT_READ | selectors.EVENT_WRITE):
+        if not self.selector:
+            return
+        try:
+            key = self.selector.get_key(fd)
+        except (KeyError, ValueError):
+            return
+
+        remaining = key.events & ~events
+        if remaining:
+            callbacks = {e: c for e, c in key.data.items() if e & remaining}
+            self.selector.modify(fd, remaining, callbacks)
+        else:
+            self.selector.unregister(fd)
+
+    def add_timer(self, delay, callback):
+        heapq.heappush(
+            self._timers,
+            (time.monotonic() + delay, next(self._timer_sequence), callback))
+
+    def start_reactor(self, keepalive=True):
+        self.reactor_running = True
+        self._loop_thread = threading.get_ident()
+        if self.stats_log_interval:
+            self.add_timer(self.stats_log_interval, self._log_stats)
+
+        if not self._wakeup_fds:
+            self._wakeup_fds = os.pipe()
+            for fd in self._wakeup_fds:
+                self.set_fd_nonblocking(fd)
+            self.register_fd(self._wakeup_fds[0], self._run_pending_calls)
+
+        self._watch_input()
+        if keepalive:
+            self.add_timer(self.link.keepalive_interval, self._keepalive)
+
+    def stop_reactor(self):
+        self.reactor_running = False
+
+    def call_soon_threadsafe(self, callback):
+        # Run callback on the loop thread, waking the loop if it is waiting.
+        self._pending_calls.append(callback)
+        try:
+            os.write(self._wakeup_fds[1], b'x')
+        except BlockingIOError:
+            # The pipe is full, so the loop will wake anyway
+            pass
+
+    def call_soon(self, callback):
+        # Run callback on the loop thread, now if we are already on it.
+        if (self._loop_thread is not None and
+                threading.get_ident() != self._loop_thread):
+            self.call_soon_threadsafe(callback)
+        else:
+            callback()
+
+    def call_in_worker(self, func, callback):
+        # Run func on a worker thread, and then pass its result to callback
+        # on the loop thread. Without the reactor both run immediately.
+        if not self.reactor_running:
+            callback(func())
+            return
+
+        def _done(f):
+            if f.exception():
+                if self.log:
+                    self.log.with_fields({'error': str(f.exception())}).error(
+                        'Background call raised an error')
+                return
+            callback(f.result())
+
+        f = self._get_executor().submit(func)
+        f.add_done_callback(
+            lambda f: self.call_soon_threadsafe(lambda: _done(f)))
+
+    def _run_pending_calls(self, fd, mask):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self._pending_calls:
+            self._call_safely('Pending call', self._pending_calls.popleft())
+
+    def run_once(self, timeout=None):
+        # Output may have been queued outside the loop
+        self._flush_output()
+        self._update_throttled_readers()
+
+        if self._runnable_producers():
+            timeout = 0
+        elif self._timers:
+            until_timer = max(0, self._timers[0][0] - time.monotonic())
+            if timeout is None or until_timer < timeout:
+                timeout = until_timer
+
+        if self.selector:
+            events = self.selector.select(timeout)
+        else:
+            events = []
+            if timeout:
+                time.sleep(timeout)
+
+        for key, mask in events:
+            for event, callback in list(key.data.items()):
+                if mask & event:
+                    self._call_safely('Callback for fd %d' % key.fd,
+                                      callback, key.fd, event)
+
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            self._call_safely('Timer', callback)
+
+        self._run_producers()
+        self._flush_output()
+        self.link.output_sample(
+            self._bytes_written,
+            bool(self._producers) or self._output_pending())
+
+    def _call_safely(self, what, callback, *args):
+        # An error in one callback must not stop the loop for everything else
+        try:
+            callback(*args)
+        except Exception as e:
+            self.stats.increment('callback-errors')
+            if self.log:
+                self.log.with_fields({'error': str(e)}).error(
+                    '%s raised an error' % what)
+
+    def _request_failed(self, unique, what, e):
+        # A producer or reader for a request raised an error. Tell the peer
+        # the request failed, and release its streams as a cancel would.
+        self.stats.increment('callback-errors')
         if self.log:
+            self.log.with_fields({'error': str(e), 'unique': unique}).error(
+                'A %s raised an error' % what)
+        commands = []
+        for stream in list(self.streams.values()):
+            if unique is not None and stream.unique == unique:
+                commands.append(stream.command)
+                self._call_safely('Cancelling stream %d' % stream.id,
+                                  self._cancel_stream, stream)
+        self.send_packet({
+            'command': 'command-error',
+            'result': False,
+            'message': '%s raised an error: %s' % (
+                ' '.join(commands) or what, e),
+            'unique': unique
+        })
+
+    def run(self):
+        self.start_reactor()
+        while self.reactor_running:
+            self.run_once()
+
+    def _watch_input(self):
+        self.register_fd(self.input_fileno, self._input_ready)
+
+    def _input_ready(self, fd, mask):
+        d = self._read()
+        if d == b'':
+            # A channel with nobody on the other end reads as closed each
+            # time we look, which is only an error the first time.
+            if not self._input_hungup:
+                if self.log_debug:
+                    self.log.debug('Channel closed by remote end, will retry')
+                self.link.error()
+                self._input_hungup = True
+            self.unregister_fd(self.input_fileno, selectors.EVENT_READ)
+            self.add_timer(RECONNECT_DELAY, self._watch_input)
+            return
+
+        if d:
+            self._input_hungup = False
+            self._buffer += d
+            self.stats.increment('bytes-in', len(d))
+            self.stats.observe('input-buffer',
+                               len(self._buffer) - self._buffer_start)
+        for packet in self._buffered_packets():
+            self.dispatch_packet(packet)
+
+    def _buffered_packets(self):
+        # Unlike find_packets(), keep going past packets which fail to decode
+        # as there might be more complete packets after them in the buffer.
+        while True:
+            framed = self._packets_framed
+            packet = self._parse_packet()
+            if packet is not None:
+                yield packet
+            elif framed == self._packets_framed:
+                return
+
+    def _log_stats(self):
+        if self.log:
+            self.log.with_fields(self.stats.snapshot()).info('Agent statistics')
+        self.add_timer(self.stats_log_interval, self._log_stats)
+
+    def _keepalive(self):
+        self.poll()
+        self.add_timer(
+            max(0.1, self.last_data + self.link.keepalive_interval -
+                time.time()),
+            self._keepalive)
+
+    def close(self):
+        if self.log_debug:
             self.log.debug('Cleaning up connection for graceful close.')
+        self.reactor_running = False
+        self._loop_thread = None
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        self._flush()
+        self._drain(CLOSE_WRITE_TIMEOUT)
+        self.unregister_fd(self.input_fileno)
         os.close(self.input_fileno)
-        os.close(self.output_fileno)
+        if self.output_fileno != self.input_fileno:
+            os.close(self.output_fileno)
 
     # Our packet format is:
     #
@@ -98,9 +1019,45 @@ class Agent(object):
     # Where XXXXXXX is a eight character decimal length with zero padding (i.e. 00000100)
     # and YYYY is XXXXXXX bytes of UTF-8 encoded JSON
     PREAMBLE = '*SFv001*'
+    PREAMBLE_BYTES = PREAMBLE.encode('utf-8')
+
+    # Binary frames carry raw file data without JSON or base64 encoding:
+    #
+    #     *SFv002*FSSSSOOOOOOOOLLLLYYYY
+    #
+    # Where F is a one byte flags field, SSSS is a four byte stream id,
+    # OOOOOOOO is an eight byte offset, and LLLL is a four byte length (all
+    # unsigned big endian integers). YYYY is LLLL bytes of raw data. Binary
+    # frames are only sent to a peer which has asked for them, and share the
+    # channel with JSON frames. Stream ids are allocated by the sender of the
+    # data, and announced in a JSON packet before the first binary frame.
+    #
+    # Once a peer has enabled compression with a set-compression packet,
+    # large JSON packets are also sent as binary frames with FLAG_JSON set and
+    # a stream id and offset of zero, so that they can be compressed.
+    BINARY_PREAMBLE = '*SFv002*'
+    BINARY_PREAMBLE_BYTES = BINARY_PREAMBLE.encode('utf-8')
+    BINARY_HEADER = struct.Struct('!BIQI')
+    MAX_BINARY_LENGTH = 0xffffffff
+
+    # Both preambles start with this, which is what we search for
+    PREAMBLE_PREFIX = b'*SFv00'
+
+    def use_json_codec(self, name):
+        self.json_codec = name
+        self._json_dumps, self._json_loads = JSON_CODECS[name]
+
+    def _encode_json(self, p):
+        try:
+            return self._json_dumps(p)
+        except (TypeError, OverflowError):
+            # The faster codecs refuse some things the standard library
+            # accepts, such as very large integers and keys which are not
+            # strings.
+            return _json_dumps(p)
 
-    def send_packet(self, p):
-        j = json.dumps(p)
+    def send_packet(self, p, priority=None):
+        j = self._encode_json(p)
         j_len = len(j)
 
         if j_len > 99999999:
@@ -108,10 +1065,215 @@ class Agent(object):
                 'The maximum packet size is 99,999,999 bytes of UTF-8 encoded JSON. '
                 'This packet is %d bytes.' % j_len)
 
-        packet = '%s[%08d]%s' % (self.PREAMBLE, j_len, j)
-        self._write(packet.encode('utf-8'))
-        if self.log:
-            self.log.debug('Sent: %s' % packet)
+        if self.compression and j_len >= self.compression_threshold:
+            compressed = self._compress(j)
+            if compressed:
+                self._write_binary_frame(FLAG_JSON | compressed[0], 0, 0,
+                                         compressed[1], unique=p.get('unique'),
+                                         priority=priority,
+                                         command=p.get('command'))
+                if self.log_debug:
+                    self.log.debug('Sent (compressed): %s',
+                                   trace.summarize_packet(p))
+                return
+
+        # The header and body are queued separately, so that the body is never
+        # copied.
+        self._write(b'%s[%08d]' % (self.PREAMBLE_BYTES, j_len), j,
+                    unique=p.get('unique'), priority=priority,
+                    command=p.get('command'))
+        if self.log_debug:
+            self.log.debug('Sent: %s', trace.summarize_packet(p))
+
+    def send_binary(self, stream_id, offset, data, flags=0, priority=None):
+        if len(data) > self.MAX_BINARY_LENGTH:
+            raise PacketTooLarge(
+                'The maximum binary frame size is %d bytes. This frame is %d '
+                'bytes.' % (self.MAX_BINARY_LENGTH, len(data)))
+
+        if self.compression and len(data) >= self.compression_threshold:
+            compressed = self._compress(data)
+            if compressed:
+                flags |= compressed[0]
+                data = compressed[1]
+
+        self._write_binary_frame(flags, stream_id, offset, data,
+                                 priority=priority)
+        if self.log_debug:
+            self.log.debug('Sent: binary frame for stream %d, offset %d, '
+                           'length %d', stream_id, offset, len(data))
+
+    def _write_binary_frame(self, flags, stream_id, offset, data,
+                            unique=None, priority=None,
+                            command='binary-chunk'):
+        self._write(
+            self.BINARY_PREAMBLE_BYTES +
+            self.BINARY_HEADER.pack(flags, stream_id, offset, len(data)),
+            data, unique=unique, priority=priority, command=command)
+
+    def _compress(self, data):
+        # Returns the flags and compressed data, or None if compressing did
+        # not make the data smaller.
+        codec_id, compress, _ = COMPRESSION_CODECS[self.compression]
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            return None
+        return codec_id << FLAG_COMPRESSION_SHIFT, compressed
+
+    def set_compression(self, packet):
+        codec = packet.get('codec')
+        if codec is not None and codec not in COMPRESSION_CODECS:
+            self.send_packet({
+                'command': 'set-compression-response',
+                'result': False,
+                'message': 'unsupported codec %s' % codec,
+                'unique': packet.get('unique', str(time.time()))
+            })
+            return
+
+        self.compression = codec
+        self.compression_threshold = packet.get(
+            'threshold', COMPRESSION_THRESHOLD)
+        self.send_packet({
+            'command': 'set-compression-response',
+            'result': True,
+            'codec': codec,
+            'threshold': self.compression_threshold,
+            'unique': packet.get('unique', str(time.time()))
+        })
+
+    def set_json_codec(self, packet):
+        # The response is sent with the new codec, so that the peer knows
+        # when to expect it.
+        codec = packet.get('codec')
+        if codec not in JSON_CODECS:
+            self.send_packet({
+                'command': 'set-json-codec-response',
+                'result': False,
+                'message': 'unsupported codec %s' % codec,
+                'unique': packet.get('unique', str(time.time()))
+            })
+            return
+
+        self.use_json_codec(codec)
+        self.send_packet({
+            'command': 'set-json-codec-response',
+            'result': True,
+            'codec': codec,
+            'unique': packet.get('unique', str(time.time()))
+        })
+
+    def allocate_stream_id(self):
+        return next(self._stream_ids)
+
+    def open_stream(self, command, unique, on_cancel=None):
+        stream = Stream(self.allocate_stream_id(), command, unique,
+                        on_cancel=on_cancel)
+        self.streams[stream.id] = stream
+        return stream
+
+    def close_stream(self, stream):
+        if stream:
+            self.streams.pop(stream.id, None)
+
+    def _cancel_stream(self, stream):
+        stream.cancelled = True
+        self.close_stream(stream)
+        if stream.on_cancel:
+            stream.on_cancel()
+
+    def cancel(self, packet):
+        # Cancel the streams named by id with 'stream', or by the unique of
+        # the request which started them with 'request'. Output already
+        # queued for a cancelled stream is still sent, so the peer should
+        # ignore anything for that stream which arrives after our reply.
+        cancelled = []
+        for stream in list(self.streams.values()):
+            if (stream.id == packet.get('stream') or
+                    ('request' in packet and
+                     stream.unique == packet['request'])):
+                self._cancel_stream(stream)
+                cancelled.append(stream.id)
+
+        response = {
+            'command': 'cancel-response',
+            'result': len(cancelled) > 0,
+            'streams': cancelled,
+            'unique': packet.get('unique', str(time.time()))
+        }
+        if not cancelled:
+            response['message'] = 'no matching stream'
+        self.send_packet(response)
+
+    def get_agent_stats(self, packet):
+        response = {
+            'command': 'get-agent-stats-response',
+            'stats': self.stats.snapshot(),
+            'output': dict(self.output_counters),
+            'link': self.link.snapshot(),
+            'unique': packet.get('unique', str(time.time()))
+        }
+        if packet.get('reset'):
+            self.stats.reset()
+        self.send_packet(response)
+
+    def set_packet_trace(self, packet):
+        # Remember the start of the last size frames sent or received, or
+        # stop tracing if size is zero.
+        size = packet.get('size', 0)
+        if size:
+            self.trace = trace.PacketTrace(size)
+        else:
+            self.trace = None
+        self.send_packet({
+            'command': 'set-packet-trace-response',
+            'result': True,
+            'size': size,
+            'unique': packet.get('unique', str(time.time()))
+        })
+
+    def get_packet_trace(self, packet):
+        response = {
+            'command': 'get-packet-trace-response',
+            'result': self.trace is not None,
+            'unique': packet.get('unique', str(time.time()))
+        }
+        if self.trace is None:
+            response['message'] = 'packet tracing is not enabled'
+        else:
+            response['entries'] = self.trace.dump()
+            if packet.get('clear'):
+                self.trace.clear()
+        self.send_packet(response)
+
+    def log_packet_trace(self):
+        if not self.log:
+            return
+        if self.trace is None:
+            self.log.info('Packet tracing is not enabled')
+            return
+        for entry in self.trace.dump():
+            self.log.with_fields(entry).info('Packet trace')
+
+    def register_binary_stream(self, stream_id, callback):
+        self._binary_streams[stream_id] = callback
+
+    def unregister_binary_stream(self, stream_id):
+        self._binary_streams.pop(stream_id, None)
+
+    def dispatch_binary_chunk(self, packet):
+        callback = self._binary_streams.get(packet['stream'])
+        if not callback:
+            if self.log:
+                self.log.error('Binary frame for unknown stream %d'
+                               % packet['stream'])
+            self.send_packet({
+                'command': 'unknown-stream',
+                'message': '%d is an unknown stream' % packet['stream'],
+                'stream': packet['stream']
+            })
+            return
+        callback(packet)
 
     def find_packets(self):
         packet = self.find_packet()
@@ -122,62 +1284,168 @@ class Agent(object):
     def find_packet(self):
         d = self._read()
         if d:
-            self.buffer += d
+            self._buffer += d
+        return self._parse_packet()
 
-        buffer_as_string = self.buffer.decode('utf-8')
-        offset = buffer_as_string.find(self.PREAMBLE)
-        if offset == -1:
-            return None
+    def _parse_packet(self):
+        buf = self._buffer
+        blen = len(buf)
+
+        # Only search the part of the buffer we haven't already searched
+        prefix_len = len(self.PREAMBLE_PREFIX)
+        while True:
+            offset = buf.find(self.PREAMBLE_PREFIX, self._search_offset)
+            if offset == -1:
+                # The tail of the buffer might be the start of a preamble which
+                # has not finished arriving yet, so we search that again next
+                # time.
+                self._search_offset = max(
+                    self._buffer_start, blen - prefix_len + 1)
+                return None
+            self._search_offset = offset
+
+            if blen < offset + len(self.PREAMBLE_BYTES):
+                return None
+            preamble = buf[offset:offset + len(self.PREAMBLE_BYTES)]
+            if preamble == self.PREAMBLE_BYTES:
+                break
+            if preamble == self.BINARY_PREAMBLE_BYTES:
+                return self._parse_binary_frame(offset)
+
+            # Not a version we understand, keep looking
+            self._search_offset = offset + 1
 
         # Do we have any length characters?
-        blen = len(self.buffer)
         len_end = offset + 17
         if blen < len_end:
             return None
 
         # Find the length of the body of the packet
-        plen = int(buffer_as_string[offset + 9: len_end])
-        if blen < len_end + 1 + plen:
+        plen = int(buf[offset + 9: len_end])
+        body_start = len_end + 1
+        body_end = body_start + plen
+        if blen < body_end:
             return None
 
-        # Extract and parse the body of the packet
-        packet = self.buffer[len_end + 1: len_end + 1 + plen]
-        packet_as_string = packet.decode('utf-8')
-        self.buffer = self.buffer[len_end + 1 + plen:]
+        # Extract and parse the body of the packet. This is the only copy of
+        # the packet body we make.
+        packet = bytes(buf[body_start:body_end])
+        self._consume(body_end)
+        return self._decode_json(packet)
+
+    def _decode_json(self, packet):
         try:
-            return json.loads(packet_as_string)
-        except json.JSONDecodeError:
-            if self.log:
-                self.log.with_fields({'packet': packet_as_string}).error(
-                    'Failed to JSON decode packet')
-            self.send_packet(
-                {
-                    'command': 'json-decode-failure',
-                    'message': ('failed to JSON decode packet: %s'
-                                % packet.decode('utf-8'))
-                })
+            return self._json_loads(packet)
+        except ValueError:
+            pass
 
-    def dispatch_packet(self, packet):
+        # The faster codecs refuse some things the standard library accepts,
+        # such as NaN and very large integers.
+        if self._json_loads is not json.loads:
+            try:
+                return json.loads(packet)
+            except ValueError:
+                pass
+
+        packet_as_string = packet.decode('utf-8', errors='replace')
+        self.stats.increment('decode-failures')
+        self.link.error()
         if self.log:
-            lp = copy.copy(packet)
-            if 'chunk' in lp:
-                lp['chunk'] = '...'
-            self.log.debug('Processing: %s' % lp)
-        command = packet.get('command')
+            self.log.with_fields({'packet': packet_as_string}).error(
+                'Failed to JSON decode packet')
+        self.send_packet(
+            {
+                'command': 'json-decode-failure',
+                'message': ('failed to JSON decode packet: %s'
+                            % packet_as_string)
+            })
 
-        if command in self._command_map:
+    def _parse_binary_frame(self, offset):
+        header_start = offset + len(self.BINARY_PREAMBLE_BYTES)
+        body_start = header_start + self.BINARY_HEADER.size
+        if len(self._buffer) < body_start:
+            return None
+
+        flags, stream_id, data_offset, length = self.BINARY_HEADER.unpack_from(
+            self._buffer, header_start)
+        body_end = body_start + length
+        if len(self._buffer) < body_end:
+            return None
+
+        chunk = bytes(self._buffer[body_start:body_end])
+        self._consume(body_end)
+
+        codec_id = (flags & FLAG_COMPRESSION_MASK) >> FLAG_COMPRESSION_SHIFT
+        if codec_id:
+            if codec_id not in COMPRESSION_CODECS_BY_ID:
+                if self.log:
+                    self.log.error('Frame compressed with unknown codec %d'
+                                   % codec_id)
+                self.send_packet({
+                    'command': 'decompression-failure',
+                    'message': 'unknown compression codec %d' % codec_id
+                })
+                return None
+            name, decompress = COMPRESSION_CODECS_BY_ID[codec_id]
             try:
-                self._command_map[command](packet)
-            except Exception as e:
+                chunk = decompress(chunk)
+            except DECOMPRESSION_ERRORS as e:
+                self.stats.increment('decompression-failures')
+                self.link.error()
                 if self.log:
-                    self.log.with_fields({'error': str(e)}).error(
-                        'Command %s raised an error')
-                self.send_packet(
-                    {
-                        'command': 'command-error',
-                        'message': 'command %s raised an error: %s' % (command, e)
-                    })
-        else:
+                    self.log.error('Failed to decompress %s frame for stream '
+                                   '%d: %s' % (name, stream_id, e))
+                self.send_packet({
+                    'command': 'decompression-failure',
+                    'message': 'failed to decompress %s frame: %s' % (name, e),
+                    'stream': stream_id
+                })
+                return None
+
+        if flags & FLAG_JSON:
+            return self._decode_json(chunk)
+
+        return {
+            'command': 'binary-chunk',
+            'flags': flags,
+            'stream': stream_id,
+            'offset': data_offset,
+            'chunk': chunk
+        }
+
+    def _consume(self, end):
+        # The frame being consumed starts at the current search offset
+        start = self._search_offset
+        self._packets_framed += 1
+        self._last_frame_size = end - start
+        self.stats.increment('frames-parsed')
+        if self.trace is not None:
+            self.trace.record(
+                'in',
+                self._buffer[start:min(end, start + trace.TRACE_HEAD_BYTES)],
+                end - start)
+        self._buffer_start = end
+        self._search_offset = end
+
+        if self._buffer_start == len(self._buffer):
+            self._buffer.clear()
+            self._buffer_start = 0
+            self._search_offset = 0
+        elif (self._buffer_start > COMPACT_THRESHOLD and
+              self._buffer_start > len(self._buffer) // 2):
+            del self._buffer[:self._buffer_start]
+            self._search_offset -= self._buffer_start
+            self._buffer_start = 0
+
+    def dispatch_packet(self, packet):
+        if self.log_debug:
+            self.log.debug('Processing: %s', trace.summarize_packet(packet))
+        command = packet.get('command')
+        size = self._last_frame_size
+        self._last_frame_size = 0
+
+        if command not in self._command_map:
+            self.stats.increment('unknown-commands')
             if self.log:
                 self.log.error('Could not find command "%s" in %s'
                                % (command, self._command_map.keys()))
@@ -186,28 +1454,108 @@ class Agent(object):
                     'command': 'unknown-command',
                     'message': '%s is an unknown command' % command
                 })
+            return
+
+        blocking = self._blocking_commands.get(command, False)
+        if callable(blocking):
+            blocking = blocking(packet)
+        if not blocking or not self.reactor_running:
+            self.stats.handled(command, size, *self._run_command(command, packet))
+            return
+
+        limit = self._command_concurrency.get(
+            command, DEFAULT_COMMAND_CONCURRENCY)
+        if self._commands_running[command] >= limit:
+            self._commands_waiting[command].append((packet, size))
+            return
+        self._start_worker(command, packet, size)
+
+    def _run_command(self, command, packet):
+        # Returns how long the handler took, and if it raised an error
+        start = time.monotonic()
+        error = False
+        try:
+            self._command_map[command](packet)
+        except Exception as e:
+            error = True
+            if self.log:
+                self.log.with_fields({'error': str(e)}).error(
+                    'Command %s raised an error' % command)
+            self.send_packet(
+                {
+                    'command': 'command-error',
+                    'message': 'command %s raised an error: %s' % (command, e)
+                })
+        return time.monotonic() - start, error
+
+    def _get_executor(self):
+        if not self._executor:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+        return self._executor
+
+    def _start_worker(self, command, packet, size):
+        self._commands_running[command] += 1
+        f = self._get_executor().submit(self._run_command, command, packet)
+        f.add_done_callback(
+            lambda f: self.call_soon_threadsafe(
+                lambda: self._worker_finished(command, size, f)))
+
+    def _worker_finished(self, command, size, f):
+        # Statistics are only updated on the loop thread, so the worker's
+        # timing is recorded here.
+        if not f.exception():
+            self.stats.handled(command, size, *f.result())
+        self._commands_running[command] -= 1
+        if self._commands_waiting[command]:
+            self._start_worker(
+                command, *self._commands_waiting[command].popleft())
 
     def noop(self, packet):
         return
 
     def log_error_packet(self, packet):
+        self.link.error()
         if self.log:
             self.log.with_fields(packet).error('Received a packet indicating an error')
 
+    # Pings carry the time they were sent, which the other end returns in its
+    # pong so that we can measure the round trip time. The timestamp is only
+    # ever compared with our own clock.
     def send_ping(self, unique=None):
         if not unique:
             unique = random.randint(0, 65535)
 
         self.send_packet({
             'command': 'ping',
-            'unique': unique
+            'unique': unique,
+            'timestamp': time.monotonic()
         })
+        self.link.ping_sent()
+        self._ping_outstanding = True
+        self._ping_unique = unique
+
+    def _ping_queued(self):
+        # Whether our last ping is still waiting to be written
+        return self._ping_outstanding and any(
+            unique == self._ping_unique
+            for _, _, unique in self._output_queues[PRIORITY_CONTROL])
 
     def send_pong(self, packet):
-        self.send_packet({
+        pong = {
             'command': 'pong',
             'unique': packet['unique']
-        })
+        }
+        if 'timestamp' in packet:
+            pong['timestamp'] = packet['timestamp']
+        self.send_packet(pong)
+
+    def pong_received(self, packet):
+        timestamp = packet.get('timestamp')
+        if isinstance(timestamp, (int, float)):
+            self.link.observe_rtt(time.monotonic() - timestamp)
+        self.link.pong_received()
+        self._ping_outstanding = False
 
     def _path_is_a_file(self, command, path, unique):
         if not path:
@@ -241,49 +1589,205 @@ class Agent(object):
 
         return None
 
-    def _send_file(self, command, source_path, destination_path, unique):
+    def _send_file(self, command, source_path, destination_path, unique,
+                   encoding='base64', window=None, offset=0, digest=None,
+                   sparse=False):
+        # If digest names an algorithm, each chunk carries a digest of its
+        # data, and the final packet a digest of the whole file. Transfers may
+        # be resumed part way through a file by passing an offset. If sparse
+        # is set, holes in the file are sent as packets with a hole length
+        # instead of as chunks of zeros.
+        if digest:
+            new_digest(digest)
+        stream = self.open_stream(command, unique)
+
+        def _start(prefix_digest):
+            if stream.cancelled:
+                return
+            producer = self.add_producer(
+                self._send_file_chunks(command, source_path, destination_path,
+                                       unique, encoding, offset, digest,
+                                       sparse, stream, prefix_digest),
+                unique=unique, window=window, offset=offset)
+            stream.on_cancel = lambda: self.remove_producer(producer)
+
+        if not digest or not offset:
+            _start(None)
+            return
+
+        # The digest of the part of the file the peer already has may take
+        # a while to compute, so it is done on a worker thread rather than
+        # holding up the loop. If that fails, the producer tries again and
+        # reports the error.
+        def _digest_prefix():
+            try:
+                with open(source_path, 'rb') as f:
+                    return digest_file(f, digest, end=offset)
+            except OSError:
+                return None
+
+        self.call_in_worker(_digest_prefix, _start)
+
+    def _send_file_chunks(self, command, source_path, destination_path, unique,
+                          encoding, offset, digest, sparse, stream,
+                          prefix_digest):
+        try:
+            yield from self._send_file_stream(
+                command, source_path, destination_path, unique, encoding,
+                offset, digest, sparse, stream, prefix_digest)
+        finally:
+            self.close_stream(stream)
+
+    def _send_file_stream(self, command, source_path, destination_path,
+                          unique, encoding, offset, digest, sparse, stream,
+                          prefix_digest=None):
         st = os.stat(source_path, follow_symlinks=True)
-        self.send_packet({
+        stat_packet = {
             'command': command,
             'result': True,
             'path': destination_path,
-            'stat_result': {
-                'mode': st.st_mode,
-                'size': st.st_size,
-                'uid': st.st_uid,
-                'gid': st.st_gid,
-                'atime': st.st_atime,
-                'mtime': st.st_mtime,
-                'ctime': st.st_ctime
-            },
+            'stat_result': stat_result(st),
+            'stream': stream.id,
             'unique': unique
-        })
+        }
+
+        stream_id = None
+        if encoding == 'binary':
+            stream_id = stream.id
+            stat_packet['encoding'] = 'binary'
+        if offset:
+            stat_packet['offset'] = offset
+        if digest:
+            stat_packet['digest'] = digest
+        if sparse:
+            stat_packet['sparse'] = True
+        self.send_packet(stat_packet)
+
+        transfer = {
+            'command': command,
+            'path': destination_path,
+            'unique': unique,
+            'encoding': encoding,
+            'stream': stream_id,
+            'digest': digest,
+            'file-digest': None,
+            'chunk-digests': []
+        }
+        if encoding == 'binary':
+            chunk_size = self.link.chunk_size(BINARY_CHUNK_SIZE)
+        else:
+            chunk_size = 1024
 
-        offset = 0
         with open(source_path, 'rb') as f:
-            d = f.read(1024)
-            while d:
-                self.send_packet({
-                    'command': command,
-                    'result': True,
-                    'path': destination_path,
-                    'offset': offset,
-                    'encoding': 'base64',
-                    'chunk': base64.b64encode(d).decode('utf-8'),
-                    'unique': unique
-                })
-                offset += len(d)
-                d = f.read(1024)
+            if prefix_digest:
+                transfer['file-digest'] = prefix_digest
+            elif digest:
+                transfer['file-digest'] = digest_file(f, digest, end=offset)
 
-            self.send_packet({
-                'command': command,
-                'result': True,
-                'path': destination_path,
-                'offset': offset,
-                'encoding': 'base64',
-                'chunk': None,
-                'unique': unique
-            })
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or not stat.S_ISREG(st.st_mode):
+                # Files in /proc and /sys claim to be empty, so we can only
+                # read them until we reach the end.
+                f.seek(offset)
+                d = f.read(chunk_size)
+                while d:
+                    self._send_file_chunk(transfer, offset, d)
+                    offset += len(d)
+                    yield len(d)
+                    d = f.read(chunk_size)
+
+            elif offset < size:
+                # Regular files are read with preadv rather than mapped, as a
+                # mapped file which shrinks under us (as logrotate's
+                # copytruncate does) kills the agent with SIGBUS. A read past
+                # the new end of the file just comes up short, and the
+                # transfer ends there. The buffer is reused unless output
+                # still waiting to be written refers to it.
+                buf = None
+                if sparse:
+                    extents = _data_extents(f.fileno(), offset, size)
+                else:
+                    extents = [(offset, size)]
+
+                truncated = False
+                for start, end in extents:
+                    if start > offset:
+                        self._send_file_hole(transfer, offset, start - offset)
+                        yield start - offset
+                    offset = start
+                    while offset < end:
+                        if buf is None or self._output_refers_to(buf):
+                            buf = bytearray(chunk_size)
+                        view = memoryview(buf)[:min(chunk_size, end - offset)]
+                        length = os.preadv(f.fileno(), [view], offset)
+                        if not length:
+                            truncated = True
+                            break
+                        self._send_file_chunk(transfer, offset, view[:length])
+                        offset += length
+                        yield length
+                    if truncated:
+                        break
+
+                if not truncated and offset < size:
+                    self._send_file_hole(transfer, offset, size - offset)
+                    offset = size
+
+        final_packet = {
+            'command': command,
+            'result': True,
+            'path': destination_path,
+            'encoding': encoding,
+            'chunk': None,
+            'offset': offset,
+            'unique': unique
+        }
+        if encoding == 'binary':
+            final_packet['stream'] = stream_id
+        if digest:
+            final_packet['file-digest'] = transfer['file-digest'].hexdigest()
+            if encoding == 'binary':
+                final_packet['chunk-digests'] = transfer['chunk-digests']
+        self.send_packet(final_packet)
+
+    def _send_file_chunk(self, transfer, offset, d):
+        chunk_digest = None
+        if transfer['digest']:
+            transfer['file-digest'].update(d)
+            chunk_digest = hashlib.new(transfer['digest'], d).hexdigest()
+
+        if transfer['encoding'] == 'binary':
+            self.send_binary(transfer['stream'], offset, d)
+            if chunk_digest:
+                # There is no room for a digest in a binary frame
+                transfer['chunk-digests'].append(chunk_digest)
+            return
+
+        packet = {
+            'command': transfer['command'],
+            'result': True,
+            'path': transfer['path'],
+            'offset': offset,
+            'encoding': 'base64',
+            'chunk': base64.b64encode(d).decode('utf-8'),
+            'unique': transfer['unique']
+        }
+        if chunk_digest:
+            packet['chunk-digest'] = chunk_digest
+        self.send_packet(packet)
+
+    def _send_file_hole(self, transfer, offset, length):
+        if transfer['digest']:
+            digest_zeros(transfer['file-digest'], length)
+
+        self.send_packet({
+            'command': transfer['command'],
+            'result': True,
+            'path': transfer['path'],
+            'offset': offset,
+            'hole': length,
+            'unique': transfer['unique']
+        })
 
 
 class SocketAgent(Agent):
@@ -0,0 +1,116 @@
+import collections
+import time
+
+
+# Handler latencies are counted in buckets whose upper bounds are powers of
+# two microseconds. The last bucket also holds everything slower than it.
+LATENCY_BUCKETS = 32
+
+
+class LatencyHistogram(object):
+    """A fixed size histogram of durations. Recording a duration is a few
+    arithmetic operations, so it is cheap enough to do for every packet."""
+
+    def __init__(self):
+        self.buckets = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        if bucket >= LATENCY_BUCKETS:
+            bucket = LATENCY_BUCKETS - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        # The upper bound of the bucket holding the given percentile
+        if not self.count:
+            return None
+        wanted = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                if bucket == LATENCY_BUCKETS - 1:
+                    return self.max
+                return min((1 << bucket) / 1000000, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total-seconds': self.total,
+            'max-seconds': self.max,
+            'p50-seconds': self.percentile(50),
+            'p99-seconds': self.percentile(99),
+            'buckets': {'%dus' % (1 << bucket): count
+                        for bucket, count in enumerate(self.buckets) if count}
+        }
+
+
+class CommandStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes-in': self.bytes_in,
+            'bytes-out': self.bytes_out,
+            'latency': self.latency.snapshot()
+        }
+
+
+class AgentStats(object):
+    """Counters describing what an agent has been doing. Per command
+    statistics are keyed by the command named in each packet, so bytes sent
+    in reply to a get-file are counted against get-file-response, and binary
+    frames against binary-chunk. These are only updated on the loop thread,
+    so there is no locking."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.commands = collections.defaultdict(CommandStats)
+        self.counters = collections.Counter()
+        self.high_water = collections.Counter()
+
+    def handled(self, command, size, seconds, error):
+        s = self.commands[command]
+        s.count += 1
+        s.bytes_in += size
+        s.latency.record(seconds)
+        if error:
+            s.errors += 1
+
+    def sent(self, command, size):
+        self.commands[command].bytes_out += size
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        # Remember the largest value seen
+        if value > self.high_water[name]:
+            self.high_water[name] = value
+
+    def snapshot(self):
+        return {
+            'since': self.since,
+            'commands': {name: s.snapshot()
+                         for name, s in self.commands.items()},
+            'counters': dict(self.counters),
+            'high-water': dict(self.high_water)
+        }
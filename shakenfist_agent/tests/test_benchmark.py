@@ -0,0 +1,52 @@
+import os
+import tempfile
+import testtools
+
+
+from shakenfist_agent.commandline import benchmark
+from shakenfist_agent import protocol
+
+
+class BenchmarkTestCase(testtools.TestCase):
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(50, benchmark._percentile(ordered, 50))
+        self.assertEqual(99, benchmark._percentile(ordered, 99))
+        self.assertEqual(1, benchmark._percentile([1], 99))
+
+    def test_requests_over_socketpair(self):
+        channel = benchmark.BenchmarkChannel('socketpair')
+        try:
+            results = benchmark._run_requests(
+                channel, ['ping', 'stat'], 20, [1, 4])
+        finally:
+            channel.close()
+
+        for kind in ['ping', 'stat']:
+            r = results[kind]['depth-4']
+            self.assertEqual(20, r['requests'])
+            self.assertTrue(r['latency_ms']['p50'] <= r['latency_ms']['p99'])
+
+    def test_transfer_over_pty(self):
+        with tempfile.TemporaryDirectory() as td:
+            channel = benchmark.BenchmarkChannel()
+            try:
+                results = benchmark._run_transfer(
+                    channel, td, [1], ['base64', 'binary'])
+            finally:
+                channel.close()
+            self.assertEqual(['source'], os.listdir(td))
+
+        for enc in ['base64', 'binary']:
+            for operation in ['get-file', 'put-file']:
+                r = results['1MiB'][enc][operation]
+                self.assertEqual(1024 * 1024, r['bytes'])
+                self.assertTrue('cpu_seconds_per_mb' in r)
+
+    def test_codecs(self):
+        for codec in protocol.json_codecs():
+            for packet in benchmark.CODEC_PACKETS.values():
+                frame, _ = benchmark._time_codec_encode(codec, packet, 10)
+                self.assertTrue(frame.startswith(protocol.Agent.PREAMBLE_BYTES))
+                found, _ = benchmark._time_codec_decode(codec, frame, 10, 4096)
+                self.assertEqual(10, found)
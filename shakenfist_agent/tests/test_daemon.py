@@ -1,14 +1,49 @@
+import base64
+import hashlib
+import io
 import json
 import mock
+import os
+import signal
 import string
+import tarfile
 import tempfile
 import testtools
+import threading
 
 
 from shakenfist_agent.commandline import daemon
+from shakenfist_agent import delta
+from shakenfist_agent import facts
+from shakenfist_agent import protocol
 
 
 class DaemonAgentTestCase(testtools.TestCase):
+    def _reactor_agent(self):
+        # An agent on a pty, so that its reactor can watch the channel, which
+        # records the threads that open and close its streams
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        a = daemon.SFFileAgent(os.ttyname(slave))
+        os.close(slave)
+        self.addCleanup(os.close, a.input_fileno)
+        a.start_reactor(keepalive=False)
+
+        threads = set()
+        for name in ('open_stream', 'close_stream'):
+            def _recorded(*args, real=getattr(a, name), **kwargs):
+                threads.add(threading.get_ident())
+                return real(*args, **kwargs)
+            setattr(a, name, _recorded)
+        return a, threads
+
+    def _run_until(self, a, condition):
+        for _ in range(100):
+            if condition():
+                return
+            a.run_once(timeout=0.1)
+        self.fail('timed out waiting for the agent')
+
     @mock.patch('time.time', return_value=1686526181.0196502)
     @mock.patch('psutil.boot_time', return_value=1200)
     @mock.patch('oslo_concurrency.processutils.execute',
@@ -29,6 +64,9 @@ class DaemonAgentTestCase(testtools.TestCase):
                     'command': 'agent-start',
                     'message': 'XXX',
                     'system_boot_time': 1200,
+                    'capabilities': daemon.CAPABILITIES,
+                    'compression': protocol.compression_codecs(),
+                    'json-codecs': protocol.json_codecs(),
                     'unique': '1686526181.0196502'
                 }, out_packet_1)
 
@@ -55,6 +93,9 @@ class DaemonAgentTestCase(testtools.TestCase):
                     'command': 'agent-start',
                     'message': 'XXX',
                     'system_boot_time': 1200,
+                    'capabilities': daemon.CAPABILITIES,
+                    'compression': protocol.compression_codecs(),
+                    'json-codecs': protocol.json_codecs(),
                     'unique': '1686526181.0196502'
                 }, out_packet_1)
 
@@ -84,6 +125,9 @@ class DaemonAgentTestCase(testtools.TestCase):
                         'command': 'agent-start',
                         'message': 'XXX',
                         'system_boot_time': 1200,
+                        'capabilities': daemon.CAPABILITIES,
+                        'compression': protocol.compression_codecs(),
+                        'json-codecs': protocol.json_codecs(),
                         'unique': '1686526181.0196502'
                     }, out_packet_1)
 
@@ -112,3 +156,900 @@ class DaemonAgentTestCase(testtools.TestCase):
                 self.assertTrue('offset' in out_packet_4)
                 self.assertEqual('base64', out_packet_4['encoding'])
                 self.assertEqual(None, out_packet_4['chunk'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_binary')
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_get_file_binary(self, mock_send_packet, mock_send_binary,
+                             mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.NamedTemporaryFile() as tf2:
+                with open(tf2.name, 'wb') as f:
+                    f.write(b'x' * (protocol.BINARY_CHUNK_SIZE + 10))
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'get-file', 'path': tf2.name,
+                                   'encoding': 'binary'})
+
+                stat_packet = mock_send_packet.mock_calls[1].args[0]
+                self.assertEqual('binary', stat_packet['encoding'])
+                stream_id = stat_packet['stream']
+
+                self.assertEqual(2, len(mock_send_binary.mock_calls))
+                self.assertEqual(
+                    (stream_id, 0),
+                    mock_send_binary.mock_calls[0].args[:2])
+                self.assertEqual(
+                    (stream_id, protocol.BINARY_CHUNK_SIZE, b'x' * 10),
+                    mock_send_binary.mock_calls[1].args)
+
+                final_packet = mock_send_packet.mock_calls[2].args[0]
+                self.assertEqual(None, final_packet['chunk'])
+                self.assertEqual(stream_id, final_packet['stream'])
+                self.assertEqual(protocol.BINARY_CHUNK_SIZE + 10,
+                                 final_packet['offset'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_put_file_binary(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'u',
+                    'stat_result': {'size': 10}, 'encoding': 'binary',
+                    'stream': 12})
+                for offset, chunk in [(0, b'01234'), (5, b'56789')]:
+                    a.dispatch_packet({
+                        'command': 'binary-chunk', 'flags': 0, 'stream': 12,
+                        'offset': offset, 'chunk': chunk})
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'u',
+                    'chunk': None, 'stream': 12})
+
+                with open(path, 'rb') as f:
+                    self.assertEqual(b'0123456789', f.read())
+                self.assertEqual(
+                    'put-file-response',
+                    mock_send_packet.mock_calls[-1].args[0]['command'])
+                self.assertEqual({}, a._binary_streams)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_execute_streaming(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            a = daemon.SFFileAgent(tf.name)
+            a.dispatch_packet({
+                'command': 'execute',
+                'command-line': 'echo hello; echo oops >&2; echo world; exit 3',
+                'stream-output': True,
+                'unique': 'u'
+            })
+
+            def final_packets():
+                return [c.args[0] for c in mock_send_packet.mock_calls
+                        if c.args[0]['command'] == 'execute-response']
+
+            for _ in range(100):
+                if final_packets():
+                    break
+                a.run_once(timeout=0.1)
+
+            output = {'stdout': '', 'stderr': ''}
+            streams = set()
+            for c in mock_send_packet.mock_calls:
+                if c.args[0]['command'] == 'execute-output':
+                    self.assertEqual('u', c.args[0]['unique'])
+                    output[c.args[0]['fd']] += c.args[0]['output']
+                    streams.add(c.args[0]['stream'])
+            self.assertEqual('hello\nworld\n', output['stdout'])
+            self.assertEqual('oops\n', output['stderr'])
+
+            self.assertEqual(1, len(final_packets()))
+            self.assertEqual({final_packets()[0]['stream']}, streams)
+            self.assertEqual(3, final_packets()[0]['return-code'])
+            self.assertEqual(False, final_packets()[0]['result'])
+            self.assertEqual({}, a._throttled_readers)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_execute_background(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            a = daemon.SFFileAgent(tf.name)
+            a.dispatch_packet({
+                'command': 'execute',
+                'command-line': 'exit 2',
+                'block-for-result': False,
+                'unique': 'u'
+            })
+
+            started = mock_send_packet.mock_calls[1].args[0]
+            self.assertEqual('execute-response', started['command'])
+            self.assertIn(started['stream'], a.streams)
+
+            for _ in range(100):
+                if a.supervisor.children:
+                    a.run_once(timeout=0.1)
+
+            complete = mock_send_packet.mock_calls[2].args[0]
+            self.assertEqual('execute-complete', complete['command'])
+            self.assertEqual(started['pid'], complete['pid'])
+            self.assertEqual(started['stream'], complete['stream'])
+            self.assertEqual(2, complete['return-code'])
+            self.assertEqual(False, complete['result'])
+            self.assertEqual('u', complete['unique'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_watch_file_window(self, mock_send_packet, mock_boot_time):
+        def chunk_offsets():
+            offsets = [c.args[0]['offset'] for c in mock_send_packet.mock_calls
+                       if c.args[0].get('chunk')]
+            mock_send_packet.reset_mock()
+            return offsets
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'log')
+                with open(path, 'wb') as f:
+                    f.write(b'')
+
+                a = daemon.SFFileAgent(tf.name)
+                a.reactor_running = True
+                a.dispatch_packet({'command': 'watch-file', 'path': path,
+                                   'unique': 'u', 'window': 4})
+
+                with open(path, 'ab') as f:
+                    f.write(b'abcdefgh')
+                a.run_once(timeout=1)
+                self.assertEqual([0], chunk_offsets())
+
+                a.dispatch_packet({'command': 'window-ack', 'unique': 'u',
+                                   'offset': 8})
+                a.run_once(timeout=0)
+
+                # Later reads, started by inotify, keep the window
+                with open(path, 'ab') as f:
+                    f.write(b'ijklmnop')
+                a.run_once(timeout=1)
+                self.assertEqual([8], chunk_offsets())
+                with open(path, 'ab') as f:
+                    f.write(b'qrstuvwx')
+                a.run_once(timeout=1)
+                self.assertEqual([], chunk_offsets())
+
+                a.dispatch_packet({'command': 'window-ack', 'unique': 'u',
+                                   'offset': 16})
+                a.run_once(timeout=0)
+                self.assertEqual([16], chunk_offsets())
+                a.dispatch_packet({'command': 'unwatch-file', 'path': path,
+                                   'unique': 'v'})
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_watch_file(self, mock_send_packet, mock_boot_time):
+        def watch_packets():
+            packets = []
+            for c in mock_send_packet.mock_calls:
+                p = c.args[0]
+                if p['command'] == 'watch-file-response':
+                    if p.get('chunk'):
+                        p = dict(p)
+                        p['chunk'] = base64.b64decode(p['chunk'])
+                    packets.append(p)
+            mock_send_packet.reset_mock()
+            return packets
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'log')
+                with open(path, 'wb') as f:
+                    f.write(b'before\n')
+
+                a = daemon.SFFileAgent(tf.name)
+                mock_send_packet.reset_mock()
+
+                a.dispatch_packet({'command': 'watch-file', 'path': path,
+                                   'unique': 'u'})
+                packets = watch_packets()
+                self.assertEqual(1, len(packets))
+                self.assertEqual(True, packets[0]['result'])
+                self.assertEqual(7, packets[0]['offset'])
+
+                # Appended data
+                with open(path, 'ab') as f:
+                    f.write(b'after\n')
+                a.run_once(timeout=1)
+                packets = watch_packets()
+                self.assertEqual(b'after\n', packets[0]['chunk'])
+                self.assertEqual(7, packets[0]['offset'])
+
+                # Truncation
+                with open(path, 'wb') as f:
+                    f.write(b'new\n')
+                a.run_once(timeout=1)
+                packets = watch_packets()
+                self.assertEqual('truncated', packets[0]['event'])
+                self.assertEqual(b'new\n', packets[1]['chunk'])
+                self.assertEqual(0, packets[1]['offset'])
+
+                # Rotation, with the new file created later
+                os.rename(path, path + '.1')
+                with open(path + '.1', 'ab') as f:
+                    f.write(b'last\n')
+                a.run_once(timeout=1)
+                a.run_once(timeout=0)
+                packets = watch_packets()
+                self.assertEqual(b'last\n', packets[0]['chunk'])
+
+                with open(path, 'wb') as f:
+                    f.write(b'rotated\n')
+                a.run_once(timeout=1)
+                packets = watch_packets()
+                self.assertEqual('reopened', packets[0]['event'])
+                self.assertEqual(b'rotated\n', packets[1]['chunk'])
+
+                a.dispatch_packet({'command': 'unwatch-file', 'path': path,
+                                   'unique': 'u'})
+                packets = watch_packets()
+                self.assertEqual(None, packets[0]['chunk'])
+                self.assertEqual({}, a.watched_files)
+                self.assertEqual({}, a._watch_descriptors)
+                self.assertEqual({}, a._directory_watches)
+                a.inotify.close()
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_get_file_digest_and_offset(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.NamedTemporaryFile() as tf2:
+                data = os.urandom(5000)
+                with open(tf2.name, 'wb') as f:
+                    f.write(data)
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'get-file', 'path': tf2.name,
+                                   'offset': 3000, 'digest': 'sha256'})
+
+                packets = [c.args[0] for c in mock_send_packet.mock_calls[1:]]
+                self.assertEqual(3000, packets[0]['offset'])
+                self.assertEqual('sha256', packets[0]['digest'])
+
+                received = b''
+                for p in packets[1:-1]:
+                    chunk = base64.b64decode(p['chunk'])
+                    self.assertEqual(3000 + len(received), p['offset'])
+                    self.assertEqual(hashlib.sha256(chunk).hexdigest(),
+                                     p['chunk-digest'])
+                    received += chunk
+                self.assertEqual(data[3000:], received)
+                self.assertEqual(hashlib.sha256(data).hexdigest(),
+                                 packets[-1]['file-digest'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sparse_get_and_put_file(self, mock_send_packet, mock_boot_time):
+        head = os.urandom(4096)
+        tail = os.urandom(4096)
+        size = 4 * 1024 * 1024 + 8192
+        expected = head + bytes(size - 8192) + tail
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                source = os.path.join(td, 'source')
+                with open(source, 'wb') as f:
+                    f.write(head)
+                    f.seek(size - 4096)
+                    f.write(tail)
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'get-file', 'path': source,
+                                   'unique': 'u', 'sparse': True,
+                                   'digest': 'sha256'})
+                packets = [c.args[0] for c in mock_send_packet.mock_calls[1:]]
+                self.assertEqual(True, packets[0]['sparse'])
+                self.assertEqual(size, packets[-1]['offset'])
+                self.assertEqual(hashlib.sha256(expected).hexdigest(),
+                                 packets[-1]['file-digest'])
+
+                holes = [p for p in packets if 'hole' in p]
+                with open(source, 'rb') as f:
+                    supports_holes = (
+                        os.lseek(f.fileno(), 0, os.SEEK_HOLE) < size)
+                if supports_holes:
+                    self.assertEqual(
+                        [{'command': 'get-file-response', 'result': True,
+                          'path': source, 'offset': 4096,
+                          'hole': size - 8192, 'unique': 'u'}], holes)
+
+                # Send the same packets back as a put to a new file
+                destination = os.path.join(td, 'destination')
+                for p in packets:
+                    p = dict(p, command='put-file', path=destination)
+                    a.dispatch_packet(p)
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('put-file-response', done['command'])
+                self.assertEqual(True, done['result'])
+                self.assertEqual(packets[-1]['file-digest'],
+                                 done['file-digest'])
+                with open(destination, 'rb') as f:
+                    self.assertEqual(expected, f.read())
+                if supports_holes:
+                    self.assertLess(os.stat(destination).st_blocks * 512,
+                                    size)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_put_file_resume_with_digests(self, mock_send_packet,
+                                          mock_boot_time):
+        data = os.urandom(4096)
+
+        def chunk_packet(path, offset, d, digest=None):
+            return {
+                'command': 'put-file', 'path': path, 'unique': 'u',
+                'offset': offset, 'encoding': 'base64',
+                'chunk': base64.b64encode(d).decode('utf-8'),
+                'chunk-digest': digest or hashlib.sha256(d).hexdigest()
+            }
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                a = daemon.SFFileAgent(tf.name)
+
+                # First attempt, which sends a corrupt second chunk
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'u',
+                    'stat_result': {'size': 4096}, 'digest': 'sha256'})
+                a.dispatch_packet(chunk_packet(path, 0, data[:1024]))
+                a.dispatch_packet(chunk_packet(path, 1024, data[1024:2048],
+                                               digest='nope'))
+                error = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual(False, error['result'])
+                self.assertEqual(1024, error['offset'])
+
+                # Ask how much is there
+                a.dispatch_packet({
+                    'command': 'verify-file', 'path': path, 'unique': 'v',
+                    'block-size': 512,
+                    'block-digests': [
+                        hashlib.sha256(data[i:i + 512]).hexdigest()
+                        for i in range(0, 4096, 512)],
+                    'digest': 'sha256'})
+                status = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('verify-file-response', status['command'])
+                self.assertEqual(1024, status['verified-offset'])
+
+                # Resume from there
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'u',
+                    'stat_result': {'size': 4096}, 'digest': 'sha256',
+                    'offset': 1024})
+                for offset in range(1024, 4096, 1024):
+                    a.dispatch_packet(
+                        chunk_packet(path, offset, data[offset:offset + 1024]))
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'u',
+                    'chunk': None,
+                    'file-digest': hashlib.sha256(data).hexdigest()})
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('put-file-response', done['command'])
+                self.assertEqual(True, done['result'])
+                self.assertEqual(hashlib.sha256(data).hexdigest(),
+                                 done['file-digest'])
+                with open(path, 'rb') as f:
+                    self.assertEqual(data, f.read())
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_verify_file_block_digests(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.NamedTemporaryFile() as tf2:
+                with open(tf2.name, 'wb') as f:
+                    f.write(b'a' * 1500)
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'verify-file', 'path': tf2.name,
+                                   'block-size': 1000})
+                status = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual(1500, status['size'])
+                self.assertEqual(
+                    [hashlib.blake2b(b'a' * 1000).hexdigest(),
+                     hashlib.blake2b(b'a' * 500).hexdigest()],
+                    status['block-digests'])
+
+    @mock.patch('shakenfist_agent.commandline.daemon.SIGNATURES_PER_PACKET', 8)
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sync_file_signatures_streamed(self, mock_send_packet,
+                                           mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.NamedTemporaryFile() as target:
+                data = os.urandom(4096 * 20)
+                target.write(data)
+                target.flush()
+
+                a = daemon.SFFileAgent(tf.name)
+                mock_send_packet.reset_mock()
+                a.dispatch_packet({'command': 'sync-file', 'path': target.name,
+                                   'unique': 'u'})
+                packets = [c.args[0] for c in mock_send_packet.mock_calls]
+                self.assertEqual([0, 8, 16],
+                                 [p['first-block'] for p in packets])
+                self.assertEqual([False, False, True],
+                                 [p['complete'] for p in packets])
+                with open(target.name, 'rb') as f:
+                    self.assertEqual(
+                        [list(sig) for sig in delta.signatures(f)],
+                        [list(sig) for p in packets
+                         for sig in p['signatures']])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sync_file(self, mock_send_packet, mock_boot_time):
+        old = os.urandom(4096 * 20)
+        new = old[:10000] + b'changed' + old[10000:]
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                with open(path, 'wb') as f:
+                    f.write(old)
+                os.chmod(path, 0o751)
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'sync-file', 'path': path,
+                                   'unique': 'u'})
+                sigs = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('sync-file-response', sigs['command'])
+                self.assertEqual(20, len(sigs['signatures']))
+
+                # Round trip the signatures through JSON as the host would
+                ops = delta.compute_delta(
+                    json.loads(json.dumps(sigs['signatures'])), new,
+                    block_size=sigs['block-size'])
+                a.dispatch_packet({'command': 'sync-file-delta', 'path': path,
+                                   'unique': 'u', 'ops': ops[:1]})
+                a.dispatch_packet({
+                    'command': 'sync-file-delta', 'path': path, 'unique': 'u',
+                    'ops': ops[1:], 'complete': True, 'digest': 'sha256',
+                    'file-digest': hashlib.sha256(new).hexdigest()})
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('sync-file-delta-response', done['command'])
+                self.assertEqual(True, done['result'])
+                with open(path, 'rb') as f:
+                    self.assertEqual(new, f.read())
+                self.assertEqual(0o751, os.stat(path).st_mode & 0o7777)
+                self.assertEqual(['target'], os.listdir(td))
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sync_file_bad_digest(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                with open(path, 'wb') as f:
+                    f.write(b'old')
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({
+                    'command': 'sync-file-delta', 'path': path, 'unique': 'u',
+                    'ops': delta.compute_delta([], b'new'), 'complete': True,
+                    'digest': 'sha256', 'file-digest': 'nope'})
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual(False, done['result'])
+                with open(path, 'rb') as f:
+                    self.assertEqual(b'old', f.read())
+                self.assertEqual(['target'], os.listdir(td))
+                self.assertEqual({}, a.incomplete_file_syncs)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sync_file_rename_fails(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                os.makedirs(os.path.join(path, 'child'))
+
+                a = daemon.SFFileAgent(tf.name)
+                closed = []
+                real_close = os.close
+
+                def _close(fd):
+                    closed.append(fd)
+                    real_close(fd)
+
+                with mock.patch('os.close', side_effect=_close):
+                    a.dispatch_packet({
+                        'command': 'sync-file-delta', 'path': path,
+                        'unique': 'u', 'ops': delta.compute_delta([], b'new'),
+                        'complete': True})
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual(False, done['result'])
+                self.assertIn('Is a directory', done['message'])
+                self.assertEqual(len(set(closed)), len(closed))
+                self.assertEqual(['target'], os.listdir(td))
+                self.assertEqual({}, a.incomplete_file_syncs)
+
+    @testtools.skipUnless(os.geteuid() == 0, 'changing owners needs root')
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_sync_file_keeps_owner(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                with open(path, 'wb') as f:
+                    f.write(b'old')
+                os.chown(path, 1234, 5678)
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({
+                    'command': 'sync-file-delta', 'path': path, 'unique': 'u',
+                    'ops': delta.compute_delta([], b'new'), 'complete': True})
+
+                self.assertEqual(
+                    True, mock_send_packet.mock_calls[-1].args[0]['result'])
+                st = os.stat(path)
+                self.assertEqual((1234, 5678), (st.st_uid, st.st_gid))
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_get_and_put_tree(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                source = os.path.join(td, 'source')
+                os.makedirs(os.path.join(source, 'sub', 'empty'))
+                with open(os.path.join(source, 'sub', 'script'), 'w') as f:
+                    f.write('#!/bin/sh\n')
+                os.chmod(os.path.join(source, 'sub', 'script'), 0o750)
+                os.utime(os.path.join(source, 'sub', 'script'), (1000, 1000))
+                with open(os.path.join(source, 'debug.log'), 'w') as f:
+                    f.write('noise')
+                os.symlink('sub/script', os.path.join(source, 'link'))
+
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'get-tree', 'path': source,
+                                   'exclude': ['*.log'], 'unique': 'u'})
+
+                def tree_packets():
+                    return [c.args[0] for c in mock_send_packet.mock_calls
+                            if c.args[0]['command'] == 'get-tree-response']
+
+                for _ in range(100):
+                    if tree_packets()[-1].get('chunk', '') is None:
+                        break
+                    a.run_once(timeout=0.1)
+
+                packets = tree_packets()
+                self.assertEqual(True, packets[-1]['result'])
+                self.assertEqual([], packets[-1]['errors'])
+                self.assertEqual(5, packets[-1]['entries'])
+                self.assertEqual({}, a._throttled_readers)
+
+                # Send the archive back to replace an existing tree
+                destination = os.path.join(td, 'destination')
+                os.makedirs(os.path.join(destination, 'stale'))
+                a.dispatch_packet({'command': 'put-tree', 'path': destination,
+                                   'unique': 'p'})
+                for p in packets[1:]:
+                    a.dispatch_packet(dict(p, command='put-tree', unique='p',
+                                           path=destination))
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('put-tree-response', done['command'])
+                self.assertEqual(True, done['result'])
+                self.assertEqual(
+                    ['link', 'sub'], sorted(os.listdir(destination)))
+                self.assertEqual(
+                    'sub/script',
+                    os.readlink(os.path.join(destination, 'link')))
+                st = os.stat(os.path.join(destination, 'sub', 'script'))
+                self.assertEqual(0o750, st.st_mode & 0o7777)
+                self.assertEqual(1000, st.st_mtime)
+                self.assertTrue(
+                    os.path.isdir(os.path.join(destination, 'sub', 'empty')))
+                self.assertEqual(['destination', 'source'],
+                                 sorted(os.listdir(td)))
+                self.assertEqual({}, a.incomplete_tree_puts)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_put_tree_streams_on_loop_thread(self, mock_send_packet,
+                                             mock_boot_time):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('file')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'hello'))
+
+        with tempfile.TemporaryDirectory() as td:
+            destination = os.path.join(td, 'destination')
+            a, threads = self._reactor_agent()
+            a.dispatch_packet({'command': 'put-tree', 'path': destination,
+                               'unique': 'p'})
+            a.dispatch_packet({
+                'command': 'put-tree', 'unique': 'p', 'offset': 0,
+                'chunk': base64.b64encode(archive.getvalue()).decode()})
+            a.dispatch_packet({'command': 'put-tree', 'unique': 'p',
+                               'chunk': None})
+            self._run_until(
+                a, lambda: mock_send_packet.mock_calls[-1].args[0][
+                    'command'] == 'put-tree-response')
+
+            done = mock_send_packet.mock_calls[-1].args[0]
+            self.assertEqual(True, done['result'])
+            self.assertEqual(1, done['entries'])
+            with open(os.path.join(destination, 'file'), 'rb') as f:
+                self.assertEqual(b'hello', f.read())
+            self.assertEqual({}, a.streams)
+            self.assertEqual({threading.get_ident()}, threads)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_batch(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                a = daemon.SFFileAgent(tf.name)
+                conf = os.path.join(td, 'etc', 'app.conf')
+                operations = [
+                    {'op': 'mkdir', 'path': os.path.dirname(conf),
+                     'parents': True},
+                    {'op': 'write', 'path': conf, 'mode': 0o600,
+                     'data': base64.b64encode(b'setting=1\n').decode('utf-8')},
+                    {'op': 'chmod', 'path': conf, 'mode': 'g+r'},
+                    {'op': 'symlink', 'target': conf,
+                     'path': os.path.join(td, 'current')},
+                    {'op': 'stat', 'path': os.path.join(td, 'current')},
+                    {'op': 'execute', 'command-line': 'cat %s' % conf},
+                    {'op': 'rename', 'source': conf,
+                     'destination': conf + '.old'},
+                    {'op': 'unlink', 'path': os.path.join(td, 'missing')},
+                    {'op': 'unlink', 'path': os.path.join(td, 'current')}
+                ]
+
+                a.dispatch_packet({'command': 'batch', 'unique': 'u',
+                                   'operations': operations})
+                response = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('batch-response', response['command'])
+                self.assertEqual(False, response['result'])
+                self.assertEqual(8, response['completed'])
+                self.assertEqual(
+                    [True] * 7 + [False],
+                    [r['result'] for r in response['results']])
+                self.assertEqual(0o640, response['results'][4]['stat_result']
+                                 ['mode'] & 0o7777)
+                self.assertEqual('setting=1\n',
+                                 response['results'][5]['stdout'])
+                self.assertTrue(os.path.exists(conf + '.old'))
+                self.assertTrue(os.path.lexists(os.path.join(td, 'current')))
+
+                # The same failure is skipped over without stop-on-error
+                a.dispatch_packet({'command': 'batch', 'unique': 'u',
+                                   'stop-on-error': False,
+                                   'operations': operations[7:]})
+                response = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual(2, response['completed'])
+                self.assertEqual([False, True],
+                                 [r['result'] for r in response['results']])
+                self.assertFalse(os.path.lexists(os.path.join(td, 'current')))
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_batch_streams_on_loop_thread(self, mock_send_packet,
+                                          mock_boot_time):
+        def responses():
+            return [c.args[0] for c in mock_send_packet.mock_calls
+                    if c.args[0]['command'] == 'batch-response']
+
+        with tempfile.TemporaryDirectory() as td:
+            a, threads = self._reactor_agent()
+            a.dispatch_packet({'command': 'batch', 'unique': 'u',
+                               'operations': [{'op': 'mkdir',
+                                               'path': os.path.join(td, 'd')}]})
+            a.dispatch_packet({'command': 'batch', 'unique': 'v',
+                               'operations': ['mkdir']})
+            self._run_until(a, lambda: len(responses()) == 2)
+
+            results = {r['unique']: r for r in responses()}
+            self.assertEqual(True, results['u']['result'])
+            self.assertTrue(os.path.isdir(os.path.join(td, 'd')))
+            self.assertEqual(False, results['v']['result'])
+            self.assertEqual('operations must be objects',
+                             results['v']['message'])
+            self.assertEqual({}, a.streams)
+            self.assertEqual({threading.get_ident()}, threads)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_cancel_execute(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            a = daemon.SFFileAgent(tf.name)
+            # The shell and its child must both go for the pipes to close
+            a.dispatch_packet({'command': 'execute',
+                               'command-line': 'sleep 30; true',
+                               'stream-output': True, 'unique': 'u'})
+            self.assertEqual(['u'], [s.unique for s in a.streams.values()])
+
+            a.dispatch_packet({'command': 'cancel', 'request': 'u',
+                               'unique': 'c'})
+            cancel = mock_send_packet.mock_calls[-1].args[0]
+            self.assertEqual('cancel-response', cancel['command'])
+            self.assertEqual(True, cancel['result'])
+
+            for _ in range(100):
+                final = mock_send_packet.mock_calls[-1].args[0]
+                if final['command'] == 'execute-response':
+                    break
+                a.run_once(timeout=0.1)
+            self.assertEqual(-signal.SIGKILL, final['return-code'])
+            self.assertEqual({}, a.streams)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_concurrent_puts_to_one_path(self, mock_send_packet,
+                                         mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            with tempfile.TemporaryDirectory() as td:
+                path = os.path.join(td, 'target')
+                a = daemon.SFFileAgent(tf.name)
+                for unique in ('a', 'b'):
+                    a.dispatch_packet({
+                        'command': 'put-file', 'path': path, 'unique': unique,
+                        'stat_result': {'size': 4}})
+                self.assertEqual(2, len(a.incomplete_file_puts))
+
+                a.dispatch_packet({'command': 'cancel', 'request': 'a'})
+                a.dispatch_packet({
+                    'command': 'put-file', 'path': path, 'unique': 'b',
+                    'offset': 0, 'chunk': base64.b64encode(b'data').decode()})
+                a.dispatch_packet({'command': 'put-file', 'path': path,
+                                   'unique': 'b', 'chunk': None})
+
+                done = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual('put-file-response', done['command'])
+                self.assertEqual(4, done['offset'])
+                self.assertEqual({}, a.incomplete_file_puts)
+                self.assertEqual({}, a.streams)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_gather_facts_subscribe(self, mock_send_packet, mock_boot_time):
+        keys = {'rsa': 'ssh-rsa AAAA'}
+        with tempfile.NamedTemporaryFile() as tf:
+            with mock.patch.dict(facts.GATHERERS,
+                                 {'ssh-host-keys': lambda: dict(keys)}):
+                a = daemon.SFFileAgent(tf.name)
+                a.dispatch_packet({'command': 'gather-facts', 'unique': 'u',
+                                   'groups': ['ssh-host-keys'],
+                                   'subscribe': True})
+                response = mock_send_packet.mock_calls[-1].args[0]
+                self.assertEqual({'ssh-host-keys': keys}, response['result'])
+
+                # Unrelated changes, and changes which leave the facts the
+                # same, are not sent
+                a._facts_changed('mounts')
+                a._facts_changed('ssh-host-keys')
+                self.assertEqual(2, len(mock_send_packet.mock_calls))
+
+                keys['ed25519'] = 'ssh-ed25519 AAAA'
+                a._facts_changed('ssh-host-keys')
+                self.assertEqual(
+                    {'command': 'facts-changed',
+                     'changed': {'ssh-host-keys': keys},
+                     'stream': response['stream'], 'unique': 'u'},
+                    mock_send_packet.mock_calls[-1].args[0])
+
+                a.dispatch_packet({'command': 'cancel', 'request': 'u'})
+                self.assertEqual({}, a._facts_subscriptions)
+
+                a.dispatch_packet({'command': 'gather-facts',
+                                   'groups': ['nope']})
+                self.assertEqual(False,
+                                 mock_send_packet.mock_calls[-1].args[0]['result'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_gather_facts_subscribe_on_loop_thread(self, mock_send_packet,
+                                                   mock_boot_time):
+        with mock.patch.dict(facts.GATHERERS, {'ssh-host-keys': dict}):
+            a, threads = self._reactor_agent()
+            a.dispatch_packet({'command': 'gather-facts', 'unique': 'u',
+                               'groups': ['ssh-host-keys'],
+                               'subscribe': True})
+            self._run_until(
+                a, lambda: mock_send_packet.mock_calls[-1].args[0][
+                    'command'] == 'gather-facts-response')
+
+            response = mock_send_packet.mock_calls[-1].args[0]
+            self.assertEqual([response['stream']],
+                             list(a._facts_subscriptions))
+            self.assertEqual({threading.get_ident()}, threads)
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_subscribe_metrics(self, mock_send_packet, mock_boot_time):
+        with tempfile.NamedTemporaryFile() as tf:
+            a = daemon.SFFileAgent(tf.name)
+            a.dispatch_packet({'command': 'subscribe-metrics', 'unique': 'u',
+                               'metrics': ['memory', 'load'], 'interval': 0.01,
+                               'batch': 2})
+            response = mock_send_packet.mock_calls[-1].args[0]
+            self.assertEqual(True, response['result'])
+
+            def metrics_packets():
+                return [c.args[0] for c in mock_send_packet.mock_calls
+                        if c.args[0]['command'] == 'metrics']
+
+            for _ in range(100):
+                if metrics_packets():
+                    break
+                a.run_once(timeout=0.01)
+
+            packet = metrics_packets()[0]
+            self.assertEqual(response['stream'], packet['stream'])
+            self.assertEqual(2, len(packet['samples']))
+            self.assertEqual(['load', 'memory', 'time'],
+                             sorted(packet['samples'][0]))
+            self.assertTrue(packet['sample-cost'] >= 0)
+
+            a.dispatch_packet({'command': 'cancel', 'request': 'u'})
+            sent = len(metrics_packets())
+            for _ in range(5):
+                a.run_once(timeout=0.01)
+            self.assertEqual(sent, len(metrics_packets()))
+
+            a.dispatch_packet({'command': 'subscribe-metrics',
+                               'metrics': ['cpu', 'gpu']})
+            self.assertEqual(
+                'unknown metrics: gpu',
+                mock_send_packet.mock_calls[-1].args[0]['message'])
+
+    @mock.patch('psutil.boot_time', return_value=1200)
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_profile(self, mock_send_packet, mock_boot_time):
+        with tempfile.TemporaryDirectory() as td:
+            channel = os.path.join(td, 'channel')
+            open(channel, 'w').close()
+            a = daemon.SFFileAgent(channel)
+            path = os.path.join(td, 'profile')
+
+            for profiler in ['cprofile', 'sampling']:
+                a.dispatch_packet({'command': 'profile', 'unique': profiler,
+                                   'profiler': profiler, 'duration': 0.05,
+                                   'interval': 0.001, 'limit': 5,
+                                   'path': path})
+                for _ in range(100):
+                    response = mock_send_packet.mock_calls[-1].args[0]
+                    if response.get('unique') == profiler:
+                        break
+                    a.run_once(timeout=0.01)
+
+                self.assertEqual('profile-response', response['command'])
+                self.assertEqual(True, response['result'])
+                self.assertEqual(profiler, response['profiler'])
+                self.assertTrue(0 < len(response['functions']) <= 5)
+                self.assertEqual(path, response['path'])
+                self.assertTrue(os.path.getsize(path) > 0)
+                self.assertEqual({}, a.streams)
+
+            # A cancelled profile stops without replying
+            sent = len(mock_send_packet.mock_calls)
+            a.dispatch_packet({'command': 'profile', 'unique': 'c',
+                               'profiler': 'cprofile', 'duration': 0.01})
+            a.dispatch_packet({'command': 'cancel', 'request': 'c'})
+            for _ in range(5):
+                a.run_once(timeout=0.01)
+            self.assertEqual(
+                ['cancel-response'],
+                [c.args[0]['command']
+                 for c in mock_send_packet.mock_calls[sent:]])
+
+            a.dispatch_packet({'command': 'profile', 'duration': 3600})
+            self.assertEqual(
+                False, mock_send_packet.mock_calls[-1].args[0]['result'])
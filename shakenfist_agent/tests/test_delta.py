@@ -0,0 +1,83 @@
+import base64
+import os
+import tempfile
+import testtools
+
+
+from shakenfist_agent import delta
+
+
+class DeltaTestCase(testtools.TestCase):
+    def _sync(self, old, new, block_size=64):
+        with tempfile.TemporaryDirectory() as td:
+            old_path = os.path.join(td, 'old')
+            new_path = os.path.join(td, 'new')
+            with open(old_path, 'wb') as f:
+                f.write(old)
+
+            with open(old_path, 'rb') as f:
+                sigs = delta.signatures(f, block_size=block_size)
+            ops = delta.compute_delta(sigs, new, block_size=block_size)
+
+            basis_fd = os.open(old_path, os.O_RDONLY)
+            out_fd = os.open(new_path, os.O_WRONLY | os.O_CREAT)
+            try:
+                end = delta.apply_delta(basis_fd, out_fd, ops, 0,
+                                        block_size=block_size)
+            finally:
+                os.close(basis_fd)
+                os.close(out_fd)
+
+            self.assertEqual(len(new), end)
+            with open(new_path, 'rb') as f:
+                self.assertEqual(new, f.read())
+            return ops
+
+    def _literal_bytes(self, ops):
+        return sum(len(base64.b64decode(op['data']))
+                   for op in ops if 'data' in op)
+
+    def test_unaligned_match(self):
+        # Matching blocks after a three byte insertion can only be found by
+        # rolling the weak checksum forward a byte at a time
+        old = os.urandom(64 * 4)
+        ops = self._sync(old, b'abc' + old)
+        self.assertEqual(
+            [{'data': base64.b64encode(b'abc').decode('utf-8')},
+             {'block': 0, 'count': 4}], ops)
+
+    def test_identical(self):
+        data = os.urandom(64 * 100 + 10)
+        ops = self._sync(data, data)
+        self.assertEqual(0, self._literal_bytes(ops))
+        self.assertEqual([{'block': 0, 'count': 101}], ops)
+
+    def test_modified_and_inserted(self):
+        old = os.urandom(64 * 100)
+        new = bytearray(old)
+        new[1000:1010] = b'x' * 10
+        new = bytes(new[:3000]) + b'inserted' + bytes(new[3000:])
+        ops = self._sync(old, new)
+        self.assertTrue(self._literal_bytes(ops) < 256)
+
+    def test_no_basis(self):
+        new = os.urandom(1000)
+        ops = self._sync(b'', new)
+        self.assertEqual(1000, self._literal_bytes(ops))
+
+    def test_truncated(self):
+        old = os.urandom(64 * 10)
+        ops = self._sync(old, old[:300])
+        self.assertTrue(self._literal_bytes(ops) < 64)
+
+    def test_block_size_for(self):
+        self.assertEqual(delta.BLOCK_SIZE, delta.block_size_for(0))
+        self.assertEqual(delta.BLOCK_SIZE, delta.block_size_for(16 << 20))
+        self.assertEqual(8192, delta.block_size_for(64 << 20))
+        self.assertEqual(delta.MAX_BLOCK_SIZE, delta.block_size_for(8 << 30))
+
+    def test_weak_checksum_rolls(self):
+        # Rolling forward gives the same checksum as computing it afresh
+        data = os.urandom(300)
+        ops = self._sync(data[100:164], data)
+        self.assertEqual({'block': 0, 'count': 1}, ops[1])
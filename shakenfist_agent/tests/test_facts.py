@@ -0,0 +1,67 @@
+import mock
+import os
+import tempfile
+import testtools
+
+
+from shakenfist_agent import facts
+from shakenfist_agent import protocol
+
+
+class FactsCacheTestCase(testtools.TestCase):
+    def setUp(self):
+        super(FactsCacheTestCase, self).setUp()
+        self.calls = []
+        self.values = {'distribution': {'id': 'debian'}, 'mounts': []}
+
+        def _gatherer(group):
+            def _gather():
+                self.calls.append(group)
+                return self.values[group]
+            return _gather
+
+        gatherers = {group: _gatherer(group) for group in self.values}
+        p = mock.patch.dict(facts.GATHERERS, gatherers, clear=True)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_cached_until_expired(self):
+        c = facts.FactsCache()
+        self.assertEqual(self.values, c.get())
+        self.assertEqual({'mounts': []}, c.get(['mounts']))
+        self.assertEqual(['distribution', 'mounts'], sorted(self.calls))
+
+        # A group with a zero TTL is gathered every time
+        c.ttls['mounts'] = 0
+        c.invalidate('mounts')
+        c.get(['mounts'])
+        c.get(['mounts'])
+        self.assertEqual(4, len(self.calls))
+
+    def test_invalidate_and_refresh(self):
+        c = facts.FactsCache()
+        c.ttls['mounts'] = None
+        c.get()
+        c.invalidate('mounts')
+        c.get(['mounts'])
+        self.assertEqual(['distribution', 'mounts', 'mounts'], self.calls)
+
+        self.values['mounts'] = [{'mount_point': '/mnt'}]
+        self.assertEqual({'mounts': [{'mount_point': '/mnt'}]},
+                         c.refresh(['distribution', 'mounts']))
+        self.assertEqual({}, c.refresh(['distribution', 'mounts']))
+
+    def test_watch_ssh_directory(self):
+        reactor = protocol.Agent()
+        changed = []
+        with tempfile.TemporaryDirectory() as td:
+            with mock.patch('shakenfist_agent.facts.SSH_DIRECTORY', td):
+                c = facts.FactsCache()
+                c.watch(reactor, changed.append)
+                self.addCleanup(c.close, reactor)
+            self.assertEqual(None, c.ttls['ssh-host-keys'])
+
+            with open(os.path.join(td, 'ssh_host_rsa_key.pub'), 'w') as f:
+                f.write('ssh-rsa AAAA')
+            reactor.run_once(timeout=1)
+            self.assertEqual(['ssh-host-keys'], changed)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import testtools
+
+
+from shakenfist_agent import inotify
+
+
+class InotifyTestCase(testtools.TestCase):
+    def test_modify_and_move(self):
+        i = inotify.Inotify()
+        self.addCleanup(i.close)
+
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'log')
+            with open(path, 'w') as f:
+                f.write('hello\n')
+
+            wd = i.add_watch(path, inotify.IN_MODIFY | inotify.IN_MOVE_SELF)
+            self.assertEqual([], i.read_events())
+
+            with open(path, 'a') as f:
+                f.write('world\n')
+            events = i.read_events()
+            self.assertTrue(len(events) > 0)
+            self.assertEqual(wd, events[0][0])
+            self.assertTrue(events[0][1] & inotify.IN_MODIFY)
+
+            os.rename(path, path + '.1')
+            events = i.read_events()
+            self.assertTrue(events[0][1] & inotify.IN_MOVE_SELF)
+
+    def test_directory_events_have_names(self):
+        i = inotify.Inotify()
+        self.addCleanup(i.close)
+
+        with tempfile.TemporaryDirectory() as td:
+            i.add_watch(td, inotify.IN_CREATE | inotify.IN_ONLYDIR)
+            with open(os.path.join(td, 'a-file'), 'w'):
+                pass
+            events = i.read_events()
+            self.assertEqual('a-file', events[0][3])
+            self.assertTrue(events[0][1] & inotify.IN_CREATE)
+
+    def test_missing_path(self):
+        i = inotify.Inotify()
+        self.addCleanup(i.close)
+        self.assertRaises(OSError, i.add_watch, '/does/not/exist',
+                          inotify.IN_MODIFY)
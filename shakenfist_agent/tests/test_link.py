@@ -0,0 +1,84 @@
+import mock
+import testtools
+
+
+from shakenfist_agent import link
+
+
+class LinkEstimatorTestCase(testtools.TestCase):
+    def test_rtt(self):
+        e = link.LinkEstimator()
+        e.observe_rtt(0.1)
+        self.assertEqual(0.1, e.rtt)
+        self.assertEqual(0.05, e.jitter)
+
+        e.observe_rtt(0.2)
+        self.assertAlmostEqual(0.1125, e.rtt)
+        self.assertAlmostEqual(0.0625, e.jitter)
+        self.assertEqual(0.1, e.min_rtt)
+        self.assertEqual(2, e.rtt_samples)
+
+        # A clock which went backwards is not a sample
+        e.observe_rtt(-1)
+        self.assertEqual(2, e.rtt_samples)
+
+    def test_keepalive_interval(self):
+        e = link.LinkEstimator()
+        for _ in range(10):
+            e.pong_received()
+        self.assertEqual(link.MAX_KEEPALIVE_INTERVAL, e.keepalive_interval)
+
+        e.ping_missed()
+        self.assertEqual(link.MIN_KEEPALIVE_INTERVAL, e.keepalive_interval)
+
+        # Nothing answering, so back off again
+        e.ping_missed()
+        e.ping_missed()
+        self.assertEqual(4 * link.MIN_KEEPALIVE_INTERVAL, e.keepalive_interval)
+        self.assertEqual(3, e.errors)
+
+        e.pong_received()
+        e.error()
+        self.assertEqual(link.MIN_KEEPALIVE_INTERVAL, e.keepalive_interval)
+
+    @mock.patch('time.monotonic')
+    def test_throughput(self, mock_monotonic):
+        e = link.LinkEstimator()
+        self.assertEqual(65536, e.chunk_size(65536))
+
+        mock_monotonic.return_value = 10.0
+        e.output_sample(1000, True)
+        mock_monotonic.return_value = 10.01
+        e.output_sample(2000, True)
+        self.assertEqual(None, e.throughput)
+
+        # Sampled while still busy
+        mock_monotonic.return_value = 10.5
+        e.output_sample(1000 + 50 * 1024 * 1024, True)
+        self.assertAlmostEqual(100 * 1024 * 1024, e.throughput)
+
+        # Writes once we are idle are not part of the busy period
+        mock_monotonic.return_value = 10.51
+        e.output_sample(1000 + 51 * 1024 * 1024, False)
+        mock_monotonic.return_value = 11.0
+        e.output_sample(1000 + 70 * 1024 * 1024, False)
+        self.assertEqual(1, e.throughput_samples)
+
+        # Nor is a busy period where nothing could be written
+        e.output_sample(0, True)
+        mock_monotonic.return_value = 12.0
+        e.output_sample(0, False)
+        self.assertEqual(1, e.throughput_samples)
+
+    def test_chunk_size(self):
+        e = link.LinkEstimator()
+        e.observe_throughput(1024 * 1024, 1)
+        self.assertEqual(16 * 1024, e.chunk_size(65536))
+
+        e = link.LinkEstimator()
+        e.observe_throughput(10 * 1024 * 1024, 1)
+        self.assertEqual(128 * 1024, e.chunk_size(65536))
+
+        e = link.LinkEstimator()
+        e.observe_throughput(1024 * 1024 * 1024, 1)
+        self.assertEqual(link.MAX_CHUNK_SIZE, e.chunk_size(65536))
@@ -0,0 +1,49 @@
+import mock
+import testtools
+
+
+from shakenfist_agent import metrics
+
+
+class MetricsSamplerTestCase(testtools.TestCase):
+    def test_rates_need_two_samples(self):
+        s = metrics.MetricsSampler(['load', 'memory', 'network'])
+        first = s.sample()
+        self.assertEqual(['load', 'memory', 'time'], sorted(first))
+
+        second = s.sample()
+        self.assertEqual(['load', 'memory', 'network', 'time'],
+                         sorted(second))
+        self.assertTrue('bytes_recv' in second['network'])
+
+    @mock.patch('time.monotonic', side_effect=[100.0, 102.0])
+    @mock.patch('psutil.net_io_counters')
+    def test_network_rates(self, mock_counters, mock_monotonic):
+        fields = {'bytes_sent': 0, 'bytes_recv': 0, 'packets_sent': 0,
+                  'packets_recv': 0, 'errin': 0, 'errout': 0, 'dropin': 0,
+                  'dropout': 0}
+        mock_counters.side_effect = [
+            mock.Mock(**fields),
+            mock.Mock(**dict(fields, bytes_recv=3000, packets_recv=3))
+        ]
+
+        s = metrics.MetricsSampler(['network'])
+        s.sample()
+        network = s.sample()['network']
+        self.assertEqual(1500, network['bytes_recv'])
+        self.assertEqual(1.5, network['packets_recv'])
+        self.assertEqual(0, network['bytes_sent'])
+
+    @mock.patch('psutil.cpu_times')
+    def test_cpu_percentages(self, mock_cpu_times):
+        mock_cpu_times.side_effect = [
+            mock.Mock(_asdict=lambda: {'user': 10.0, 'system': 5.0,
+                                       'idle': 85.0}),
+            mock.Mock(_asdict=lambda: {'user': 13.0, 'system': 6.0,
+                                       'idle': 91.0})
+        ]
+
+        s = metrics.MetricsSampler(['cpu'])
+        s.sample()
+        self.assertEqual({'user': 30.0, 'system': 10.0, 'idle': 60.0},
+                         s.sample()['cpu'])
@@ -0,0 +1,61 @@
+import mock
+import os
+import signal
+import testtools
+import time
+
+
+from shakenfist_agent import process
+from shakenfist_agent import protocol
+
+
+class ProcessSupervisorTestCase(testtools.TestCase):
+    def _run_until(self, reactor, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            reactor.run_once(timeout=0.1)
+
+    def test_spawn_reports_exit(self):
+        reactor = protocol.Agent()
+        s = process.ProcessSupervisor(reactor)
+        results = []
+
+        p = s.spawn('exit 7', results.append)
+        self._run_until(reactor, lambda: results)
+
+        self.assertEqual(1, len(results))
+        self.assertEqual(p.pid, results[0]['pid'])
+        self.assertEqual(7, results[0]['return-code'])
+        self.assertEqual(7, p.returncode)
+        self.assertTrue(results[0]['wall-time'] >= 0)
+        self.assertTrue('max-rss' in results[0])
+        self.assertEqual({}, s.children)
+
+    def test_spawn_reports_signal(self):
+        reactor = protocol.Agent()
+        s = process.ProcessSupervisor(reactor)
+        results = []
+
+        s.spawn('kill -TERM $$', results.append)
+        self._run_until(reactor, lambda: results)
+        self.assertEqual(-signal.SIGTERM, results[0]['return-code'])
+
+    @mock.patch('os.pidfd_open', side_effect=OSError('not supported'),
+                create=True)
+    def test_spawn_sigchld_fallback(self, mock_pidfd_open):
+        old_handler = signal.getsignal(signal.SIGCHLD)
+        self.addCleanup(signal.signal, signal.SIGCHLD, old_handler)
+
+        reactor = protocol.Agent()
+        s = process.ProcessSupervisor(reactor)
+        results = []
+
+        for i in range(10):
+            s.spawn('exit %d' % i, results.append)
+        self._run_until(reactor, lambda: len(results) == 10)
+
+        self.assertNotEqual(None, s._sigchld_fds)
+        self.assertEqual(list(range(10)),
+                         sorted(r['return-code'] for r in results))
+        for fd in s._sigchld_fds:
+            os.close(fd)
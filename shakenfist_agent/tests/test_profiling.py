@@ -0,0 +1,61 @@
+import os
+import pstats
+import tempfile
+import testtools
+import threading
+import time
+
+
+from shakenfist_agent import profiling
+
+
+def _busy(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class ProfilingTestCase(testtools.TestCase):
+    def test_cprofile(self):
+        p = profiling.CProfiler()
+        p.start()
+        _busy(0.05)
+        self.assertRaises(profiling.ProfilerBusy, profiling.CProfiler().start)
+        p.stop()
+
+        top = p.top(100)
+        busy = [f for f in top if f['function'].endswith('(_busy)')]
+        self.assertEqual(1, len(busy))
+        self.assertEqual(1, busy[0]['calls'])
+        self.assertTrue(busy[0]['cumulative-seconds'] >= 0.05)
+
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'profile')
+            p.dump(path)
+            self.assertTrue(pstats.Stats(path).total_calls > 0)
+
+        # The next profile may start now this one has stopped
+        p = profiling.CProfiler()
+        p.start()
+        p.stop()
+
+    def test_sampling(self):
+        p = profiling.SamplingProfiler(
+            interval=0.001, threads=[threading.get_ident()])
+        p.start()
+        _busy(0.2)
+        p.stop()
+
+        self.assertTrue(p.samples > 0)
+        top = p.top(5, sort='total')
+        self.assertTrue(top[0]['function'].endswith('(_busy)'))
+        self.assertEqual(top[0]['samples'], top[0]['cumulative-samples'])
+
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'stacks')
+            p.dump(path)
+            with open(path) as f:
+                line = f.readline()
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(int(count) > 0)
+            self.assertTrue(stack.split(';')[-1].endswith('(_busy)'))
@@ -1,8 +1,16 @@
+import hashlib
 import json
+import math
 import mock
+import os
+import socket
+import tempfile
+import threading
+import time
 import testtools
 
 
+from shakenfist_agent import link
 from shakenfist_agent import protocol
 
 
@@ -60,12 +68,62 @@ class ProtocolTestCase(testtools.TestCase):
         a.buffer = p.encode('utf-8')
         self.assertEqual(None, a.find_packet())
 
+    @mock.patch('time.monotonic', return_value=12.5)
     @mock.patch('shakenfist_agent.protocol.Agent._write')
-    def test_send_ping(self, mock_write):
+    def test_send_ping(self, mock_write, mock_monotonic):
         a = protocol.Agent()
+        a.use_json_codec('json')
         a.send_ping(unique=4242)
         mock_write.assert_called_with(
-            b'*SFv001*[00000035]{"command": "ping", "unique": 4242}')
+            b'*SFv001*[00000054]',
+            b'{"command": "ping", "unique": 4242, "timestamp": 12.5}',
+            unique=4242, priority=None, command='ping')
+
+    def test_ping_round_trip(self):
+        a = protocol.Agent()
+        a._write = mock.Mock()
+
+        # Our pongs return the timestamp from the ping
+        a.send_pong({'command': 'ping', 'unique': 1, 'timestamp': 12.5})
+        self.assertEqual(
+            {'command': 'pong', 'unique': 1, 'timestamp': 12.5},
+            json.loads(bytes(a._write.mock_calls[-1].args[1])))
+
+        with mock.patch('time.monotonic', return_value=100.0):
+            a.send_ping(unique=2)
+        with mock.patch('time.monotonic', return_value=100.25):
+            a.dispatch_packet(
+                {'command': 'pong', 'unique': 2, 'timestamp': 100.0})
+        self.assertEqual(0.25, a.link.rtt)
+        self.assertEqual(1, a.link.pongs_received)
+        self.assertEqual(2 * protocol.KEEPALIVE_INTERVAL,
+                         a.link.keepalive_interval)
+
+        # Pongs without a timestamp still count as an answer
+        a.send_ping(unique=3)
+        a.dispatch_packet({'command': 'pong', 'unique': 3})
+        self.assertEqual(1, a.link.rtt_samples)
+        self.assertEqual(2, a.link.pongs_received)
+
+    def test_keepalive_adapts(self):
+        a = protocol.Agent()
+        a._write = mock.Mock()
+
+        # An unanswered ping makes us ping an idle channel more often
+        a.send_ping(unique=1)
+        a.last_data -= protocol.KEEPALIVE_INTERVAL + 1
+        a.poll()
+        self.assertEqual(1, a.link.pings_missed)
+        self.assertEqual(link.MIN_KEEPALIVE_INTERVAL,
+                         a.link.keepalive_interval)
+
+        # As do errors reported by the other end
+        a.dispatch_packet({'command': 'pong', 'unique': 1})
+        self.assertEqual(2 * link.MIN_KEEPALIVE_INTERVAL,
+                         a.link.keepalive_interval)
+        a.dispatch_packet({'command': 'command-error', 'message': 'oops'})
+        self.assertEqual(link.MIN_KEEPALIVE_INTERVAL,
+                         a.link.keepalive_interval)
 
     @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
     def test_null_body(self, mock_read):
@@ -102,3 +160,790 @@ class ProtocolTestCase(testtools.TestCase):
                 'command': 'json-decode-failure',
                 'message': 'failed to JSON decode packet: "{"notjson"'
                 })], mock_send_packet.mock_calls)
+
+    def test_packet_split_across_reads(self):
+        j = json.dumps({'command': 'pong', 'unique': 42})
+        d = ('%s[%08d]%s' % (protocol.Agent.PREAMBLE, len(j), j)).encode('utf-8')
+        reads = [d[:3], d[3:12], d[12:20], d[20:]]
+
+        a = protocol.Agent()
+        with mock.patch('shakenfist_agent.protocol.Agent._read',
+                        side_effect=reads):
+            self.assertEqual(None, a.find_packet())
+            self.assertEqual(None, a.find_packet())
+            self.assertEqual(None, a.find_packet())
+            self.assertEqual({'command': 'pong', 'unique': 42}, a.find_packet())
+        self.assertEqual(b'', a.buffer)
+
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_leading_garbage_discarded(self, mock_read):
+        a = protocol.Agent()
+        j = json.dumps({'command': 'pong', 'unique': 42})
+        p = 'garbage%s[%08d]%s*SF' % (a.PREAMBLE, len(j), j)
+        a.buffer = p.encode('utf-8')
+        self.assertEqual({'command': 'pong', 'unique': 42}, a.find_packet())
+        self.assertEqual(b'*SF', a.buffer)
+
+    @mock.patch('shakenfist_agent.protocol.COMPACT_THRESHOLD', 100)
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_buffer_compaction(self, mock_read):
+        a = protocol.Agent()
+        for i in range(50):
+            j = json.dumps({'command': 'pong', 'unique': i})
+            a.buffer += ('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode('utf-8')
+        a.buffer += b'*SFv0'
+
+        for i in range(50):
+            self.assertEqual({'command': 'pong', 'unique': i}, a.find_packet())
+            self.assertTrue(a._buffer_start <= 100 or
+                            a._buffer_start <= len(a._buffer) // 2)
+        self.assertEqual(b'*SFv0', a.buffer)
+
+    def test_reactor_answers_ping(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+
+        a = protocol.Agent()
+        a.use_json_codec('json')
+        a.input_fileno = ours.fileno()
+        a.output_fileno = ours.fileno()
+        a.set_fd_nonblocking(ours.fileno())
+        a.start_reactor()
+
+        j = json.dumps({'command': 'ping', 'unique': 42})
+        theirs.sendall(('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode('utf-8'))
+        a.run_once(timeout=1)
+
+        j = json.dumps({'command': 'pong', 'unique': 42})
+        self.assertEqual(
+            ('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode('utf-8'),
+            theirs.recv(1024))
+
+    @mock.patch('shakenfist_agent.protocol.Agent.send_ping')
+    def test_reactor_keepalive_timer(self, mock_send_ping):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+
+        a = protocol.Agent()
+        a.input_fileno = ours.fileno()
+        a.output_fileno = ours.fileno()
+        a.set_fd_nonblocking(ours.fileno())
+        a.start_reactor()
+
+        # Not idle yet, so no ping
+        a._timers[0] = (0, 0, a._timers[0][2])
+        a.run_once(timeout=0)
+        self.assertEqual(0, len(mock_send_ping.mock_calls))
+
+        a.last_data -= protocol.KEEPALIVE_INTERVAL + 1
+        a._timers[0] = (0, 0, a._timers[0][2])
+        a.run_once(timeout=0)
+        self.assertEqual(1, len(mock_send_ping.mock_calls))
+
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_binary_frames_mixed_with_json(self, mock_read):
+        a = protocol.Agent()
+        written = []
+        with mock.patch('shakenfist_agent.protocol.Agent._write',
+                        side_effect=lambda *p, **kw: written.append(b''.join(p))):
+            a.send_packet({'command': 'pong', 'unique': 42})
+            a.send_binary(7, 1024, b'\x00*SFv001*\xff')
+            a.send_packet({'command': 'pong', 'unique': 43})
+        a.buffer = b''.join(written)
+
+        self.assertEqual({'command': 'pong', 'unique': 42}, a.find_packet())
+        self.assertEqual(
+            {
+                'command': 'binary-chunk',
+                'flags': 0,
+                'stream': 7,
+                'offset': 1024,
+                'chunk': b'\x00*SFv001*\xff'
+            }, a.find_packet())
+        self.assertEqual({'command': 'pong', 'unique': 43}, a.find_packet())
+        self.assertEqual(b'', a.buffer)
+
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_incomplete_binary_frame(self, mock_read):
+        a = protocol.Agent()
+        with mock.patch('shakenfist_agent.protocol.Agent._write') as mock_write:
+            a.send_binary(1, 0, b'hello')
+        frame = b''.join(mock_write.mock_calls[0].args)
+
+        a.buffer = frame[:-1]
+        self.assertEqual(None, a.find_packet())
+        a.buffer += frame[-1:]
+        self.assertEqual(b'hello', a.find_packet()['chunk'])
+
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_binary_chunk_unknown_stream(self, mock_send_packet):
+        a = protocol.Agent()
+        a.dispatch_packet({'command': 'binary-chunk', 'flags': 0, 'stream': 3,
+                           'offset': 0, 'chunk': b'x'})
+        self.assertEqual('unknown-stream',
+                         mock_send_packet.mock_calls[0].args[0]['command'])
+
+        received = []
+        a.register_binary_stream(3, received.append)
+        a.dispatch_packet({'command': 'binary-chunk', 'flags': 0, 'stream': 3,
+                           'offset': 0, 'chunk': b'x'})
+        self.assertEqual(b'x', received[0]['chunk'])
+
+    def _socket_agent(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+
+        a = protocol.Agent()
+        a.input_fileno = ours.fileno()
+        a.output_fileno = ours.fileno()
+        a.set_fd_nonblocking(ours.fileno())
+        return a, theirs
+
+    def _drain_socket(self, s):
+        s.setblocking(False)
+        received = b''
+        while True:
+            try:
+                d = s.recv(65536)
+            except BlockingIOError:
+                return received
+            received += d
+
+    def test_write_backpressure_does_not_drop(self):
+        a, theirs = self._socket_agent()
+        a.reactor_running = True
+
+        # Write far more than the socket buffer will hold
+        data = bytes(range(256)) * 16384
+        a._write(data)
+        self.assertTrue(a._output_queued > 0)
+
+        received = self._drain_socket(theirs)
+        while len(received) < len(data):
+            a.run_once(timeout=0)
+            received += self._drain_socket(theirs)
+        self.assertEqual(data, received)
+        self.assertEqual(0, a._output_queued)
+
+    @mock.patch('shakenfist_agent.protocol.Agent._drain')
+    def test_write_before_reactor_starts(self, mock_drain):
+        a, theirs = self._socket_agent()
+        a.write_timeout = None
+
+        # Nobody is reading yet, so this is left for the reactor
+        data = bytes(range(256)) * 16384
+        a._write(data)
+        self.assertEqual(0, len(mock_drain.mock_calls))
+        self.assertTrue(a._output_queued > 0)
+
+        a.start_reactor(keepalive=False)
+        received = self._drain_socket(theirs)
+        while len(received) < len(data):
+            a.run_once(timeout=0)
+            received += self._drain_socket(theirs)
+        self.assertEqual(data, received)
+
+    @mock.patch('shakenfist_agent.protocol.CLOSE_WRITE_TIMEOUT', 0.01)
+    def test_close_with_nobody_reading(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+
+        # Input and output share a file descriptor, which is closed once
+        a = protocol.Agent()
+        a.input_fileno = ours.detach()
+        a.output_fileno = a.input_fileno
+        a.set_fd_nonblocking(a.input_fileno)
+        a.write_timeout = None
+        a._write(bytes(range(256)) * 16384)
+
+        start = time.monotonic()
+        a.close()
+        self.assertTrue(time.monotonic() - start < 1)
+        self.assertTrue(a.stats.counters['dropped-bytes'] > 0)
+        self.assertEqual(0, a._output_queued)
+
+    def test_producer_window(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor()
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with open(tf.name, 'wb') as f:
+                f.write(b'x' * 10240)
+
+            a._send_file('get-file-response', tf.name, tf.name, 'u',
+                         window=2048)
+            for _ in range(5):
+                a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            packets = list(a.find_packets())
+            self.assertEqual(3, len(packets))
+            self.assertTrue('stat_result' in packets[0])
+            self.assertEqual(1024, packets[2]['offset'])
+
+            a.dispatch_packet({'command': 'window-ack', 'unique': 'u',
+                               'offset': 2048})
+            for _ in range(5):
+                a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            packets = list(a.find_packets())
+            self.assertEqual(2, len(packets))
+            self.assertEqual(3072, packets[1]['offset'])
+
+    def test_producer_window_resumed(self):
+        # Acks name file offsets, so a resumed transfer's window starts at
+        # the offset it was resumed from.
+        a, theirs = self._socket_agent()
+        a.start_reactor()
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with open(tf.name, 'wb') as f:
+                f.write(b'x' * 10240)
+
+            a._send_file('get-file-response', tf.name, tf.name, 'u',
+                         window=2048, offset=4096)
+            for _ in range(5):
+                a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            packets = list(a.find_packets())
+            self.assertEqual([4096, 5120],
+                             [p['offset'] for p in packets[1:]])
+
+            a.dispatch_packet({'command': 'window-ack', 'unique': 'u',
+                               'offset': 5120})
+            for _ in range(5):
+                a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            self.assertEqual([6144],
+                             [p['offset'] for p in a.find_packets()])
+
+    def test_resume_digest_off_loop_thread(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor(keepalive=False)
+        data = os.urandom(10240)
+
+        threads = []
+        digest_file = protocol.digest_file
+
+        def recording_digest_file(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return digest_file(*args, **kwargs)
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with open(tf.name, 'wb') as f:
+                f.write(data)
+
+            with mock.patch('shakenfist_agent.protocol.digest_file',
+                            side_effect=recording_digest_file):
+                a._send_file('get-file-response', tf.name, tf.name, 'u',
+                             offset=4096, digest='sha256')
+                packets = []
+                while not packets or packets[-1].get('chunk', '') is not None:
+                    a.run_once(timeout=0.1)
+                    a.buffer = a.buffer + self._drain_socket(theirs)
+                    packets.extend(a.find_packets())
+
+        self.assertEqual(1, len(threads))
+        self.assertNotEqual(threading.get_ident(), threads[0])
+        self.assertEqual(hashlib.sha256(data).hexdigest(),
+                         packets[-1]['file-digest'])
+
+    def test_writes_coalesced(self):
+        a, theirs = self._socket_agent()
+        a.reactor_running = True
+
+        for i in range(20):
+            a.send_packet({'command': 'pong', 'unique': i})
+        self.assertEqual(0, a.output_counters['write_syscalls'])
+
+        a.run_once(timeout=0)
+        self.assertEqual(20, a.output_counters['frames'])
+        self.assertEqual(1, a.output_counters['write_syscalls'])
+
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual(
+            [{'command': 'pong', 'unique': i} for i in range(20)],
+            list(a.find_packets()))
+
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_compressed_frames(self, mock_read):
+        a = protocol.Agent()
+        written = []
+        with mock.patch('shakenfist_agent.protocol.Agent._write',
+                        side_effect=lambda *p, **kw: written.append(b''.join(p))):
+            a.dispatch_packet({'command': 'set-compression', 'codec': 'zlib',
+                               'unique': 1})
+            self.assertEqual('zlib', a.compression)
+            written.clear()
+
+            large = {'command': 'execute-response', 'stdout': 'hello\n' * 1000}
+            a.send_packet(large)
+            a.send_packet({'command': 'pong', 'unique': 42})
+            a.send_binary(3, 0, b'x' * 4096)
+            random_data = os.urandom(4096)
+            a.send_binary(3, 4096, random_data)
+
+        # The large packet and compressible data should be compressed, the
+        # rest should not be
+        self.assertTrue(written[0].startswith(a.BINARY_PREAMBLE_BYTES))
+        self.assertTrue(len(written[0]) < 1000)
+        self.assertTrue(written[1].startswith(a.PREAMBLE_BYTES))
+        self.assertTrue(len(written[2]) < 4096)
+        self.assertTrue(len(written[3]) > 4096)
+
+        a.buffer = b''.join(written)
+        self.assertEqual(large, a.find_packet())
+        self.assertEqual({'command': 'pong', 'unique': 42}, a.find_packet())
+        self.assertEqual(b'x' * 4096, a.find_packet()['chunk'])
+        self.assertEqual(random_data, a.find_packet()['chunk'])
+
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    @mock.patch('shakenfist_agent.protocol.Agent._read', return_value=None)
+    def test_corrupt_compressed_frame(self, mock_read, mock_send_packet):
+        a = protocol.Agent()
+        garbage = b'not zlib data'
+        frame = (a.BINARY_PREAMBLE_BYTES +
+                 a.BINARY_HEADER.pack(
+                     protocol.COMPRESSION_CODECS['zlib'][0] <<
+                     protocol.FLAG_COMPRESSION_SHIFT, 3, 0, len(garbage)) +
+                 garbage)
+        j = json.dumps({'command': 'pong', 'unique': 42})
+        a.buffer = frame + ('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode()
+
+        # The corrupt frame is reported, and parsing carries on after it
+        self.assertEqual([{'command': 'pong', 'unique': 42}],
+                         list(a._buffered_packets()))
+        failure = mock_send_packet.mock_calls[0].args[0]
+        self.assertEqual('decompression-failure', failure['command'])
+        self.assertEqual(3, failure['stream'])
+        self.assertEqual(1, a.stats.counters['decompression-failures'])
+
+    @mock.patch('shakenfist_agent.protocol.Agent.send_packet')
+    def test_set_compression_unknown_codec(self, mock_send_packet):
+        a = protocol.Agent()
+        a.dispatch_packet({'command': 'set-compression', 'codec': 'rot13',
+                           'unique': 1})
+        self.assertEqual(None, a.compression)
+        self.assertEqual(False, mock_send_packet.mock_calls[0].args[0]['result'])
+
+    def test_blocking_command_does_not_block_ping(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor(keepalive=False)
+
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow_command(packet):
+            started.set()
+            release.wait(10)
+            a.send_packet({'command': 'slow-response'})
+
+        a.add_command('slow', slow_command, blocking=True)
+        a.dispatch_packet({'command': 'slow'})
+        self.assertTrue(started.wait(10))
+
+        a.dispatch_packet({'command': 'ping', 'unique': 1})
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual([{'command': 'pong', 'unique': 1}],
+                         list(a.find_packets()))
+
+        release.set()
+        while a._commands_running['slow']:
+            a.run_once(timeout=1)
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual([{'command': 'slow-response'}],
+                         list(a.find_packets()))
+
+    def test_blocking_command_concurrency_limit(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor(keepalive=False)
+
+        release = threading.Event()
+        calls = []
+
+        def slow_command(packet):
+            calls.append(packet['n'])
+            release.wait(10)
+
+        a.add_command('slow', slow_command, blocking=True, concurrency=2)
+        for n in range(5):
+            a.dispatch_packet({'command': 'slow', 'n': n})
+        self.assertEqual(2, a._commands_running['slow'])
+        self.assertEqual(3, len(a._commands_waiting['slow']))
+
+        release.set()
+        while a._commands_running['slow']:
+            a.run_once(timeout=1)
+        self.assertEqual([0, 1, 2, 3, 4], sorted(calls))
+
+    def test_throttled_reader_paused(self):
+        a = protocol.Agent()
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+
+        producer = protocol.Producer(None, unique='u', window=10)
+        a.register_throttled_reader(r, lambda fd, mask: None, producer)
+        self.assertTrue(a._throttled_readers[r]['registered'])
+
+        producer.sent = 10
+        a.run_once(timeout=0)
+        self.assertFalse(a._throttled_readers[r]['registered'])
+
+        a.dispatch_packet({'command': 'window-ack', 'unique': 'u', 'offset': 5})
+        a.run_once(timeout=0)
+        self.assertTrue(a._throttled_readers[r]['registered'])
+
+        a._output_queued = protocol.MAX_QUEUED_OUTPUT
+        a.run_once(timeout=0)
+        self.assertFalse(a._throttled_readers[r]['registered'])
+
+    def test_control_output_overtakes_bulk(self):
+        a, theirs = self._socket_agent()
+        a.reactor_running = True
+
+        a.send_packet({'command': 'chunk', 'unique': 'u'},
+                      priority=protocol.PRIORITY_BULK)
+        a.send_packet({'command': 'chunk', 'unique': 'u'},
+                      priority=protocol.PRIORITY_BULK)
+        # A packet for a request with bulk output queued keeps its place
+        # behind that output, others go first
+        a.send_packet({'command': 'done', 'unique': 'u'})
+        a.send_packet({'command': 'pong', 'unique': 'v'})
+        self.assertEqual({'u': 3}, dict(a._bulk_frames_queued))
+
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual(['pong', 'chunk', 'chunk', 'done'],
+                         [p['command'] for p in a.find_packets()])
+        self.assertEqual({}, dict(a._bulk_frames_queued))
+
+    def test_partial_bulk_frame_finished_first(self):
+        a, theirs = self._socket_agent()
+        a.reactor_running = True
+
+        # The channel accepts the start of a bulk frame, and then blocks
+        writes = []
+
+        def short_writev(fd, iov):
+            if writes:
+                raise BlockingIOError()
+            writes.append(fd)
+            return os.write(fd, b''.join(iov)[:10])
+
+        with mock.patch('os.writev', side_effect=short_writev):
+            a.send_binary(1, 0, b'x' * 100, priority=protocol.PRIORITY_BULK)
+            a._flush()
+        self.assertIs(a._output_queues[protocol.PRIORITY_BULK],
+                      a._output_frame_open)
+        a.send_packet({'command': 'pong', 'unique': 'v'})
+
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual(['binary-chunk', 'pong'],
+                         [p['command'] for p in a.find_packets()])
+
+    def test_get_file_truncated_during_transfer(self):
+        # As logrotate's copytruncate does to the file we are sending
+        with tempfile.NamedTemporaryFile() as tf:
+            tf.write(b'x' * (3 * protocol.BINARY_CHUNK_SIZE))
+            tf.flush()
+
+            a = protocol.Agent()
+            a.send_packet = mock.Mock()
+            chunks = []
+            a.send_binary = mock.Mock(
+                side_effect=lambda s, o, d: chunks.append((o, bytes(d))))
+            stream = a.open_stream('get-file', 'u')
+            producer = a._send_file_stream(
+                'get-file-response', tf.name, tf.name, 'u', 'binary', 0,
+                None, False, stream)
+
+            self.assertEqual(protocol.BINARY_CHUNK_SIZE, next(producer))
+            os.truncate(tf.name, 10)
+            self.assertEqual([], list(producer))
+
+        self.assertEqual([(0, b'x' * protocol.BINARY_CHUNK_SIZE)], chunks)
+        final = a.send_packet.mock_calls[-1].args[0]
+        self.assertEqual(None, final['chunk'])
+        self.assertEqual(protocol.BINARY_CHUNK_SIZE, final['offset'])
+
+    def test_output_refers_to(self):
+        a = protocol.Agent()
+        a.reactor_running = True
+        buf = bytearray(100)
+        self.assertFalse(a._output_refers_to(buf))
+        a._write(b'header', memoryview(buf)[:10])
+        self.assertTrue(a._output_refers_to(buf))
+
+    def test_cancel_producer(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor()
+
+        with tempfile.NamedTemporaryFile() as tf:
+            with open(tf.name, 'wb') as f:
+                f.write(b'x' * 10240)
+
+            a._send_file('get-file-response', tf.name, tf.name, 'u',
+                         window=2048)
+            for _ in range(5):
+                a.run_once(timeout=0)
+            self.assertEqual(1, len(a.streams))
+            stream_id = list(a.streams)[0]
+
+            a.dispatch_packet({'command': 'cancel', 'request': 'u',
+                               'unique': 'c'})
+            self.assertEqual({}, a.streams)
+            self.assertEqual([], a._producers)
+
+            a.dispatch_packet({'command': 'window-ack', 'unique': 'u',
+                               'offset': 10240})
+            for _ in range(5):
+                a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            packets = list(a.find_packets())
+            self.assertEqual(
+                {'command': 'cancel-response', 'result': True,
+                 'streams': [stream_id], 'unique': 'c'}, packets[-1])
+            self.assertEqual(4, len(packets))
+
+            a.dispatch_packet({'command': 'cancel', 'stream': stream_id})
+            a.run_once(timeout=0)
+            a.buffer = self._drain_socket(theirs)
+            self.assertEqual(False, a.find_packet()['result'])
+
+    def test_no_host_does_not_spin(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor(keepalive=False)
+
+        # The other end has gone away, and reads only see EOF
+        with mock.patch('shakenfist_agent.protocol.Agent._read',
+                        return_value=b''):
+            a._input_ready(a.input_fileno, 0)
+            a._watch_input()
+            a._input_ready(a.input_fileno, 0)
+        self.assertEqual(1, a.link.errors)
+
+        # Nor do writes get anywhere, so stop trying for a while
+        a._write(bytes(range(256)) * 16384)
+        a.run_once(timeout=0)
+        a.send_ping(unique=1)
+        a._output_ready(a.output_fileno, 0)
+        self.assertTrue(a._output_paused)
+        self.assertFalse(a._waiting_for_writable)
+        a.run_once(timeout=0)
+        self.assertFalse(a._waiting_for_writable)
+
+        # The unsent ping is neither missed nor sent again
+        a.last_data -= a.link.keepalive_interval + 1
+        a.poll()
+        self.assertEqual(0, a.link.pings_missed)
+        self.assertEqual(1, a.link.pings_sent)
+
+        # Eventually what is queued is too old to keep
+        a._output_stalled_since -= protocol.WRITE_TIMEOUT + 1
+        a._resume_output()
+        self.assertFalse(a._output_paused)
+        self.assertEqual(0, a._output_queued)
+        self.assertTrue(a.stats.counters['dropped-bytes'] > 0)
+
+    def test_callback_errors_do_not_stop_loop(self):
+        a, theirs = self._socket_agent()
+        a.start_reactor(keepalive=False)
+
+        def broken_read():
+            yield 10
+            raise OSError(5, 'Input/output error')
+
+        cancelled = []
+        a.open_stream('get-file', 'u', on_cancel=lambda: cancelled.append(1))
+        a.add_producer(broken_read(), unique='u')
+
+        def broken_timer():
+            raise ValueError('oops')
+
+        a.add_timer(0, broken_timer)
+
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        os.write(w, b'x')
+
+        def broken_reader(fd, mask):
+            raise ValueError('oops')
+
+        a.register_throttled_reader(r, broken_reader, protocol.Producer(
+            None, unique='v'))
+
+        for _ in range(5):
+            a.run_once(timeout=0)
+        self.assertEqual([], a._producers)
+        self.assertEqual({}, a._throttled_readers)
+        self.assertEqual({}, a.streams)
+        self.assertEqual([1], cancelled)
+        self.assertEqual(3, a.stats.counters['callback-errors'])
+
+        a.buffer = self._drain_socket(theirs)
+        errors = {p['unique']: p for p in a.find_packets()}
+        self.assertEqual('command-error', errors['u']['command'])
+        self.assertEqual(False, errors['u']['result'])
+        self.assertIn('get-file', errors['u']['message'])
+        self.assertEqual('command-error', errors['v']['command'])
+
+        # The loop still works
+        a.dispatch_packet({'command': 'ping', 'unique': 1})
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        self.assertEqual('pong', a.find_packet()['command'])
+
+    def test_agent_stats(self):
+        a, theirs = self._socket_agent()
+        a.use_json_codec('json')
+        a.start_reactor()
+        a.add_command('broken', mock.Mock(side_effect=Exception('oops')),
+                      blocking=True)
+
+        for packet in [{'command': 'ping', 'unique': 1},
+                       {'command': 'broken'},
+                       {'command': 'nosuchcommand'}]:
+            j = json.dumps(packet)
+            theirs.sendall(
+                ('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode('utf-8'))
+
+        # broken runs on a worker, and is recorded once the loop hears it
+        # has finished
+        for _ in range(20):
+            a.run_once(timeout=0.1)
+            if 'broken' in a.stats.commands:
+                break
+        self._drain_socket(theirs)
+
+        a.dispatch_packet({'command': 'get-agent-stats', 'unique': 's',
+                           'reset': True})
+        a.run_once(timeout=0)
+        a.buffer = self._drain_socket(theirs)
+        response = a.find_packet()
+        self.assertEqual('get-agent-stats-response', response['command'])
+
+        s = response['stats']
+        self.assertEqual(3, s['counters']['frames-parsed'])
+        self.assertEqual(1, s['counters']['unknown-commands'])
+        self.assertEqual(
+            len(json.dumps({'command': 'ping', 'unique': 1})) + 18,
+            s['commands']['ping']['bytes-in'])
+        self.assertEqual(1, s['commands']['ping']['count'])
+        self.assertEqual(0, s['commands']['ping']['errors'])
+        self.assertEqual(
+            len(json.dumps({'command': 'pong', 'unique': 1})) + 18,
+            s['commands']['pong']['bytes-out'])
+        self.assertEqual(1, s['commands']['broken']['errors'])
+        self.assertEqual(
+            1, s['commands']['broken']['latency']['count'])
+        self.assertFalse('nosuchcommand' in s['commands'])
+        self.assertTrue(s['high-water']['input-buffer'] > 0)
+        self.assertTrue(response['output']['frames'] >= 3)
+
+        # The request asked for the counters to be reset once read
+        self.assertFalse('ping' in a.stats.snapshot()['commands'])
+
+    def test_packet_trace(self):
+        a, theirs = self._socket_agent()
+        a.use_json_codec('json')
+        a.start_reactor()
+
+        a.dispatch_packet({'command': 'get-packet-trace', 'unique': 1})
+        a.dispatch_packet({'command': 'set-packet-trace', 'size': 3})
+        j = json.dumps({'command': 'ping', 'unique': 2})
+        theirs.sendall(('%s[%08d]%s' % (a.PREAMBLE, len(j), j)).encode('utf-8'))
+        a.run_once(timeout=1)
+        a.dispatch_packet({'command': 'get-packet-trace', 'unique': 3,
+                           'clear': True})
+        a.run_once(timeout=0)
+
+        # Only the get-packet-trace-response is left after clearing
+        self.assertEqual(1, len(a.trace.dump()))
+
+        a.buffer = self._drain_socket(theirs)
+        packets = list(a.find_packets())
+        self.assertEqual(False, packets[0]['result'])
+        self.assertEqual('packet tracing is not enabled', packets[0]['message'])
+
+        # The set-packet-trace-response, the ping, and the pong
+        entries = packets[-1]['entries']
+        self.assertEqual(['out', 'in', 'out'],
+                         [e['direction'] for e in entries])
+        self.assertEqual(
+            '%s[%08d]%s' % (a.PREAMBLE, len(j), j), entries[1]['head'])
+        self.assertTrue(entries[2]['head'].endswith('"unique": 2}'))
+
+    def test_debug_logging_is_lazy(self):
+        log = mock.Mock()
+        log.isEnabledFor.return_value = False
+        a = protocol.Agent(logger=log)
+        a._write = mock.Mock()
+        a.send_packet({'command': 'put-file', 'chunk': 'x' * 100000})
+        a.dispatch_packet({'command': 'pong'})
+        log.debug.assert_not_called()
+
+        log.isEnabledFor.return_value = True
+        a.log = log
+        a.send_packet({'command': 'put-file', 'chunk': 'x' * 100000})
+        log.debug.assert_called_with(
+            'Sent: %s', {'command': 'put-file', 'chunk': '<100000 bytes>'})
+
+    def test_json_codecs(self):
+        packet = {'command': 'put-file', 'path': '/tmp/caf\u00e9',
+                  'chunk': 'x' * 100, 'offset': 42, 'stat_result': None}
+        for codec in protocol.json_codecs():
+            a = protocol.Agent()
+            a.use_json_codec(codec)
+            a._write = mock.Mock()
+            a.send_packet(packet)
+
+            header, body = a._write.mock_calls[0].args
+            self.assertEqual(b'*SFv001*[%08d]' % len(body), header)
+            self.assertEqual(packet, json.loads(body))
+
+            for other in protocol.json_codecs():
+                b = protocol.Agent()
+                b.use_json_codec(other)
+                b._read = mock.Mock(return_value=None)
+                b.buffer = header + body
+                self.assertEqual(packet, b.find_packet())
+
+    def test_json_is_ascii_by_default(self):
+        # Older hosts fail if a read splits a multibyte character, so we
+        # only send them unescaped when asked to.
+        a = protocol.Agent()
+        a._write = mock.Mock()
+        a.send_packet({'command': 'execute-response', 'stdout': '\u25cf'})
+        a._write.mock_calls[0].args[1].decode('ascii')
+        self.assertNotIn(a.json_codec, protocol.UTF8_JSON_CODECS)
+
+        for codec in protocol.json_codecs():
+            a.dispatch_packet({'command': 'set-json-codec', 'codec': codec,
+                               'unique': 1})
+            self.assertEqual(codec, a.json_codec)
+            response = json.loads(a._write.mock_calls[-1].args[1])
+            self.assertEqual(True, response['result'])
+
+        a.dispatch_packet({'command': 'set-json-codec', 'codec': 'yaml',
+                           'unique': 2})
+        response = json.loads(a._write.mock_calls[-1].args[1])
+        self.assertEqual(False, response['result'])
+
+    def test_json_codec_falls_back(self):
+        # Whichever codec is in use, things the standard library can encode
+        # and decode still work.
+        a = protocol.Agent()
+        a._write = mock.Mock()
+        a.send_packet({'command': 'big', 'value': 2 ** 70})
+        self.assertEqual(2 ** 70, json.loads(a._write.mock_calls[0].args[1])['value'])
+
+        a._read = mock.Mock(return_value=None)
+        a.buffer = b'*SFv001*[00000014]{"value": NaN}'
+        self.assertTrue(math.isnan(a.find_packet()['value']))
@@ -0,0 +1,30 @@
+import testtools
+
+
+from shakenfist_agent import stats
+
+
+class LatencyHistogramTestCase(testtools.TestCase):
+    def test_percentiles(self):
+        h = stats.LatencyHistogram()
+        self.assertEqual(None, h.percentile(50))
+
+        for _ in range(98):
+            h.record(0.0001)
+        h.record(0.01)
+        h.record(100000)
+
+        # 100us falls in the bucket up to 128us
+        self.assertEqual(0.000128, h.percentile(50))
+        self.assertEqual(0.016384, h.percentile(99))
+        self.assertEqual(100000, h.percentile(100))
+
+        s = h.snapshot()
+        self.assertEqual(100, s['count'])
+        self.assertEqual(100000, s['max-seconds'])
+        self.assertEqual(98, s['buckets']['128us'])
+
+    def test_percentile_capped_at_max(self):
+        h = stats.LatencyHistogram()
+        h.record(0.0002)
+        self.assertEqual(0.0002, h.percentile(50))
@@ -0,0 +1,40 @@
+import testtools
+
+
+from shakenfist_agent import trace
+
+
+class TraceTestCase(testtools.TestCase):
+    def test_summarize(self):
+        self.assertEqual('short', trace.summarize(b'short'))
+        self.assertEqual('abc... (truncated from 6)',
+                         trace.summarize('abcdef', limit=3))
+        self.assertEqual('\\xff\\xfe... (truncated from 1000)',
+                         trace.summarize(b'\xff\xfe' * 500, limit=2))
+
+    def test_summarize_packet(self):
+        packet = {'command': 'put-file', 'chunk': 'x' * 100000,
+                  'path': 'p' * 1000, 'offset': 42}
+        summary = trace.summarize_packet(packet, limit=10)
+        self.assertEqual(
+            {'command': 'put-file', 'chunk': '<100000 bytes>',
+             'path': 'pppppppppp... (truncated from 1000)', 'offset': 42},
+            summary)
+
+        # The packet itself is untouched
+        self.assertEqual(100000, len(packet['chunk']))
+        self.assertEqual(None, trace.summarize_packet({'chunk': None})['chunk'])
+
+    def test_ring_buffer(self):
+        t = trace.PacketTrace(2)
+        t.record('in', b'first', 5)
+        t.record('out', memoryview(b'x' * 1000), 1000)
+        t.record('in', b'third', 5)
+
+        entries = t.dump()
+        self.assertEqual(['out', 'in'], [e['direction'] for e in entries])
+        self.assertEqual(trace.TRACE_HEAD_BYTES, len(entries[0]['head']))
+        self.assertEqual(1000, entries[0]['length'])
+
+        t.clear()
+        self.assertEqual([], t.dump())
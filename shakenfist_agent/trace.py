@@ -0,0 +1,64 @@
+import collections
+import time
+
+
+# Values longer than this are truncated when logged.
+SUMMARY_LENGTH = 256
+
+# The trace keeps this many bytes from the start of each frame, which is
+# enough for the preamble, the binary header, or the start of the JSON.
+TRACE_HEAD_BYTES = 96
+
+
+def summarize(value, limit=SUMMARY_LENGTH):
+    # A loggable version of a string or bytes, truncated if it is long
+    head = value[:limit]
+    if not isinstance(value, str):
+        head = bytes(head).decode('utf-8', errors='backslashreplace')
+    if len(value) <= limit:
+        return head
+    return '%s... (truncated from %d)' % (head, len(value))
+
+
+def summarize_packet(packet, limit=SUMMARY_LENGTH):
+    # A loggable copy of a packet with file data replaced by its length and
+    # other long values truncated. Only call this once you know the result
+    # will be logged.
+    summary = {}
+    for key, value in packet.items():
+        if key == 'chunk' and value is not None:
+            summary[key] = '<%d bytes>' % len(value)
+        elif isinstance(value, (str, bytes, bytearray)) and len(value) > limit:
+            summary[key] = summarize(value, limit)
+        else:
+            summary[key] = value
+    return summary
+
+
+class PacketTrace(object):
+    """A ring buffer remembering the start of the last few frames sent and
+    received. Recording a frame is a small copy and an append, so a trace
+    may be left enabled to see what a misbehaving agent was doing just
+    before it was asked."""
+
+    def __init__(self, size):
+        self.entries = collections.deque(maxlen=size)
+
+    def record(self, direction, head, length):
+        # head is at least the start of the frame, and length is its size
+        self.entries.append(
+            (time.time(), direction, length, bytes(head[:TRACE_HEAD_BYTES])))
+
+    def dump(self):
+        return [
+            {
+                'time': when,
+                'direction': direction,
+                'length': length,
+                'head': head.decode('utf-8', errors='backslashreplace')
+            }
+            for when, direction, length, head in self.entries
+        ]
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,24 @@
+try:
+    from importlib import metadata
+except ImportError:
+    # Python 3.7 has no importlib.metadata, so we always ask pbr
+    metadata = None
+
+
+_VERSION = None
+
+
+def version_string():
+    # Asking pbr for our version is slow, so we ask the package metadata
+    # first, and only ever ask once.
+    global _VERSION
+    if _VERSION is None:
+        if metadata:
+            try:
+                _VERSION = metadata.version('shakenfist-agent')
+            except metadata.PackageNotFoundError:
+                pass
+        if _VERSION is None:
+            from pbr.version import VersionInfo
+            _VERSION = VersionInfo('shakenfist_agent').version_string()
+    return _VERSION